@@ -295,7 +295,13 @@ nonphylogenetic_metrics = [
 cup_metrics = [alph.lladser_pe, alph.lladser_ci]
 
 
-def single_file_alpha(infilepath, metrics, outfilepath, tree_path):
+def get_alpha_calcs(metrics):
+    """Returns an AlphaDiversityCalcs object for the named metrics
+
+    metrics: list of metric names or a comma-separated string of names
+
+    Raises a ValueError if a metric is not known.
+    """
     metrics_list = metrics
     try:
         metrics_list = metrics_list.split(',')
@@ -312,14 +318,20 @@ def single_file_alpha(infilepath, metrics, outfilepath, tree_path):
                 metric_f = get_phylogenetic_metric(metric)
                 is_phylogenetic = True
             except AttributeError:
-                stderr.write(
+                raise ValueError(
                     "Could not find metric %s.\n Known metrics are: %s\n"
                     % (metric, ', '.join(list_known_metrics())))
-                exit(1)
-        c = AlphaDiversityCalc(metric_f, is_phylogenetic)
-        calcs.append(c)
+        calcs.append(AlphaDiversityCalc(metric_f, is_phylogenetic))
 
-    all_calcs = AlphaDiversityCalcs(calcs)
+    return AlphaDiversityCalcs(calcs)
+
+
+def single_file_alpha(infilepath, metrics, outfilepath, tree_path):
+    try:
+        all_calcs = get_alpha_calcs(metrics)
+    except ValueError as e:
+        stderr.write(str(e))
+        exit(1)
 
     try:
         result = all_calcs(data_path=infilepath, tree_path=tree_path,
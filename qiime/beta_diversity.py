@@ -40,9 +40,14 @@ from biom import load_table
 
 from qiime.util import (FunctionWithParams, TreeMissingError,
                         OtuMissingError)
-from qiime.format import format_matrix, format_distance_matrix
+from qiime.format import (format_matrix, format_distance_matrix,
+                          write_binary_distance_matrix,
+                          write_binary_distance_rows)
 from qiime.parse import parse_newick, PhyloNode
 import qiime.beta_metrics
+from qiime.beta_metrics import (UniFracCounts, native_unifrac_metrics,
+                                sparse_nonphylogenetic_distances,
+                                sparse_nonphylogenetic_metrics)
 
 
 def get_nonphylogenetic_metric(name):
@@ -190,8 +195,20 @@ class BetaDiversityCalc(FunctionWithParams):
         return format_distance_matrix(sample_names, data)
 
 
+def _get_sparse_sample_data(otu_table):
+    """Return the sparse samples by observations data in otu_table
+
+    Returns None if otu_table contains negative values, which
+    sparse_nonphylogenetic_distances does not handle.
+    """
+    data = otu_table.matrix_data.T.tocsr()
+    if data.nnz and data.data.min() < 0:
+        return None
+    return data
+
+
 def single_file_beta(input_path, metrics, tree_path, output_dir,
-                     rowids=None, full_tree=False):
+                     rowids=None, full_tree=False, binary_output=False):
     """ does beta diversity calc on a single otu table
 
     uses name in metrics to name output beta diversity files
@@ -203,6 +220,10 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
      tree_path (str)
      output_dir (str)
      rowids (comma separated str)
+     binary_output: if True, full distance matrices are written in the
+      binary format (see qiime.format.write_binary_distance_matrix), and
+      rows in the binary rows format (see
+      qiime.format.write_binary_distance_rows)
     """
     metrics_list = metrics
     try:
@@ -212,7 +233,10 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
 
     otu_table = load_table(input_path)
 
-    otumtx = asarray([v for v in otu_table.iter_data(axis='sample')])
+    # the samples by observations matrix is only made dense if a metric
+    # can't be computed from the sparse data
+    otumtx = None
+    sparse_data = _get_sparse_sample_data(otu_table)
 
     if tree_path:
         tree = parse_newick(open(tree_path, 'U'),
@@ -222,6 +246,7 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
 
     input_dir, input_filename = os.path.split(input_path)
     input_basename, input_ext = os.path.splitext(input_filename)
+    unifrac_counts = None
     for metric in metrics_list:
         outfilepath = os.path.join(output_dir, metric + '_' +
                                    input_basename + '.txt')
@@ -240,27 +265,63 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
                 stderr.write("Could not find metric %s.\n\nKnown metrics are: %s\n"
                              % (metric, ', '.join(list_known_metrics())))
                 exit(1)
+        sparse_metric = None
+        if (not is_phylogenetic and sparse_data is not None and
+                metric.lower() in sparse_nonphylogenetic_metrics):
+            sparse_metric = metric.lower()
+        if sparse_metric is None and otumtx is None:
+            otumtx = asarray([v for v in otu_table.iter_data(axis='sample')])
+        native_metric = None
+        if is_phylogenetic:
+            native_metric = native_unifrac_metrics.get(metric.lower())
+        if native_metric is not None and unifrac_counts is None:
+            # the node by sample counts are shared by all of the native
+            # UniFrac metrics
+            unifrac_counts = UniFracCounts(
+                otumtx, otu_table.ids(axis='observation'), tree,
+                otu_table.ids())
         if rowids is None:
             # standard, full way
-            if is_phylogenetic:
+            if native_metric is not None:
+                dissims = unifrac_counts.distances(native_metric)
+            elif sparse_metric is not None:
+                dissims = sparse_nonphylogenetic_distances(sparse_data,
+                                                           sparse_metric)
+            elif is_phylogenetic:
                 dissims = metric_f(otumtx, otu_table.ids(axis='observation'),
                                    tree, otu_table.ids(),
                                    make_subtree=(not full_tree))
             else:
                 dissims = metric_f(otumtx)
-            f = open(outfilepath, 'w')
-            f.write(format_distance_matrix(otu_table.ids(), dissims))
-            f.close()
+            if binary_output:
+                write_binary_distance_matrix(otu_table.ids(), dissims,
+                                             outfilepath)
+            else:
+                f = open(outfilepath, 'w')
+                f.write(format_distance_matrix(otu_table.ids(), dissims))
+                f.close()
         else:
             # only calc d(rowid1, *) for each rowid
             rowids_list = rowids.split(',')
+            rowidxs = [otu_table.index(rowid, axis='sample')
+                       for rowid in rowids_list]
+            # the native UniFrac and sparse metrics prepare the whole table
+            # on each call, so they compute all of the rows at once
+            if native_metric is not None:
+                all_row_dissims = unifrac_counts.distances(native_metric,
+                                                           rowidxs)
+            elif sparse_metric is not None:
+                all_row_dissims = sparse_nonphylogenetic_distances(
+                    sparse_data, sparse_metric, rowidxs)
             row_dissims = []  # same order as rowids_list
-            for rowid in rowids_list:
-                rowidx = otu_table.index(rowid, axis='sample')
+            for row_num, rowid in enumerate(rowids_list):
+                rowidx = rowidxs[row_num]
 
                 # first test if we can the dissim is a fn of only the pair
                 # if not, just calc the whole matrix
-                if metric_f.__name__ == 'dist_chisq' or \
+                if native_metric is not None or sparse_metric is not None:
+                    row_dissims.append(all_row_dissims[row_num])
+                elif metric_f.__name__ == 'dist_chisq' or \
                         metric_f.__name__ == 'dist_gower' or \
                         metric_f.__name__ == 'dist_hellinger' or\
                         metric_f.__name__ == 'binary_dist_chisq':
@@ -295,13 +356,17 @@ def single_file_beta(input_path, metrics, tree_path, output_dir,
 
             # rows_outfilepath = os.path.join(output_dir, metric + '_' +\
             #     '_'.join(rowids_list) + '_' + os.path.split(input_path)[1])
-            f = open(outfilepath, 'w')
-            f.write(
-                format_matrix(
-                    row_dissims,
-                    rowids_list,
-                    otu_table.ids()))
-            f.close()
+            if binary_output:
+                write_binary_distance_rows(rowids_list, otu_table.ids(),
+                                           row_dissims, outfilepath)
+            else:
+                f = open(outfilepath, 'w')
+                f.write(
+                    format_matrix(
+                        row_dissims,
+                        rowids_list,
+                        otu_table.ids()))
+                f.close()
 
 
 def single_object_beta(otu_table, metrics, tr, rowids=None,
@@ -318,7 +383,10 @@ def single_object_beta(otu_table, metrics, tr, rowids=None,
                                         diversity metric
                 rowids -- comma seperated string
     """
-    otumtx = asarray([v for v in otu_table.iter_sample_data()])
+    # the samples by observations matrix is only made dense if a metric
+    # can't be computed from the sparse data
+    otumtx = None
+    sparse_data = _get_sparse_sample_data(otu_table)
 
     if tr:
         tree = tr
@@ -327,6 +395,7 @@ def single_object_beta(otu_table, metrics, tr, rowids=None,
 
     metrics_list = metrics.split(',')
 
+    unifrac_counts = None
     for metric in metrics_list:
         try:
             metric_f = get_nonphylogenetic_metric(metric)
@@ -343,9 +412,29 @@ def single_object_beta(otu_table, metrics, tr, rowids=None,
                 stderr.write("Could not find metric %s.\n\nKnown metrics are: %s\n"
                              % (metric, ', '.join(list_known_metrics())))
                 exit(1)
+        sparse_metric = None
+        if (not is_phylogenetic and sparse_data is not None and
+                metric.lower() in sparse_nonphylogenetic_metrics):
+            sparse_metric = metric.lower()
+        if sparse_metric is None and otumtx is None:
+            otumtx = asarray([v for v in otu_table.iter_data(axis='sample')])
+        native_metric = None
+        if is_phylogenetic:
+            native_metric = native_unifrac_metrics.get(metric.lower())
+        if native_metric is not None and unifrac_counts is None:
+            # the node by sample counts are shared by all of the native
+            # UniFrac metrics
+            unifrac_counts = UniFracCounts(
+                otumtx, otu_table.ids(axis='observation'), tree,
+                otu_table.ids())
         if rowids is None:
             # standard, full way
-            if is_phylogenetic:
+            if native_metric is not None:
+                dissims = unifrac_counts.distances(native_metric)
+            elif sparse_metric is not None:
+                dissims = sparse_nonphylogenetic_distances(sparse_data,
+                                                           sparse_metric)
+            elif is_phylogenetic:
                 dissims = metric_f(otumtx, otu_table.ids(axis='observation'),
                                    tree, otu_table.ids(),
                                    make_subtree=(not full_tree))
@@ -367,7 +456,13 @@ def single_object_beta(otu_table, metrics, tr, rowids=None,
 
                 # first test if we can the dissim is a fn of only the pair
                 # if not, just calc the whole matrix
-                if metric_f.__name__ == 'dist_chisq' or \
+                if native_metric is not None:
+                    row_dissims.append(
+                        unifrac_counts.distances(native_metric, [rowidx])[0])
+                elif sparse_metric is not None:
+                    row_dissims.append(sparse_nonphylogenetic_distances(
+                        sparse_data, sparse_metric, [rowidx])[0])
+                elif metric_f.__name__ == 'dist_chisq' or \
                         metric_f.__name__ == 'dist_gower' or \
                         metric_f.__name__ == 'dist_hellinger' or\
                         metric_f.__name__ == 'binary_dist_chisq':
@@ -404,7 +499,7 @@ def single_object_beta(otu_table, metrics, tr, rowids=None,
 
 
 def multiple_file_beta(input_path, output_dir, metrics, tree_path,
-                       rowids=None, full_tree=False):
+                       rowids=None, full_tree=False, binary_output=False):
     """ runs beta diversity for each input file in the input directory
 
     performs minimal error checking on input args, then calls single_file_beta
@@ -444,4 +539,5 @@ def multiple_file_beta(input_path, output_dir, metrics, tree_path,
 
     for fname in file_names:
         single_file_beta(os.path.join(input_path, fname),
-                         metrics, tree_path, output_dir, rowids, full_tree)
+                         metrics, tree_path, output_dir, rowids, full_tree,
+                         binary_output)
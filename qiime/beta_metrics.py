@@ -47,20 +47,219 @@ def make_unifrac_metric(weighted, metric, is_symmetric):
         return dist_mtx
     return result
 
+
+class UniFracCounts(object):
+
+    """Node by sample counts shared by the native UniFrac metrics
+
+    The tree is traversed once, in postorder, to build a branch length vector
+    and a matrix of the number of sequences from each sample below each node.
+    Unweighted, weighted and normalized weighted UniFrac between any samples
+    are then computed from these arrays with numpy, rather than indexing the
+    tree and building an envs dict for each metric as fast_unifrac does.
+
+    Only nodes with at least one observation below them are kept. This gives
+    the same distances as fast_unifrac on the subtree relating the observed
+    taxa (the default), and on the full tree.
+    """
+
+    metrics = ('unweighted', 'weighted', 'weighted_normalized')
+
+    def __init__(self, data, taxon_names, tree, sample_names,
+                 block_size=4194304):
+        """Build the node by sample counts
+
+        data: samples by taxa 2d array of counts
+        taxon_names: taxon names in the order of the columns of data; taxa
+         which are not tips in the tree are ignored
+        tree: PhyloNode tree relating the taxa
+        sample_names: sample names in the order of the rows of data
+        block_size: maximum number of array elements in the temporary arrays
+         used to compute distances
+        """
+        num_samples, num_taxa = data.shape
+        if (num_samples, num_taxa) != (len(sample_names), len(taxon_names)):
+            raise ValueError(
+                "Shape of matrix %s doesn't match # samples and # taxa "
+                "(%s and %s)" % (data.shape, len(sample_names),
+                                 len(taxon_names)))
+        self.sample_names = list(sample_names)
+        self.block_size = block_size
+
+        nodes = list(tree.postorder())
+        node_index = dict((id(node), i) for i, node in enumerate(nodes))
+        # the root is last in postorder, and has no parent in the tree
+        parents = np.array([node_index[id(node.Parent)]
+                            for node in nodes[:-1]], dtype=int)
+        tip_index = dict((node.Name, i) for i, node in enumerate(nodes)
+                         if not node.Children)
+        taxon_cols = []
+        tip_rows = []
+        for i, taxon_name in enumerate(taxon_names):
+            if taxon_name in tip_index:
+                taxon_cols.append(i)
+                tip_rows.append(tip_index[taxon_name])
+        if not taxon_cols:
+            raise ValueError("No valid samples/environments found. Check "
+                             "whether tree tips match otus/taxa present in "
+                             "samples/environments")
+        tip_counts = np.asarray(data, dtype=float)[:, taxon_cols].T
+
+        # find the nodes with observations below them
+        observed = np.zeros(len(nodes), dtype=bool)
+        observed[tip_rows] = tip_counts.sum(1) > 0
+        for i, parent in enumerate(parents):
+            if observed[i]:
+                observed[parent] = True
+        kept = np.flatnonzero(observed)
+        new_index = np.cumsum(observed) - 1
+        parents = new_index[parents[kept[:-1]]]
+
+        self.branch_lengths = np.array([nodes[i].Length or 0.0
+                                        for i in kept])
+        self.counts = np.zeros((len(kept), num_samples))
+        tip_rows = np.array(tip_rows, dtype=int)
+        observed_tips = observed[tip_rows]
+        self.counts[new_index[tip_rows[observed_tips]]] = \
+            tip_counts[observed_tips]
+        self.tip_rows = np.unique(new_index[tip_rows[observed_tips]])
+        for i, parent in enumerate(parents):
+            self.counts[parent] += self.counts[i]
+
+        # distance from the root to each node, including the root's length
+        self.root_distances = self.branch_lengths.copy()
+        for i in range(len(parents) - 1, -1, -1):
+            self.root_distances[i] += self.root_distances[parents[i]]
+
+        self.sample_totals = self.counts[self.tip_rows].sum(0)
+        self.present = self.sample_totals > 0
+
+    def distances(self, metric, rows=None):
+        """Return the distances from samples in rows to all samples
+
+        metric: one of UniFracCounts.metrics
+        rows: indices of the samples to compute distances from, or None to
+         compute the full distance matrix
+
+        Samples with no observations on the tree are 1.0 from all other
+        samples, except from other samples without observations, with a
+        warning, as in beta_metrics.dist_unweighted_unifrac.
+        """
+        if metric not in self.metrics:
+            raise ValueError("Unknown UniFrac metric %s. Known metrics are: "
+                             "%s" % (metric, ', '.join(self.metrics)))
+        num_samples = len(self.sample_names)
+        if rows is None:
+            rows = range(num_samples)
+            symmetric = True
+        else:
+            symmetric = False
+        rows = np.asarray(rows, dtype=int)
+
+        for i in rows:
+            if not self.present[i]:
+                warnings.warn('unifrac had no information for sample ' +
+                              self.sample_names[i] +
+                              ". Distances involving that sample aren't "
+                              "meaningful")
+
+        present = np.flatnonzero(self.present)
+        present_index = np.cumsum(self.present) - 1
+        present_rows = rows[self.present[rows]]
+        if len(present_rows) == 0:
+            present_dists = np.zeros((0, len(present)))
+        elif metric == 'unweighted':
+            present_dists = self._unweighted(present,
+                                             present_index[present_rows])
+        else:
+            present_dists = self._weighted(
+                present, present_index[present_rows], symmetric,
+                normalized=(metric == 'weighted_normalized'))
+
+        result = np.ones((len(rows), num_samples))
+        result[np.ix_(~self.present[rows], ~self.present)] = 0.0
+        result[np.ix_(self.present[rows], self.present)] = present_dists
+        result[np.arange(len(rows)), rows] = 0.0
+        return result
+
+    def _unweighted(self, present, rows):
+        """Unweighted UniFrac from present samples in rows to all present"""
+        shared = np.zeros((len(rows), len(present)))
+        totals = np.zeros(len(present))
+        block_rows = max(1, self.block_size // len(present))
+        for start in range(0, len(self.branch_lengths), block_rows):
+            end = start + block_rows
+            observed = (self.counts[start:end, present] > 0).astype(float)
+            branch_lengths = self.branch_lengths[start:end, np.newaxis]
+            observed_lengths = observed * branch_lengths
+            shared += np.dot(observed[:, rows].T, observed_lengths)
+            totals += observed_lengths.sum(0)
+        union = totals[rows, np.newaxis] + totals - shared
+        return 1 - shared / union
+
+    def _weighted(self, present, rows, symmetric, normalized):
+        """Weighted UniFrac from present samples in rows to all present
+
+        If symmetric, rows must be all of the present samples, and only the
+        upper triangle of the distance matrix is computed.
+        """
+        proportions = self.counts[:, present] / self.sample_totals[present]
+        result = np.zeros((len(rows), len(present)))
+        block_cols = max(1, self.block_size // len(self.branch_lengths))
+        for i, row in enumerate(rows):
+            first_col = row + 1 if symmetric else 0
+            row_proportions = proportions[:, row, np.newaxis]
+            for start in range(first_col, len(present), block_cols):
+                end = start + block_cols
+                result[i, start:end] = np.dot(
+                    self.branch_lengths,
+                    np.abs(proportions[:, start:end] - row_proportions))
+        if symmetric:
+            result = result + result.T
+        if normalized:
+            tip_distances = np.dot(self.root_distances[self.tip_rows],
+                                   proportions[self.tip_rows])
+            result /= tip_distances[rows, np.newaxis] + tip_distances
+        return result
+
+
+# metrics which are computed with UniFracCounts, and the UniFracCounts
+# metric used for each
+native_unifrac_metrics = {'unweighted_unifrac': 'unweighted',
+                          'unifrac': 'unweighted',
+                          'weighted_unifrac': 'weighted',
+                          'weighted_normalized_unifrac': 'weighted_normalized'}
+
+
+def make_native_unifrac_metric(metric):
+    """Make a UniFrac metric computed with UniFracCounts
+
+    metric: one of UniFracCounts.metrics
+
+    The result has the same interface as metrics made by make_unifrac_metric.
+    make_subtree is accepted but ignored, as the distances are the same with
+    or without it.
+    """
+    def result(data, taxon_names, tree, sample_names, **kwargs):
+        """ computes the distance matrix, in the order of sample_names"""
+        unifrac_counts = UniFracCounts(data, taxon_names, tree, sample_names)
+        return unifrac_counts.distances(metric)
+    return result
+
+
 # these should start with dist_ to be discoverable by beta_diversity.py
 # unweighted full tree => keep the full tree relating all samples.
 # Compute how much branch
 # length is present in one sample but not (both samples OR NEITHER
 # SAMPLE).  Divide by total branch length of full tree.
 # G is asymmetric unifrac
-dist_unweighted_unifrac = make_unifrac_metric(False, fast_tree.unifrac, True)
+dist_unweighted_unifrac = make_native_unifrac_metric('unweighted')
 dist_unifrac = dist_unweighted_unifrac  # default unifrac is just unifrac
 dist_unweighted_unifrac_full_tree = make_unifrac_metric(False,
                                                         fast_tree.unnormalized_unifrac, True)
-dist_weighted_unifrac = make_unifrac_metric(True,
-                                            fast_tree.weighted_unifrac, True)
-dist_weighted_normalized_unifrac = make_unifrac_metric('correct',
-                                                       fast_tree.weighted_unifrac, True)
+dist_weighted_unifrac = make_native_unifrac_metric('weighted')
+dist_weighted_normalized_unifrac = make_native_unifrac_metric(
+    'weighted_normalized')
 dist_unifrac_g = make_unifrac_metric(False, fast_tree.G, False)
 dist_unifrac_g_full_tree = make_unifrac_metric(False,
                                                fast_tree.unnormalized_G, False)
@@ -101,18 +300,31 @@ def make_unifrac_row_metric(weighted, metric, is_symmetric):
         return dist_mtx
     return result
 
-one_sample_unweighted_unifrac = make_unifrac_row_metric(
-    False,
-    fast_tree.unifrac,
-    True)
+
+def make_native_unifrac_row_metric(metric):
+    """Make a UniFrac row metric computed with UniFracCounts
+
+    metric: one of UniFracCounts.metrics
+
+    The result has the same interface as metrics made by
+    make_unifrac_row_metric.
+    """
+    def result(data, taxon_names, tree, sample_names,
+               one_sample_name, **kwargs):
+        """ computes the distances from one_sample_name to all samples"""
+        unifrac_counts = UniFracCounts(data, taxon_names, tree, sample_names)
+        row = list(sample_names).index(one_sample_name)
+        return unifrac_counts.distances(metric, rows=[row])[0]
+    return result
+
+one_sample_unweighted_unifrac = make_native_unifrac_row_metric('unweighted')
 # default unifrac is just unifrac
 one_sample_unifrac = one_sample_unweighted_unifrac
 one_sample_unweighted_unifrac_full_tree = make_unifrac_row_metric(False,
                                                                   fast_tree.unnormalized_unifrac, True)
-one_sample_weighted_unifrac = make_unifrac_row_metric(True,
-                                                      fast_tree.weighted_unifrac, True)
-one_sample_weighted_normalized_unifrac = make_unifrac_row_metric('correct',
-                                                                 fast_tree.weighted_unifrac, True)
+one_sample_weighted_unifrac = make_native_unifrac_row_metric('weighted')
+one_sample_weighted_normalized_unifrac = make_native_unifrac_row_metric(
+    'weighted_normalized')
 one_sample_unifrac_g = make_unifrac_row_metric(False, fast_tree.G, False)
 one_sample_unifrac_g_full_tree = make_unifrac_row_metric(False,
                                                          fast_tree.unnormalized_G, False)
@@ -192,3 +404,155 @@ def _reorder_unifrac_res_one_sample(
                 unifrac_i = unifrac_sample_names_idx[sam_i]
                 dist_arry[i] = unifrac_dist_arry[unifrac_i]
     return dist_arry
+
+
+def _sparse_bray_curtis(mins, row_sums, col_sums):
+    totals = row_sums + col_sums
+    return np.where(totals > 0, (totals - 2 * mins) / np.where(totals > 0,
+                                                               totals, 1), 0.0)
+
+
+def _sparse_manhattan(mins, row_sums, col_sums):
+    return row_sums + col_sums - 2 * mins
+
+
+def _sparse_kulczynski(mins, row_sums, col_sums):
+    both_empty = (row_sums == 0) & (col_sums == 0)
+    one_empty = (row_sums == 0) | (col_sums == 0)
+    result = 1.0 - (mins / np.where(row_sums == 0, 1, row_sums) +
+                    mins / np.where(col_sums == 0, 1, col_sums)) / 2.0
+    return np.where(both_empty, 0.0, np.where(one_empty, 1.0, result))
+
+
+def _sparse_soergel(mins, row_sums, col_sums):
+    maxes = row_sums + col_sums - mins
+    return np.where(maxes > 0, (maxes - mins) / np.where(maxes > 0, maxes, 1),
+                    0.0)
+
+
+def _sparse_euclidean(products, row_sumsq, col_sumsq):
+    return np.sqrt(np.maximum(row_sumsq + col_sumsq - 2 * products, 0.0))
+
+
+def _sparse_binary_jaccard(shared, row_nnz, col_nnz):
+    union = row_nnz + col_nnz - shared
+    return np.where(union > 0, 1.0 - shared / np.where(union > 0, union, 1),
+                    0.0)
+
+
+def _sparse_binary_sorensen_dice(shared, row_nnz, col_nnz):
+    totals = row_nnz + col_nnz
+    return np.where(totals > 0,
+                    1.0 - 2 * shared / np.where(totals > 0, totals, 1), 0.0)
+
+
+def _sparse_binary_hamming(shared, row_nnz, col_nnz):
+    return row_nnz + col_nnz - 2 * shared
+
+
+def _sparse_binary_euclidean(shared, row_nnz, col_nnz):
+    return np.sqrt(row_nnz + col_nnz - 2 * shared)
+
+# non-phylogenetic metrics which can be computed from sparse data, as
+# (pairwise statistic, per sample statistic, f(pairwise, row, col)). The
+# pairwise statistics are sums over the observations of the min of the two
+# counts ('min'), their product ('product') or whether both are nonzero
+# ('shared'), which only need to be computed where both counts are nonzero.
+sparse_nonphylogenetic_metrics = {
+    'bray_curtis': ('min', 'sum', _sparse_bray_curtis),
+    'bray_curtis_faith': ('min', 'sum', _sparse_bray_curtis),
+    'manhattan': ('min', 'sum', _sparse_manhattan),
+    'kulczynski': ('min', 'sum', _sparse_kulczynski),
+    'soergel': ('min', 'sum', _sparse_soergel),
+    'euclidean': ('product', 'sumsq', _sparse_euclidean),
+    'binary_jaccard': ('shared', 'nnz', _sparse_binary_jaccard),
+    'binary_sorensen_dice': ('shared', 'nnz', _sparse_binary_sorensen_dice),
+    'binary_hamming': ('shared', 'nnz', _sparse_binary_hamming),
+    'binary_euclidean': ('shared', 'nnz', _sparse_binary_euclidean)}
+
+
+def sparse_nonphylogenetic_distances(data, metric, rows=None,
+                                     block_size=4194304):
+    """Compute a non-phylogenetic metric from sparse samples by taxa data
+
+    data: scipy.sparse samples by taxa matrix of nonnegative counts (e.g.,
+     the transpose of a biom Table's matrix_data)
+    metric: a key of sparse_nonphylogenetic_metrics
+    rows: indices of the samples to compute distances from, or None to
+     compute the full distance matrix
+    block_size: maximum number of array elements in the temporary arrays
+
+    The counts of a block of samples are expanded to a dense array, and
+    compared with the nonzero counts of the other samples, so memory use is
+    bounded by the distance matrix and block_size rather than by the size
+    of the dense table. Gives the same distances as the
+    cogent.maths.distance_transform metric of the same name.
+    """
+    try:
+        pair_stat, sample_stat, combine_f = \
+            sparse_nonphylogenetic_metrics[metric]
+    except KeyError:
+        raise ValueError("Unknown sparse metric %s. Known metrics are: %s" %
+                         (metric, ', '.join(
+                             sorted(sparse_nonphylogenetic_metrics))))
+    data = data.tocsr().astype(float)
+    data.eliminate_zeros()
+    if data.nnz and data.data.min() < 0:
+        raise ValueError("negative value in input matrix")
+    num_samples, num_taxa = data.shape
+    indptr = data.indptr
+    if sample_stat == 'sum':
+        sample_stats = np.asarray(data.sum(1)).ravel()
+    elif sample_stat == 'sumsq':
+        sample_stats = np.asarray(data.multiply(data).sum(1)).ravel()
+    else:
+        sample_stats = np.diff(indptr).astype(float)
+
+    if rows is None:
+        rows = np.arange(num_samples)
+        symmetric = True
+    else:
+        rows = np.asarray(rows, dtype=int)
+        symmetric = False
+    result = np.zeros((len(rows), num_samples))
+
+    rows_per_block = max(1, min(len(rows), block_size // max(num_taxa, 1)))
+    max_chunk_nnz = max(1, block_size // rows_per_block)
+    for block_start in range(0, len(rows), rows_per_block):
+        block_rows = rows[block_start:block_start + rows_per_block]
+        block = data[block_rows].toarray()
+        # in the symmetric case only the lower triangle is computed
+        num_cols = block_rows[-1] + 1 if symmetric else num_samples
+        pair_stats = np.zeros((len(block_rows), num_cols))
+        chunk_start = 0
+        while chunk_start < num_cols:
+            chunk_end = np.searchsorted(
+                indptr, indptr[chunk_start] + max_chunk_nnz, side='right') - 1
+            chunk_end = min(max(chunk_end, chunk_start + 1), num_cols)
+            start, end = indptr[chunk_start], indptr[chunk_end]
+            if end > start:
+                block_values = block[:, data.indices[start:end]]
+                values = data.data[start:end]
+                if pair_stat == 'min':
+                    block_values = np.minimum(block_values, values)
+                elif pair_stat == 'product':
+                    block_values *= values
+                else:
+                    block_values = (block_values > 0).astype(float)
+                # sum the values for each nonempty sample in the chunk
+                counts = np.diff(indptr[chunk_start:chunk_end + 1])
+                nonempty = np.flatnonzero(counts)
+                pair_stats[:, chunk_start + nonempty] = np.add.reduceat(
+                    block_values,
+                    indptr[chunk_start + nonempty] - start, axis=1)
+            chunk_start = chunk_end
+        result[block_start:block_start + len(block_rows), :num_cols] = \
+            combine_f(pair_stats, sample_stats[block_rows, np.newaxis],
+                      sample_stats[:num_cols])
+
+    if symmetric:
+        result = np.tril(result, -1)
+        result = result + result.T
+    else:
+        result[np.arange(len(rows)), rows] = 0.0
+    return result
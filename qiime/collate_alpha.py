@@ -69,3 +69,35 @@ def make_output_row(f_metrics, metric, f_samples, f_data,
     output_row.insert(1, seqs)
     output_row.insert(2, iter)
     return output_row
+
+
+def collate_alpha_results(alpha_results, output_dir):
+    """Writes one collated file per alpha metric from in-memory results
+
+    alpha_results: list of (fname, metrics, samples, data) tuples, one per
+     rarefied table, where data is the samples by metrics array computed
+     by AlphaDiversityCalcs and fname is the name the alpha diversity file
+     would have had (e.g. alpha_rarefaction_10_0.txt)
+    output_dir: directory where <metric>.txt files are written
+
+    The output is identical to running collate_alpha.py on a directory of
+    alpha diversity files with the same names and contents.
+    """
+    if not alpha_results:
+        return
+
+    # the shallowest rarefaction contains all of the samples and is used
+    # as the example, as collate_alpha.py does by default
+    example = min(alpha_results,
+                  key=lambda r: parse_rarefaction_fname(r[0])[1])
+    all_metrics, all_samples = example[1], list(example[2])
+    num_cols = len(all_samples)
+
+    for metric in all_metrics:
+        metric_file_data = []
+        for fname, f_metrics, f_samples, f_data in alpha_results:
+            metric_file_data.append(
+                make_output_row(f_metrics, metric, f_samples,
+                                f_data, fname, num_cols, all_samples))
+
+        write_output_file(metric_file_data, output_dir, metric, all_samples)
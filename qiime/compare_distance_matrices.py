@@ -13,10 +13,10 @@ __email__ = "jai.rideout@gmail.com"
 from os import path
 
 from skbio.stats import p_value_to_str
-from skbio.stats.distance import DistanceMatrix, mantel
+from skbio.stats.distance import DistanceMatrix
 
 from qiime.util import make_compatible_distance_matrices
-from qiime.stats import MantelCorrelogram, PartialMantel
+from qiime.stats import MantelCorrelogram, PartialMantel, mantel_pearson
 
 
 def run_mantel_test(method, fps, distmats, num_perms, tail_type, comment,
@@ -104,9 +104,8 @@ def run_mantel_test(method, fps, distmats, num_perms, tail_type, comment,
             dm2 = DistanceMatrix(dm2_data, dm2_labels)
 
             if method == 'mantel':
-                corr_coeff, p_value, n = mantel(dm1, dm2, method='pearson',
-                                 permutations=num_perms, alternative=tail_type,
-                                 strict=True)
+                corr_coeff, p_value, n = mantel_pearson(dm1, dm2, num_perms,
+                                                        tail_type)
                 p_str = p_value_to_str(p_value, num_perms)
                 result += "%s\t%s\t%d\t%.5f\t%s\t%d\t%s\n" % (
                     fp1, fp2, n, corr_coeff, p_str, num_perms, tail_type)
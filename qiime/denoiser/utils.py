@@ -24,13 +24,11 @@ from subprocess import Popen, PIPE, STDOUT
 import pickle
 from tempfile import mkstemp
 
-from skbio.sequence import BiologicalSequence
 from burrito.util import ApplicationNotFoundError, ApplicationError
-from skbio.util import create_dir
 from bfillings.denoiser import lazy_parse_sff_handle
 from burrito.util import which
 
-from qiime.util import (get_qiime_project_dir, FileFormatError)
+from qiime.util import (get_qiime_project_dir, FileFormatError, create_dir)
 
 
 def write_sff_header(header, fh, num=None):
@@ -209,6 +207,7 @@ def get_representatives(mapping, seqs):
 
     seqs_fh: An open Fasta filehandle
     """
+    from skbio.sequence import BiologicalSequence
     for (label, seq) in seqs:
         if(label in mapping):
             seq = BiologicalSequence(
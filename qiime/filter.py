@@ -15,8 +15,6 @@ from collections import defaultdict
 from random import shuffle, sample
 from numpy import array, inf
 
-from skbio.parse.sequences import parse_fasta, parse_fastq
-from skbio.format.sequences import format_fastq_record
 from biom import load_table
 
 from qiime.parse import (parse_distmat, parse_mapping_file,
@@ -349,6 +347,7 @@ def filter_fasta(input_seqs_f, output_seqs_f, seqs_to_keep, negate=False,
         else:
             keep_seq = lambda x: not seqid_f(x)
 
+    from skbio.parse.sequences import parse_fasta
     for seq_id, seq in parse_fasta(input_seqs_f):
         if keep_seq(seq_id):
             output_seqs_f.write('>%s\n%s\n' % (seq_id, seq))
@@ -378,6 +377,8 @@ def filter_fastq(input_seqs_f, output_seqs_f, seqs_to_keep, negate=False,
         else:
             keep_seq = lambda x: not seqid_f(x)
 
+    from skbio.parse.sequences import parse_fastq
+    from skbio.format.sequences import format_fastq_record
     for seq_id, seq, qual in parse_fastq(input_seqs_f,
                                          enforce_qual_range=False):
         if keep_seq(seq_id):
@@ -523,6 +524,7 @@ get_seq_ids_from_seq_id_file = get_seqs_to_keep_lookup_from_seq_id_file
 
 def get_seqs_to_keep_lookup_from_fasta_file(fasta_f):
     """return the sequence ids within the fasta file"""
+    from skbio.parse.sequences import parse_fasta
     return (
         set([seq_id.split()[0] for seq_id, seq in parse_fasta(fasta_f)])
     )
@@ -17,10 +17,10 @@ from re import compile, sub
 from os import walk
 from os.path import join, splitext, exists, isfile, abspath
 
-from skbio.sequence import BiologicalSequence
 from biom.table import Table
 
 from qiime.util import get_qiime_library_version, load_qiime_config
+from qiime.parse import BINARY_DISTMAT_MAGIC, BINARY_DISTROWS_MAGIC
 from qiime.colors import data_color_hsv
 
 """Contains formatters for the files we expect to encounter in 454 workflow.
@@ -278,6 +278,55 @@ def format_distance_matrix(labels, data):
     return format_matrix(data, labels, labels)
 
 
+def write_binary_distance_matrix(labels, data, output_fp):
+    """Writes distance matrix in QIIME's binary distance matrix format
+
+    The file starts with a line identifying the format, followed by a
+    tab-separated line of labels (as in the header of
+    format_distance_matrix). The condensed upper triangle of the matrix
+    (as returned by scipy.spatial.distance.squareform) then follows as
+    little-endian 64-bit floats, starting at the next multiple of 8 bytes.
+    Use qiime.parse.parse_binary_distmat to read the file with
+    numpy.memmap, or qiime.parse.parse_distmat to read the full matrix.
+    """
+    data = asarray(data)
+    if data.shape != (len(labels), len(labels)):
+        raise ValueError(
+            "Data shape of %s doesn't match header sizes %s %s" %
+            (data.shape, len(labels), len(labels)))
+    header = BINARY_DISTMAT_MAGIC + '\t%s\n' % '\t'.join(map(str, labels))
+    of = open(output_fp, 'wb')
+    of.write(header)
+    of.write('\n' * (-len(header) % 8))
+    for i in range(len(labels)):
+        data[i, i + 1:].astype('<f8').tofile(of)
+    of.close()
+
+
+def write_binary_distance_rows(row_labels, col_labels, data, output_fp):
+    """Writes rows of a distance matrix in QIIME's binary format
+
+    The file starts with a line identifying the format, followed by a
+    tab-separated line of column labels (as in the header of
+    format_matrix) and a tab-separated line of row labels. The rows then
+    follow as little-endian 64-bit floats, starting at the next multiple of
+    8 bytes. Use qiime.parse.parse_binary_distance_rows to read the file.
+    """
+    data = asarray(data)
+    if data.shape != (len(row_labels), len(col_labels)):
+        raise ValueError(
+            "Data shape of %s doesn't match header sizes %s %s" %
+            (data.shape, len(row_labels), len(col_labels)))
+    header = '%s\t%s\n%s\n' % (BINARY_DISTROWS_MAGIC,
+                                 '\t'.join(map(str, col_labels)),
+                                 '\t'.join(map(str, row_labels)))
+    of = open(output_fp, 'wb')
+    of.write(header)
+    of.write('\n' * (-len(header) % 8))
+    data.astype('<f8').tofile(of)
+    of.close()
+
+
 def format_matrix(data, row_names, col_names):
     """Writes matrix as tab-delimited text.
 
@@ -600,6 +649,7 @@ def write_Fasta_from_name_seq_pairs(name_seqs, fh):
     if fh is None:
         raise ValueError("Need open file handle to write to.")
 
+    from skbio.sequence import BiologicalSequence
     for (name, seq) in name_seqs:
         fh.write("%s\n" % BiologicalSequence(seq, id=name).to_fasta())
 
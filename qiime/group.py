@@ -172,21 +172,19 @@ def get_field_state_comparisons(dist_matrix_header, dist_matrix,
                                               suppress_symmetry_and_hollowness_check)
 
     # Build up our 2D dictionary giving the distances between a field state and
-    # a comparison group field state by filtering out the between_groupings
-    # list to include only the comparisons that we want.
+    # a comparison group field state by looking up the between_groupings for
+    # each pair of field states that we want.
+    between_distances = {}
+    for group in between_groupings:
+        between_distances[(group[0], group[1])] = group[2]
+        between_distances[(group[1], group[0])] = group[2]
+
     result = {}
     for field_state in field_states:
         result[field_state] = {}
         for comp_field_state in comparison_field_states:
-            result[field_state][comp_field_state] = []
-            for group in between_groupings:
-                if ((group[0] == field_state or group[1] == field_state)
-                    and (group[0] == comp_field_state or
-                         group[1] == comp_field_state)):
-                    # We've found a group of distances between our comparison
-                    # field state and the current field state, so keep the
-                    # data.
-                    result[field_state][comp_field_state] = group[2]
+            result[field_state][comp_field_state] = between_distances.get(
+                (field_state, comp_field_state), [])
     return result
 
 
@@ -551,8 +549,20 @@ def _get_indices(input_items, wanted_items):
     if isinstance(wanted_items, basestring):
         wanted_items = [wanted_items]
 
-    return [input_items.index(item)
-            for item in wanted_items if item in input_items]
+    index_map = _get_index_map(input_items)
+    return [index_map[item] for item in wanted_items if item in index_map]
+
+
+def _get_index_map(items):
+    """Returns a dict mapping each item to the index of its first occurrence.
+
+    Building this once and looking items up in it avoids a linear search of
+    items for every item looked up.
+    """
+    index_map = {}
+    for i, item in enumerate(items):
+        index_map.setdefault(item, i)
+    return index_map
 
 
 def _get_groupings(dist_matrix_header, dist_matrix, groups, within=True,
@@ -590,33 +600,34 @@ def _get_groupings(dist_matrix_header, dist_matrix, groups, within=True,
         if not is_symmetric_and_hollow(dist_matrix):
             raise ValueError("The distance matrix must be symmetric and "
                              "hollow.")
-    result = []
+    dist_matrix = np.asarray(dist_matrix)
+    index_map = _get_index_map(dist_matrix_header)
     group_items = groups.items()
+    group_indices = [np.array([index_map[sample_id]
+                               for sample_id in sample_ids
+                               if sample_id in index_map], dtype=int)
+                     for _, sample_ids in group_items]
 
-    for i, (row_group, row_ids) in enumerate(group_items):
-        row_indices = _get_indices(dist_matrix_header, row_ids)
+    result = []
+    for i, (row_group, _) in enumerate(group_items):
+        row_indices = group_indices[i]
         if within:
-            # Handle the case where indices are the same so we need to omit
-            # the diagonal.
-            block = dist_matrix[row_indices][:, row_indices]
-
-            size = len(row_indices)
-            indices = []
-            for i in range(size):
-                for j in range(i, size):
-                    if i != j:
-                        indices.append(block[i][j])
-            if indices:
-                result.append((row_group, row_group, indices))
+            # Handle the case where indices are the same: take the upper
+            # triangle of the block so that the diagonal is omitted and each
+            # pair of samples is only included once.
+            block = dist_matrix[np.ix_(row_indices, row_indices)]
+            vals = list(block[np.triu_indices(len(row_indices), 1)])
+            if vals:
+                result.append((row_group, row_group, vals))
         else:
             # Handle the case where indices are separate: just return blocks.
-            for j in range(i + 1, len(groups)):
-                col_group, col_ids = group_items[j]
-                col_indices = _get_indices(dist_matrix_header, col_ids)
-                vals = dist_matrix[row_indices][:, col_indices]
+            for j in range(i + 1, len(group_items)):
+                col_group, _ = group_items[j]
+                col_indices = group_indices[j]
+                vals = dist_matrix[np.ix_(row_indices, col_indices)]
 
                 # Flatten the array into a single-level list.
-                vals = map(None, vals.flat)
+                vals = list(vals.flat)
                 if vals:
                     result.append((row_group, col_group, vals))
     return result
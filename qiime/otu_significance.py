@@ -12,17 +12,21 @@ __email__ = "lkursell@gmail.com"
 
 from qiime.parse import parse_mapping_file_to_dict
 from numpy import (array, argsort, vstack, isnan, inf, nan, apply_along_axis,
-                   mean, zeros, isinf, logical_or)
+                   mean, zeros, isinf, logical_or, empty)
+from numpy.random import (get_state, set_state, seed as set_seed, randint,
+                          RandomState)
 
 from qiime.stats import (fisher_population_correlation,
                                   pearson, spearman, g_fit, ANOVA_one_way, 
                                   kruskal_wallis, mw_t, mw_boot, t_paired, 
                                   mc_t_two_sample, t_two_sample, fisher, 
-                                  kendall, assign_correlation_pval, cscore)
+                                  kendall, assign_correlation_pval, cscore,
+                                  mc_t_two_sample_rows)
 
 from qiime.util import biom_taxonomy_formatter
-from collections import defaultdict
-from itertools import izip
+from collections import defaultdict, deque
+from itertools import izip, islice
+from multiprocessing import Pool
 
 """
 Library for group_significance.py.
@@ -70,6 +74,23 @@ CORRELATION_PVALUE_CHOICES = [
     'parametric_t_distribution', 'fisher_z_transform',
     'bootstrapped', 'kendall']
 
+# the row generators densify this many rows of the OTU table at a time, so
+# that memory use follows the block size rather than the size of the table.
+OBSERVATION_BLOCK_SIZE = 1000
+
+
+def observation_blocks(bt, block_size=OBSERVATION_BLOCK_SIZE):
+    """Yield consecutive blocks of rows of bt as dense 2D arrays.
+
+    Inputs:
+     bt - biom table object. Described at top of library.
+     block_size - int, maximum number of rows in each block.
+    """
+    data = bt.matrix_data.tocsr()
+    num_rows = data.shape[0]
+    for start in range(0, num_rows, block_size):
+        yield data[start:min(start + block_size, num_rows)].toarray()
+
 # Functions for group significance testing
 
 
@@ -109,20 +130,26 @@ def get_sample_indices(cat_sam_groups, bt):
     return cat_sam_indices
 
 
-def group_significance_row_generator(bt, cat_sam_indices):
+def group_significance_row_generator(bt, cat_sam_indices,
+                                     block_size=OBSERVATION_BLOCK_SIZE):
     """Produce generator that feeds lists of arrays to group significance tests.
 
     Read library documentation for description of what a 'row' is.
     Inputs:
      bt - biom table object. Described at top of library.
      cat_sam_indices - dict, output of get_sample_indices.
+     block_size - int, number of rows of bt to densify at a time.
     """
-    data = array([i for i in bt.iter_data(axis='observation')])
-    indices = cat_sam_indices.values()  # list of lists of column indices
-    return izip(*[data.take(i, axis=1) for i in indices])
+    # list of arrays of column indices
+    indices = [array(i, dtype=int) for i in cat_sam_indices.values()]
+    for block in observation_blocks(bt, block_size):
+        for row in izip(*[block.take(i, axis=1) for i in indices]):
+            yield row
 
 
-def run_group_significance_test(data_generator, test, test_choices, reps=1000):
+def run_group_significance_test(data_generator, test, test_choices, reps=1000,
+                                block_size=OBSERVATION_BLOCK_SIZE,
+                                jobs_to_start=1, seed=None):
     """Run any of the group significance tests.
 
     Inputs:
@@ -134,14 +161,57 @@ def run_group_significance_test(data_generator, test, test_choices, reps=1000):
      test_choices - dictionary, defined as global at top of library.
      reps - int, number of reps or permutations to do for the bootstrapped
       tests.
+     block_size - int, number of rows that are tested together (by a single
+      worker process if jobs_to_start > 1).
+     jobs_to_start - int, number of worker processes to split the blocks of
+      rows across.
+     seed - int or None, see below.
     Ouputs are lists of test statistics, p values, and means of each group.
+    The nonparametric t-test is run on blocks of rows at once, with every row
+    tested against the same permutations (see
+    qiime.stats.mc_t_two_sample_rows). For the bootstrapped test, if seed is
+    not None the prng is seeded with seed + i before testing row i, so the
+    results do not depend on jobs_to_start or block_size. If jobs_to_start > 1
+    and seed is None, seed is drawn from the prng.
     """
+    if seed is None and jobs_to_start > 1:
+        seed = randint(0, 2 ** 31 - 1)
+    prng_state = _get_prng_state(seed)
+    blocks = ((rows, start, test, test_choices, reps, seed, prng_state)
+              for start, rows in _row_blocks(data_generator, block_size))
     pvals, test_stats, means = [], [], []
-    for row in data_generator:
-        if test == 'nonparametric_t_test':
-            test_stat, _, _, pval = test_choices[test](row[0], row[1],
-                                                       permutations=reps)
-        elif test == 'bootstrap_mann_whitney_u':
+    for block_stats, block_pvals, block_means in \
+            _map_blocks(_group_significance_block, blocks, jobs_to_start):
+        test_stats.extend(block_stats)
+        pvals.extend(block_pvals)
+        means.extend(block_means)
+    return test_stats, pvals, means
+
+
+def _group_significance_block(args):
+    """Run a group significance test on a block of rows.
+
+    args is a tuple of the block of rows, the index of its first row, and the
+    test, test_choices, reps, seed and prng state passed to
+    run_group_significance_test. Returns the test statistics, p values and
+    means for the block.
+    """
+    rows, start, test, test_choices, reps, seed, prng_state = args
+    means = [[i.mean() for i in row] for row in rows]
+    if test == 'nonparametric_t_test':
+        # every block starts from the same prng state so that all rows are
+        # tested against the same permutations.
+        set_state(prng_state)
+        test_stats, _, pvals = mc_t_two_sample_rows(
+            array([row[0] for row in rows]), array([row[1] for row in rows]),
+            permutations=reps)
+        return list(test_stats), list(pvals), means
+
+    pvals, test_stats = [], []
+    for i, row in enumerate(rows):
+        if seed is not None:
+            set_seed((seed + start + i) % 2 ** 32)
+        if test == 'bootstrap_mann_whitney_u':
             test_stat, pval = test_choices[test](row[0], row[1], num_reps=reps)
         elif test in ['parametric_t_test', 'mann_whitney_u']:
             test_stat, pval = test_choices[test](row[0], row[1])
@@ -154,10 +224,56 @@ def run_group_significance_test(data_generator, test, test_choices, reps=1000):
                 pval = nan
         test_stats.append(test_stat)
         pvals.append(pval)
-        means.append([i.mean() for i in row])
     return test_stats, pvals, means
 
 
+def _get_prng_state(seed=None):
+    """Return the state of the prng after seeding it with seed.
+
+    If seed is None the current state of the prng is returned.
+    """
+    if seed is None:
+        return get_state()
+    return RandomState(seed).get_state()
+
+
+def _row_blocks(data_generator, block_size):
+    """Yield (index of first row, list of rows) for blocks of data_generator."""
+    data_generator = iter(data_generator)
+    start = 0
+    while True:
+        rows = list(islice(data_generator, block_size))
+        if not rows:
+            break
+        yield start, rows
+        start += len(rows)
+
+
+def _map_blocks(f, blocks, jobs_to_start=1):
+    """Yield f(block) for each of blocks, in order.
+
+    If jobs_to_start > 1, f is applied in a pool of jobs_to_start worker
+    processes. Only a few blocks per worker are read ahead of the results
+    being consumed, so memory use follows the block size.
+    """
+    if jobs_to_start <= 1:
+        for block in blocks:
+            yield f(block)
+        return
+
+    pool = Pool(jobs_to_start)
+    try:
+        pending = deque()
+        for block in blocks:
+            pending.append(pool.apply_async(f, (block,)))
+            if len(pending) >= 2 * jobs_to_start:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
 def group_significance_output_formatter(bt, test_stats, pvals, fdr_pvals,
                                         bon_pvals, means, cat_sample_indices, md_key):
     """Format the output for gradient tests so it can be easily written.
@@ -182,7 +298,8 @@ def group_significance_output_formatter(bt, test_stats, pvals, fdr_pvals,
 
 # Functions for gradient correlation testing
 
-def grouped_correlation_row_generator(bt, pmf, category, gc_to_samples):
+def grouped_correlation_row_generator(bt, pmf, category, gc_to_samples,
+                                      block_size=OBSERVATION_BLOCK_SIZE):
     """Create generator for grouped correlation tests.
 
     Inputs:
@@ -192,21 +309,30 @@ def grouped_correlation_row_generator(bt, pmf, category, gc_to_samples):
       metadata for gradient correlations.
      gc_to_samples - dict, output of get_cat_sample_groups. Keys are grouping
       categories for a sample group, values are those samples.
+     block_size - int, number of rows of bt to densify at a time.
     Output:
      tuple of category values (in order of computation), the metadata values,
       and the otu values.
     """
-    data = array([i for i in bt.iter_data(axis='observation')])
     category_values = gc_to_samples.keys()
     samples = gc_to_samples.values()
-    sample_inds = [[bt.index(i, axis='sample') for i in group] for group in samples]
+    sample_inds = [array([bt.index(i, axis='sample') for i in group], dtype=int)
+                   for group in samples]
     try:
         md_vals = []
         for grp in samples:
             md_vals.append(array([pmf[s][category] for s in grp], dtype=float))
     except ValueError:
         raise ValueError("Couldn't convert sample metadata to float.")
-    otu_vals = [data.take(inds, 1) for inds in sample_inds]
+    # fill the otu values for each group a block of rows at a time rather
+    # than densifying the whole table first.
+    num_obs = len(bt.ids(axis='observation'))
+    otu_vals = [empty((num_obs, len(inds))) for inds in sample_inds]
+    start = 0
+    for block in observation_blocks(bt, block_size):
+        for vals, inds in izip(otu_vals, sample_inds):
+            vals[start:start + len(block)] = block.take(inds, axis=1)
+        start += len(block)
     return category_values, md_vals, otu_vals
 
 
@@ -279,7 +405,8 @@ def grouped_correlation_formatter(bt, rhos, pvals, f_rhos, f_pvals, f_hs,
     return nls
 
 
-def correlation_row_generator(bt, pmf, category):
+def correlation_row_generator(bt, pmf, category,
+                              block_size=OBSERVATION_BLOCK_SIZE):
     """Produce a generator that feeds lists of arrays to any gradient test.
 
     In this function, a row is a full row of the OTU table, a single 1D array.
@@ -287,21 +414,24 @@ def correlation_row_generator(bt, pmf, category):
      bt - biom table object. Described at top of library.
      cat_sam_indices - dict, output of get_sample_indices.
      category - str, category to pull continuous sample metadata from.
+     block_size - int, number of rows of bt to densify at a time.
     """
-    data = array([i for i in bt.iter_data(axis='observation')])
     # ensure that the order of the category vector sample values is the same
     # as the order of the samples in data. otherwise will have hard to
     # diagnose correspondence issues
     try:
         cat_vect = array([pmf[s][category] for s in bt.ids()], dtype=float)
-        return ((row, cat_vect) for row in data)
+        return ((row, cat_vect) for block in observation_blocks(bt, block_size)
+                for row in block)
     except ValueError:
         raise ValueError("Mapping file category contained data that couldn't " +
                          "be converted to float. Can't continue.")
 
 
 def run_correlation_test(data_generator, test, test_choices,
-                         pval_assignment_method, permutations=None):
+                         pval_assignment_method, permutations=None,
+                         block_size=OBSERVATION_BLOCK_SIZE, jobs_to_start=1,
+                         seed=None):
     """Run correlation tests.
 
     Inputs:
@@ -312,10 +442,38 @@ def run_correlation_test(data_generator, test, test_choices,
      pval_assignment_method - str, one of CORRELATION_PVALUE_CHOICES.
      permutations - int or None, number of permutations to use for bootstrapped
       methods.
+     block_size, jobs_to_start, seed - as for run_group_significance_test.
+      If seed is not None the prng is seeded with seed + i before the
+      bootstrapped p-value of row i is calculated.
+    """
+    if seed is None and jobs_to_start > 1:
+        seed = randint(0, 2 ** 31 - 1)
+    blocks = ((rows, start, test, test_choices, pval_assignment_method,
+               permutations, seed)
+              for start, rows in _row_blocks(data_generator, block_size))
+    corr_coefs, pvals = [], []
+    for block_corr_coefs, block_pvals in \
+            _map_blocks(_correlation_block, blocks, jobs_to_start):
+        corr_coefs.extend(block_corr_coefs)
+        pvals.extend(block_pvals)
+    return corr_coefs, pvals
+
+
+def _correlation_block(args):
+    """Run a correlation test on a block of rows.
+
+    args is a tuple of the block of rows, the index of its first row, and the
+    test, test_choices, pval_assignment_method, permutations and seed passed
+    to run_correlation_test. Returns the correlation coefficients and p values
+    for the block.
     """
+    (rows, start, test, test_choices, pval_assignment_method, permutations,
+     seed) = args
     corr_coefs, pvals = [], []
     test_fn = test_choices[test]
-    for otu_vals, md_vals in data_generator:
+    for i, (otu_vals, md_vals) in enumerate(rows):
+        if seed is not None:
+            set_seed((seed + start + i) % 2 ** 32)
         r = test_fn(otu_vals, md_vals)
         if pval_assignment_method == 'bootstrapped':
             pval = assign_correlation_pval(r, len(otu_vals),
@@ -11,11 +11,15 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 from os.path import join, split, splitext
+from tempfile import NamedTemporaryFile
+from numpy import empty, memmap, zeros
 from skbio.util import create_dir
 from biom import load_table
 
 from qiime.parallel.util import ParallelWrapper
-from qiime.format import format_distance_matrix
+from qiime.parse import (BINARY_DISTROWS_MAGIC, parse_binary_distance_rows,
+                         parse_matrix)
+from qiime.util import get_qiime_temp_dir
 
 
 class ParallelBetaDiversity(ParallelWrapper):
@@ -38,6 +42,8 @@ class ParallelBetaDiversity(ParallelWrapper):
 
 
 class ParallelBetaDiversitySingle(ParallelBetaDiversity):
+    _process_run_results_f = \
+        'qiime.parallel.beta_diversity.parallel_beta_diversity_process_run_results_f'
 
     def _identify_files_to_remove(self, job_result_filepaths, params):
         """ The output of the individual jobs are the files we want to keep
@@ -121,7 +127,7 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
 
             result_filepaths += current_result_filepaths
 
-            bdiv_command = '%s -i %s -o %s %s -m %s %s -r %s' %\
+            bdiv_command = '%s -i %s -o %s %s -m %s %s -r %s -b' %\
                 (self._script_name,
                  input_fp,
                  working_dir_i,
@@ -157,13 +163,17 @@ class ParallelBetaDiversitySingle(ParallelBetaDiversity):
              merge_map_filepath,
              deletion_list_filepath,
              self._seconds_to_sleep,
-             'qiime.parallel.beta_diversity.parallel_beta_diversity_process_run_results_f',
+             self._process_run_results_f,
              command_suffix)
 
         return result, []
 
 
 class ParallelBetaDiversityMultiple(ParallelBetaDiversity):
+    # each job writes its own final distance matrices, so there is nothing
+    # to assemble
+    _process_run_results_f = \
+        'qiime.parallel.poller.basic_process_run_results_f'
 
     def _get_job_commands(self,
                           input_fps,
@@ -230,46 +240,82 @@ def parallel_beta_diversity_process_run_results_f(f):
         fields = line.strip().split('\t')
         dm_components = fields[:-1]
         output_fp = fields[-1]
-        # assemble the current dm
-        dm = assemble_distance_matrix(map(open, dm_components))
-        # and write it to file
+        # assemble the current dm and write it to file
         output_f = open(output_fp, 'w')
-        output_f.write(dm)
+        assemble_distance_matrix(dm_components, output_f)
         output_f.close()
 
     return True
 
 
-def assemble_distance_matrix(dm_components):
-    """ assemble distance matrix components into a complete dm string
+def _parse_distance_rows(fp):
+    """ return row ids, column ids and rows from a --rows output file
 
+        Binary row blocks (beta_diversity.py -b) are memory-mapped, text
+        row blocks are parsed.
     """
-    print "I get called."
-    data = {}
-    # iterate over compenents
-    for c in dm_components:
-        # create a blank list to store the column ids
-        col_ids = []
-        # iterate over lines
-        for line in c:
-            # split on tabs remove leading and trailing whitespace
-            fields = line.strip().split()
-            if fields:
-                # if no column ids seen yet, these are them
-                if not col_ids:
-                    col_ids = fields
-                # otherwise this is a data row so add it to data
-                else:
-                    sid = fields[0]
-                    data[sid] = dict(zip(col_ids, fields[1:]))
-
-    # grab the col/row ids as a list so it's ordered
-    labels = data.keys()
-    # create an empty list to build the dm
-    dm = []
-    # construct the dm one row at a time
-    for l1 in labels:
-        dm.append([data[l1][l2] for l2 in labels])
-    # create the dm string and return it
-    dm = format_distance_matrix(labels, dm)
-    return dm
+    with open(fp, 'rb') as f:
+        is_binary = \
+            f.read(len(BINARY_DISTROWS_MAGIC)) == BINARY_DISTROWS_MAGIC
+    if is_binary:
+        return parse_binary_distance_rows(fp)
+    col_ids, row_ids, rows = parse_matrix(open(fp, 'U'))
+    return row_ids, col_ids, rows
+
+
+def assemble_distance_matrix(dm_component_fps, output_f,
+                             max_in_memory_bytes=2 ** 28):
+    """ assemble distance matrix components into a complete dm
+
+        dm_component_fps: filepaths of the rows of the distance matrix, as
+         written by beta_diversity.py --rows (binary or text)
+        output_f: open file the distance matrix is written to, in the
+         format of qiime.format.format_distance_matrix
+        max_in_memory_bytes: larger distance matrices are assembled in a
+         memory-mapped file in the QIIME temp dir
+
+        Each component is placed directly into a preallocated N x N array,
+        with samples ordered as in the columns of the first component.
+    """
+    components = [_parse_distance_rows(fp) for fp in dm_component_fps]
+    labels = components[0][1] if components else []
+    n = len(labels)
+    label_indices = dict([(label, i) for i, label in enumerate(labels)])
+
+    temp_f = None
+    if n * n * 8 > max_in_memory_bytes:
+        temp_f = NamedTemporaryFile(dir=get_qiime_temp_dir(),
+                                    prefix='qiime_parallel_dm_',
+                                    suffix='.bin')
+        dm = memmap(temp_f, dtype='<f8', mode='w+', shape=(n, n))
+    else:
+        dm = empty((n, n))
+    assembled = zeros(n, dtype=bool)
+
+    for row_ids, col_ids, rows in components:
+        if col_ids != labels:
+            raise ValueError("Distance matrix components have different "
+                             "columns.")
+        try:
+            row_indices = [label_indices[row_id] for row_id in row_ids]
+        except KeyError as e:
+            raise ValueError("Row %s is not a column of the distance "
+                             "matrix." % e)
+        dm[row_indices] = rows
+        assembled[row_indices] = True
+
+    if not assembled.all():
+        missing = [labels[i] for i in (~assembled).nonzero()[0]]
+        raise ValueError("Distance matrix components are missing rows: %s" %
+                         ', '.join(missing))
+
+    # stream the matrix out a row at a time, as format_distance_matrix would
+    # write it
+    output_f.write('\t'.join([''] + labels))
+    for label, row in zip(labels, dm):
+        output_f.write('\n')
+        output_f.write('\t'.join([label] + map(str, row)))
+
+    del dm
+    if temp_f is not None:
+        temp_f.close()
@@ -57,6 +57,9 @@ class ParallelMultipleRarefactions(ParallelWrapper):
         else:
             subsample_multinomial_str = ''
 
+        if params['batch_subsampling']:
+            subsample_multinomial_str += ' --batch_subsampling'
+
         for depth, output_fn in run_parameters:
             # Each run ends with moving the output file from the tmp dir to
             # the output_dir. Build the command to perform the move here.
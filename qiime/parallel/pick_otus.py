@@ -10,10 +10,13 @@ __version__ = "1.9.0-dev"
 __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
+from array import array
+from collections import OrderedDict
 from math import ceil
 from os.path import basename, join
 from os import mkdir
 from re import compile
+from numpy import argsort, asarray, bincount, concatenate, cumsum
 
 from bfillings.formatdb import build_blast_db_from_fasta_path
 from bfillings.sortmerna_v2 import build_database_sortmerna
@@ -419,22 +422,7 @@ def parallel_pick_otus_process_run_results_f(f):
         raise IOError("Poller can't open final output file: %s" % out_filepath +
                       "\nLeaving individual jobs output.\n Do you have write access?")
 
-    unique_otu_map = {}
-    for fp in infiles_list:
-        for line in open(fp):
-            fields = line.strip().split()
-            try:
-                # current otu_id already exists, so append this
-                # set of seq_ids
-                unique_otu_map[fields[0]] += fields[1:]
-            except KeyError:
-                # current otu_id has not been seen yet, so
-                # create it with the current set of otus
-                unique_otu_map[fields[0]] = fields[1:]
-
-    for otu_id, seq_ids in unique_otu_map.items():
-        of.write('\t'.join([otu_id] + seq_ids))
-        of.write('\n')
+    merge_otu_map_files(infiles_list, of)
     of.close()
 
     # It is a good idea to have your clean_up_callback return True.
@@ -443,6 +431,75 @@ def parallel_pick_otus_process_run_results_f(f):
     return True
 
 
+def merge_otu_map_files(otu_map_fps, output_f, max_open_files=64):
+    """ Write the combined OTU map from several OTU map files to output_f
+
+        otu_map_fps: list of OTU map filepaths (e.g., one per parallel job)
+        output_f: file-like object to write the combined OTU map to
+        max_open_files: the maximum number of OTU map files to keep open
+         at once while writing the combined map (the least recently read
+         are closed first)
+
+        Sequence identifiers assigned to the same OTU in different maps are
+         written on one line, in the order of otu_map_fps. Rather than holding
+         all of the sequence identifiers in memory, only the location of each
+         OTU's line in each map is stored, and the lines are read back from
+         the maps as the combined map is written. OTUs are written in the
+         order in which they are first observed.
+    """
+    otu_indices = {}
+    otu_ids = []
+    # one entry per line of the input OTU maps
+    line_otus = array('l')
+    line_files = array('l')
+    line_offsets = array('l')
+    for file_index, fp in enumerate(otu_map_fps):
+        offset = 0
+        for line in open(fp, 'rb'):
+            fields = line.split(None, 1)
+            if fields:
+                try:
+                    otu_index = otu_indices[fields[0]]
+                except KeyError:
+                    otu_index = otu_indices[fields[0]] = len(otu_ids)
+                    otu_ids.append(fields[0])
+                line_otus.append(otu_index)
+                line_files.append(file_index)
+                line_offsets.append(offset)
+            offset += len(line)
+    del otu_indices
+    if not otu_ids:
+        return
+
+    # group lines by OTU, keeping them in file order within each OTU
+    line_otus = asarray(line_otus)
+    order = argsort(line_otus, kind='mergesort')
+    bounds = concatenate(([0], cumsum(bincount(line_otus))))
+    del line_otus
+
+    otu_map_fs = OrderedDict()
+    try:
+        for otu_index, otu_id in enumerate(otu_ids):
+            output_f.write(otu_id)
+            for i in order[bounds[otu_index]:bounds[otu_index + 1]]:
+                file_index = line_files[i]
+                try:
+                    otu_map_f = otu_map_fs.pop(file_index)
+                except KeyError:
+                    if len(otu_map_fs) >= max_open_files:
+                        otu_map_fs.popitem(last=False)[1].close()
+                    otu_map_f = open(otu_map_fps[file_index], 'rb')
+                otu_map_fs[file_index] = otu_map_f
+                otu_map_f.seek(line_offsets[i])
+                seq_ids = otu_map_f.readline().split()[1:]
+                if seq_ids:
+                    output_f.write('\t' + '\t'.join(seq_ids))
+            output_f.write('\n')
+    finally:
+        for otu_map_f in otu_map_fs.values():
+            otu_map_f.close()
+
+
 class ParallelPickOtusTrie(ParallelPickOtus):
 
     """Picking Otus using a trie the parallel way
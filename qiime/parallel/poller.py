@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
 from __future__ import division
-from time import sleep
+import ctypes
+import ctypes.util
+from select import select
+from time import sleep, time
 from optparse import OptionParser
-from os import getenv, remove
-from os.path import exists, isdir
+from os import getenv, remove, read, close
+from os.path import exists, isdir, dirname
 from shutil import rmtree
 from skbio.util import remove_files
 from qiime.parse import parse_tmp_to_final_filepath_map_file
@@ -18,6 +21,60 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 
+# inotify event masks (from sys/inotify.h) for files which are complete
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+
+
+class DirectoryWatcher(object):
+
+    """ Waits for files to be written to, or moved into, a set of directories
+
+        Parallel jobs write their results to a temporary directory and then
+         move them into the output directory, so waiting on these events lets
+         a poller check for completion as soon as a job finishes. Linux's
+         inotify is used if it's available; otherwise (or for jobs on other
+         hosts writing to network filesystems, where no events are delivered)
+         wait just times out, giving the same behavior as sleeping.
+    """
+
+    def __init__(self, dirs):
+        self._fd = None
+        dirs = set([d for d in dirs if isdir(d)])
+        if not dirs:
+            return
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        for d in dirs:
+            if libc.inotify_add_watch(fd, d, IN_CLOSE_WRITE | IN_MOVED_TO |
+                                      IN_CREATE) < 0:
+                close(fd)
+                return
+        self._fd = fd
+
+    def wait(self, timeout):
+        """ Return after a file event, or after timeout seconds
+        """
+        if self._fd is None:
+            sleep(timeout)
+            return
+        if select([self._fd], [], [], timeout)[0]:
+            # the events themselves aren't needed, as the caller rechecks
+            # the files
+            read(self._fd, 65536)
+
+    def close(self):
+        if self._fd is not None:
+            close(self._fd)
+            self._fd = None
+
+
 def get_function_handle(s):
     last_dot = s.rindex('.')
     module_name = s[:last_dot]
@@ -53,10 +110,15 @@ def basic_check_run_complete_f(f):
         If f contains the three lines above, this function would return
          False if any of these three files did not exist, and True otherwise.
 
+        If f is a list, the filepaths found to exist are removed from it, so
+         repeated calls (e.g., by poller) don't check them again.
+
     """
     filepaths = [l.strip() for l in f]
-    for fp in filepaths:
+    for i, fp in enumerate(filepaths):
         if not exists(fp):
+            if isinstance(f, list):
+                del f[:i]
             return False
     return True
 
@@ -127,9 +189,11 @@ def verbose_check_run_complete_f(f):
 
     """
     filepaths = [l.strip() for l in f]
-    for fp in filepaths:
+    for i, fp in enumerate(filepaths):
         if not exists(fp):
             print "At least one fp doesn't exist: %s" % fp
+            if isinstance(f, list):
+                del f[:i]
             return False
     print "All filepaths exist."
     return True
@@ -206,15 +270,24 @@ def poller(check_run_complete_f,
          on each call
         process_run_results_file: file passed to process_run_results_f
         clean_up_file: file passed to clean_up_f
-        seconds_to_sleep: number of seconds to sleep between calls
-         to check_run_complete_f
+        seconds_to_sleep: maximum number of seconds to wait between calls
+         to check_run_complete_f. If check_run_complete_file lists
+         filepaths, check_run_complete_f is also called whenever a file is
+         written to or moved into their directories (see DirectoryWatcher).
 
     """
-    number_of_loops = 0
-    while(not check_run_complete_f(check_run_complete_file)):
-        sleep(seconds_to_sleep)
-        number_of_loops += 1
+    start_time = time()
+    if isinstance(check_run_complete_file, list):
+        watcher = DirectoryWatcher(
+            [dirname(l.strip()) for l in check_run_complete_file])
+    else:
+        watcher = DirectoryWatcher([])
+    try:
+        while(not check_run_complete_f(check_run_complete_file)):
+            watcher.wait(seconds_to_sleep)
+    finally:
+        watcher.close()
     process_run_results_f(process_run_results_file)
     clean_up_f(clean_up_file)
-    est_per_proc_run_time = number_of_loops * seconds_to_sleep
+    est_per_proc_run_time = time() - start_time
     return est_per_proc_run_time
@@ -15,9 +15,11 @@ from math import ceil
 from os.path import split, splitext, join
 from os import makedirs, mkdir
 from random import choice
+from multiprocessing.pool import ThreadPool
 from skbio.parse.sequences import parse_fasta
-from qiime.split import split_fasta
+from qiime.split import split_fasta_into_chunks
 from qiime.util import load_qiime_config, qiime_system_call, count_seqs
+from qiime.parallel.poller import get_function_handle, basic_clean_up_f
 
 qiime_config = load_qiime_config()
 
@@ -25,11 +27,20 @@ RANDOM_JOB_PREFIX_CHARS = "abcdefghigklmnopqrstuvwxyz"
 RANDOM_JOB_PREFIX_CHARS += RANDOM_JOB_PREFIX_CHARS.upper()
 RANDOM_JOB_PREFIX_CHARS += "0123456790"
 
+# passing this as cluster_jobs_fp runs the jobs in a pool of local
+# processes rather than submitting them with a cluster_jobs script
+LOCAL_CLUSTER_JOBS = 'local'
+
 
 class ParallelWrapper(object):
 
     """
     """
+    _process_run_results_f = \
+        'qiime.parallel.poller.basic_process_run_results_f'
+    # input fasta files are split into this many chunks per job, which the
+    # jobs work through as they finish their previous chunks
+    _chunks_per_job = 4
 
     def __init__(self,
                  cluster_jobs_fp=qiime_config['cluster_jobs_fp'],
@@ -142,6 +153,17 @@ class ParallelWrapper(object):
         self.files_to_remove += \
             self._identify_files_to_remove(job_result_filepaths, params)
 
+        # If there are more commands than jobs (e.g., when the input file
+        # was split into chunks), each job takes the next command which
+        # hasn't been started when it finishes one, so a few slow commands
+        # don't hold up the run. Local jobs are run from a pool which does
+        # this already.
+        if (self._cluster_jobs_fp != LOCAL_CLUSTER_JOBS and
+                len(commands) > self._jobs_to_start):
+            commands = self._get_worker_commands(commands,
+                                                 job_prefix,
+                                                 working_dir)
+
         # Generate the output clean-up files
         merge_map_filepath, deletion_list_filepath, expected_files_filepath =\
             self._initialize_output_cleanup_files(job_result_filepaths,
@@ -150,6 +172,22 @@ class ParallelWrapper(object):
                                                   input_file_basename,
                                                   params)
 
+        if self._cluster_jobs_fp == LOCAL_CLUSTER_JOBS:
+            self._run_jobs_locally(commands,
+                                   job_prefix,
+                                   working_dir,
+                                   merge_map_filepath,
+                                   deletion_list_filepath,
+                                   suppress_submit_jobs)
+            self.files_to_remove = []
+            self._call_cleanup(input_fp,
+                               output_dir,
+                               params,
+                               job_prefix,
+                               poll_directly,
+                               suppress_submit_jobs)
+            return
+
         # Set up poller apparatus if the user does not suppress polling
         if not self._suppress_polling:
             poller_command = self._initiate_polling(job_result_filepaths,
@@ -257,6 +295,112 @@ class ParallelWrapper(object):
 
         return stdout, stderr, return_value
 
+    def _run_jobs_locally(self,
+                          commands,
+                          job_prefix,
+                          working_dir,
+                          merge_map_filepath,
+                          deletion_list_filepath,
+                          suppress_submit_jobs):
+        """ Run the jobs in a pool of local processes and process their results
+
+            Up to jobs_to_start commands are run at a time, and the results
+             are processed and cleaned up in this process as soon as the last
+             job completes, rather than by a poller which checks for the
+             output files every seconds_to_sleep seconds.
+        """
+        jobs_fp = join(working_dir, job_prefix + 'jobs.txt')
+        self._write_jobs_file(commands, jobs_fp)
+        self.files_to_remove.append(jobs_fp)
+        if suppress_submit_jobs:
+            return
+
+        if not self._suppress_polling:
+            if not self._retain_temp_files:
+                self._write_filepaths_to_file(self.files_to_remove,
+                                              deletion_list_filepath)
+            else:
+                self._write_filepaths_to_file([], deletion_list_filepath)
+
+        # each job is a child process, so threads are enough to keep
+        # jobs_to_start of them running
+        pool = ThreadPool(max(1, min(self._jobs_to_start, len(commands))))
+        try:
+            for cmd, stdout, stderr, return_value in \
+                    pool.imap_unordered(self._run_local_job, commands):
+                if return_value != 0:
+                    msg = "\n\n*** Parallel job failed. \n" +\
+                        "Command run was:\n %s\n" % cmd +\
+                        "Command returned exit status: %d\n" % return_value +\
+                        "Stdout:\n%s\nStderr\n%s\n" % (stdout, stderr)
+                    raise RuntimeError(msg)
+        finally:
+            pool.close()
+            pool.join()
+
+        if not self._suppress_polling:
+            process_run_results_f = \
+                get_function_handle(self._process_run_results_f)
+            process_run_results_f(open(merge_map_filepath, 'U'))
+            basic_clean_up_f(open(deletion_list_filepath, 'U'))
+
+    def _run_local_job(self, command):
+        """ Run one job command, returning it with its stdout, stderr and status
+        """
+        stdout, stderr, return_value = \
+            qiime_system_call(self._strip_shell_wrapping(command))
+        return command, stdout, stderr, return_value
+
+    def _strip_shell_wrapping(self, command):
+        """ Remove the shell start and exit from command
+
+            Commands are run as '/bin/bash; ...; exit' by
+             start_parallel_jobs.py, which only makes sense for a command
+             which is a job of its own. The remaining subcommands are
+             joined with '&&', so the command stops at, and exits with the
+             status of, the first subcommand which fails.
+        """
+        subcommands = [c.strip() for c in command.split(';')]
+        subcommands = [c for c in subcommands
+                       if c and c not in ('/bin/bash', 'exit')]
+        return ' && '.join(subcommands)
+
+    def _get_worker_commands(self,
+                             commands,
+                             job_prefix,
+                             working_dir,
+                             command_prefix='/bin/bash; ',
+                             command_suffix='; exit'):
+        """ Return jobs_to_start commands which run commands as a work queue
+
+            Each command is written to a script, and each of the returned
+             commands runs a worker script which tries to claim each of the
+             commands in turn, running those it claims. A command is
+             claimed by creating a directory for it, which only one worker
+             can do.
+        """
+        claims_dir = join(working_dir, '%sclaims' % job_prefix)
+        makedirs(claims_dir)
+        self.files_to_remove.append(claims_dir)
+
+        worker_lines = []
+        for i, command in enumerate(commands):
+            command_fp = join(working_dir, '%s%d.sh' % (job_prefix, i))
+            open(command_fp, 'w').write(
+                self._strip_shell_wrapping(command) + '\n')
+            self.files_to_remove.append(command_fp)
+            worker_lines.append('if mkdir %s 2> /dev/null; then bash %s; fi' %
+                                (join(claims_dir, str(i)), command_fp))
+
+        worker_fp = join(working_dir, '%sworker.sh' % job_prefix)
+        open(worker_fp, 'w').write('\n'.join(worker_lines) + '\n')
+        self.files_to_remove.append(worker_fp)
+
+        worker_command = '%sbash %s%s' % (command_prefix,
+                                          worker_fp,
+                                          command_suffix)
+        return [worker_command] * min(self._jobs_to_start, len(commands))
+
     def _identify_files_to_remove(self, job_result_filepaths, params):
         """ Select the files to remove: by default remove all files
         """
@@ -473,16 +617,12 @@ class ParallelWrapper(object):
                      jobs_to_start,
                      job_prefix,
                      output_dir):
-        # compute the number of sequences that should be included in
-        # each file after splitting the input fasta file
-        num_seqs_per_file = self._compute_seqs_per_file(
-            input_fp,
-            jobs_to_start)
-
-        # split the fasta files and get the list of resulting files
+        # split the fasta file on byte offsets into chunks of about equal
+        # size, several per job, and get the list of resulting files
         tmp_fasta_fps =\
-            split_fasta(open(input_fp), num_seqs_per_file,
-                        job_prefix, working_dir=output_dir)
+            split_fasta_into_chunks(input_fp,
+                                    jobs_to_start * self._chunks_per_job,
+                                    job_prefix, working_dir=output_dir)
 
         return tmp_fasta_fps, True
 
@@ -19,17 +19,16 @@ from os.path import expandvars
 import re
 from types import GeneratorType
 
-from numpy import concatenate, repeat, zeros, nan, asarray
+from numpy import concatenate, repeat, zeros, nan, asarray, memmap
 from numpy.random import permutation
+from scipy.spatial.distance import squareform
 
-from skbio.stats.ordination import OrdinationResults
-from skbio.parse.record_finder import LabeledRecordFinder
 from cogent.parse.tree import DndParser
-from skbio.parse.sequences import parse_fastq
-from skbio.parse.sequences.fasta import FastaFinder
-from skbio.sequence import DNA
 from cogent.core.tree import PhyloNode
 
+# scikit-bio is imported inside the functions that use it, as importing it
+# dominates the startup time of scripts that only need light parsers.
+
 
 def is_casava_v180_or_later(header_line):
     """ True if this file is generated by Illumina software post-casava 1.8 """
@@ -214,16 +213,98 @@ def group_by_fields(table, names):
     return result
 
 
+# first line of a binary distance matrix (see
+# qiime.format.write_binary_distance_matrix)
+BINARY_DISTMAT_MAGIC = 'QIIME binary distance matrix\t1\n'
+
+
+def is_binary_distmat(fp):
+    """Returns True if fp is a binary distance matrix"""
+    with open(fp, 'rb') as f:
+        return f.read(len(BINARY_DISTMAT_MAGIC)) == BINARY_DISTMAT_MAGIC
+
+
+def parse_binary_distmat(fp):
+    """Opens a binary distance matrix, as written by
+    qiime.format.write_binary_distance_matrix
+
+    Returns the sample ids and the condensed upper triangle of the distance
+    matrix (as returned by scipy.spatial.distance.squareform), which is a
+    read-only numpy.memmap of the file, so is not read into memory.
+    """
+    with open(fp, 'rb') as f:
+        if f.readline() != BINARY_DISTMAT_MAGIC:
+            raise ValueError("%s is not a binary distance matrix." % fp)
+        header = f.readline().rstrip('\n').split('\t')[1:]
+        # the distances start at the next multiple of 8 bytes
+        offset = (f.tell() + 7) // 8 * 8
+    num_distances = len(header) * (len(header) - 1) // 2
+    if num_distances == 0:
+        return header, zeros(0)
+    return header, memmap(fp, dtype='<f8', mode='r', offset=offset,
+                          shape=(num_distances,))
+
+
+BINARY_DISTROWS_MAGIC = 'QIIME binary distance rows\t1\n'
+
+
+def parse_binary_distance_rows(fp):
+    """Opens rows of a distance matrix, as written by
+    qiime.format.write_binary_distance_rows
+
+    Returns the row ids, the column ids and the rows (rows by columns) as a
+    read-only numpy.memmap of the file, so is not read into memory.
+    """
+    with open(fp, 'rb') as f:
+        if f.readline() != BINARY_DISTROWS_MAGIC:
+            raise ValueError("%s is not a binary distance rows file." % fp)
+        col_ids = f.readline().rstrip('\n').split('\t')[1:]
+        row_ids = f.readline().rstrip('\n')
+        row_ids = row_ids.split('\t') if row_ids else []
+        # the distances start at the next multiple of 8 bytes
+        offset = (f.tell() + 7) // 8 * 8
+    shape = (len(row_ids), len(col_ids))
+    if 0 in shape:
+        return row_ids, col_ids, zeros(shape)
+    return row_ids, col_ids, memmap(fp, dtype='<f8', mode='r', offset=offset,
+                                    shape=shape)
+
+
+def _get_binary_distmat_fp(lines):
+    """Returns the filepath of lines if it is a binary distance matrix
+
+    lines can be a filepath or an open file. Returns None otherwise.
+    """
+    if isinstance(lines, str):
+        fp = lines
+    else:
+        fp = getattr(lines, 'name', None)
+    if isinstance(fp, str) and os.path.isfile(fp) and is_binary_distmat(fp):
+        return fp
+    return None
+
+
 def parse_distmat(lines):
     """Parser for distance matrix file (e.g. UniFrac dist matrix).
 
     The examples I have of this file are just sample x sample tab-delimited
     text, so easiest way to handle is just to convert into a numpy array
     plus a list of field names.
+
+    If lines is an open binary distance matrix file (see
+    parse_binary_distmat), it is read directly from the file.
     """
+    binary_fp = _get_binary_distmat_fp(lines)
+    if binary_fp is not None:
+        header, condensed = parse_binary_distmat(binary_fp)
+        return header, squareform(condensed, force='tomatrix', checks=False)
+
     header = None
     result = []
     for line in lines:
+        if line == BINARY_DISTMAT_MAGIC:
+            raise ValueError("Binary distance matrices must be passed as "
+                             "open files or filepaths.")
         if line[0] == '\t':  # is header
             header = map(strip, line.split('\t')[1:])
         else:
@@ -253,10 +334,13 @@ def parse_matrix(lines):
 def parse_distmat_to_dict(table):
     """Parse a dist matrix into an 2d dict indexed by sample ids.
 
-    table: table as lines
+    table: table as lines, or an open binary distance matrix file
     """
-
-    col_headers, row_headers, data = parse_matrix(table)
+    if _get_binary_distmat_fp(table) is not None:
+        col_headers, data = parse_distmat(table)
+        row_headers = col_headers
+    else:
+        col_headers, row_headers, data = parse_matrix(table)
     assert(col_headers == row_headers)
 
     result = defaultdict(dict)
@@ -266,6 +350,20 @@ def parse_distmat_to_dict(table):
     return result
 
 
+def parse_distmat_to_skbio(dm_f):
+    """Parse a text or binary distance matrix into an skbio DistanceMatrix
+
+    dm_f: filepath or open file
+    """
+    from skbio.stats.distance import DistanceMatrix
+    binary_fp = _get_binary_distmat_fp(dm_f)
+    if binary_fp is not None:
+        header, condensed = parse_binary_distmat(binary_fp)
+        return DistanceMatrix(squareform(condensed, force='tomatrix',
+                                         checks=False), header)
+    return DistanceMatrix.read(dm_f)
+
+
 def parse_bootstrap_support(lines):
     """Parser for a bootstrap/jackknife support in tab delimited text
     """
@@ -364,6 +462,7 @@ def parse_coords(lines):
     Strategy: read the file using skbio's parser and return the objects
               we want
     """
+    from skbio.stats.ordination import OrdinationResults
     pcoa_results = OrdinationResults.read(lines)
     return (pcoa_results.site_ids, pcoa_results.site, pcoa_results.eigvals,
             pcoa_results.proportion_explained)
@@ -724,6 +823,7 @@ def parse_illumina_line(l, barcode_length, rev_comp_barcode,
         barcode = y_position_subfields[1][:barcode_length]
 
     if rev_comp_barcode:
+        from skbio.sequence import DNA
         barcode = str(DNA(barcode).rc())
 
     result = {
@@ -749,6 +849,7 @@ def parse_qual_score(infile, value_cast_f=int):
 
 def MinimalQualParser(infile, value_cast_f=int, full_header=False):
     """Yield quality scores"""
+    from skbio.parse.sequences.fasta import FastaFinder
     for rec in FastaFinder(infile):
         curr_id = rec[0][1:]
         curr_qual = ' '.join(rec[1:])
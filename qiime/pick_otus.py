@@ -17,11 +17,15 @@ grouping those sequences by similarity.
 
 from copy import copy
 from itertools import ifilter
-from os.path import splitext, split, abspath, join, dirname
-from os import makedirs, close, rename
+from os.path import splitext, split, abspath, join, dirname, getsize
+from os import makedirs, close, rename, remove
 from itertools import imap
+from heapq import merge
+from math import ceil
 from tempfile import mkstemp
 
+from numpy import array, arange, concatenate, cumsum, repeat, int32, int64
+
 from bfillings.mothur import parse_otu_list as mothur_parse
 
 from skbio.util import remove_files, flatten
@@ -328,11 +332,6 @@ class SortmernaV2OtuPicker(OtuPicker):
                     unique_seqs_fp, filepath to FASTA file
                     holding only de-replicated sequences
         """
-        # Creating mapping for de-replicated reads
-        with open(seq_path, 'U') as s_path:
-            seqs_to_cluster, exact_match_id_map =\
-                self._prefilter_exact_matches(parse_fasta(s_path))
-
         # Create temporary file for storing the de-replicated reads
         fd, unique_seqs_fp = mkstemp(
             prefix='SortMeRNAExactMatchFilter', suffix='.fasta')
@@ -340,18 +339,10 @@ class SortmernaV2OtuPicker(OtuPicker):
 
         self.files_to_remove.append(unique_seqs_fp)
 
-        # Write de-replicated reads to file
-        unique_seqs_f = open(unique_seqs_fp, 'w')
-        for seq_id, seq in seqs_to_cluster:
-            unique_seqs_f.write('>%s count=%d;\n%s\n' %
-                                (seq_id,
-                                 len(exact_match_id_map[seq_id]),
-                                 seq))
-        unique_seqs_f.close()
-
-        # Clean up the seqs_to_cluster as we don't need
-        # it again
-        del(seqs_to_cluster)
+        # Create mapping for de-replicated reads, and write de-replicated
+        # reads to file
+        exact_match_id_map = dereplicate_fasta(seq_path, unique_seqs_fp,
+                                               write_counts=True)
 
         return exact_match_id_map, unique_seqs_fp
 
@@ -645,10 +636,6 @@ class SumaClustOtuPicker(OtuPicker):
                     unique_seqs_fp, filepath to FASTA file
                     holding only de-replicated sequences
         """
-        # creating mapping for de-replicated reads
-        seqs_to_cluster, exact_match_id_map =\
-            self._prefilter_exact_matches(parse_fasta(open(seq_path, 'U')))
-
         # create temporary file for storing the de-replicated reads
         fd, unique_seqs_fp = mkstemp(
             prefix='SumaClustExactMatchFilter', suffix='.fasta')
@@ -656,17 +643,10 @@ class SumaClustOtuPicker(OtuPicker):
 
         self.files_to_remove.append(unique_seqs_fp)
 
-        # write de-replicated reads to file
-        unique_seqs_f = open(unique_seqs_fp, 'w')
-        for seq_id, seq in seqs_to_cluster:
-            unique_seqs_f.write('>%s count=%d;\n%s\n'
-                                % (seq_id,
-                                   len(exact_match_id_map[seq_id]),
-                                   seq))
-        unique_seqs_f.close()
-        # clean up the seqs_to_cluster list as it can be big and we
-        # don't need it again
-        del(seqs_to_cluster)
+        # create mapping for de-replicated reads, and write de-replicated
+        # reads to file
+        exact_match_id_map = dereplicate_fasta(seq_path, unique_seqs_fp,
+                                               write_counts=True)
 
         return exact_match_id_map, unique_seqs_fp
 
@@ -1181,16 +1161,8 @@ class UclustOtuPickerBase(OtuPicker):
         fd, unique_seqs_fp = mkstemp(
             prefix='UclustExactMatchFilter', suffix='.fasta')
         close(fd)
-        seqs_to_cluster, exact_match_id_map =\
-            self._prefilter_exact_matches(parse_fasta(open(seq_path, 'U')))
         self.files_to_remove.append(unique_seqs_fp)
-        unique_seqs_f = open(unique_seqs_fp, 'w')
-        for seq_id, seq in seqs_to_cluster:
-            unique_seqs_f.write('>%s\n%s\n' % (seq_id, seq))
-        unique_seqs_f.close()
-        # clean up the seqs_to_cluster list as it can be big and we
-        # don't need it again
-        # del(seqs_to_cluster)
+        exact_match_id_map = dereplicate_fasta(seq_path, unique_seqs_fp)
         return exact_match_id_map, unique_seqs_fp
 
 
@@ -2084,13 +2056,305 @@ class MothurOtuPicker(OtuPicker):
                 break
         return my_otus
 
+
+class ExactMatchIdMap(object):
+
+    """Maps dereplicated sequence ids to the ids of identical sequences
+
+    This behaves like the dict of {dereplicated seq id: [seq ids]} returned
+    by OtuPicker._prefilter_exact_matches, but stores each list of seq ids
+    as a single tab-separated string to reduce memory use. Lists are
+    created when a value is looked up.
+    """
+
+    def __init__(self):
+        self._seq_ids = {}
+
+    def __setitem__(self, key, seq_ids):
+        self._seq_ids[key] = '\t'.join(seq_ids)
+
+    def __getitem__(self, key):
+        return self._seq_ids[key].split('\t')
+
+    def __contains__(self, key):
+        return key in self._seq_ids
+
+    def __len__(self):
+        return len(self._seq_ids)
+
+    def __iter__(self):
+        return iter(self._seq_ids)
+
+    def keys(self):
+        return self._seq_ids.keys()
+
+    def items(self):
+        return [(k, v.split('\t')) for k, v in self._seq_ids.iteritems()]
+
+    def count(self, key):
+        """Return the number of seq ids mapped to key"""
+        return self._seq_ids[key].count('\t') + 1
+
+
+def dereplicate_fasta(seq_path, unique_seqs_fp, write_counts=False,
+                      max_partition_size=1e9, temp_dir=None):
+    """Write the unique sequences in seq_path to unique_seqs_fp
+
+    This performs the same dereplication as
+    OtuPicker._prefilter_exact_matches (the unique sequences are written in
+    order of first occurrence, and are named QiimeExactMatch.<seq id of first
+    occurrence>), but with bounded memory use. If seq_path is larger than
+    max_partition_size bytes, the sequences are first hash-partitioned into
+    temporary files so that identical sequences end up in the same file.
+    Each partition is dereplicated separately, and the unique sequences from
+    all partitions are merged back into their original order.
+
+    seq_path: path to the input fasta file
+    unique_seqs_fp: path where the unique sequences will be written
+    write_counts: if True, the number of identical sequences is appended to
+     each fasta label (e.g., >QiimeExactMatch.s1 count=3;), as expected by
+     SumaClust and SortMeRNA
+    max_partition_size: maximum size of the input (in bytes) which will be
+     dereplicated without partitioning, and the approximate size of each
+     partition
+    temp_dir: directory where partition files will be written (defaults to
+     the QIIME temp dir)
+
+    Returns an ExactMatchIdMap of {dereplicated seq id: [seq ids]}.
+    """
+    if temp_dir is None:
+        temp_dir = get_qiime_temp_dir()
+    num_partitions = int(ceil(getsize(seq_path) / float(max_partition_size)))
+
+    exact_match_id_map = ExactMatchIdMap()
+    seqs_f = open(seq_path, 'U')
+    indexed_seqs = ((i, seq_id.split()[0], seq)
+                    for i, (seq_id, seq) in enumerate(parse_fasta(seqs_f)))
+
+    if num_partitions <= 1:
+        unique_seqs = _dereplicate_indexed_seqs(indexed_seqs,
+                                                exact_match_id_map)
+        partition_fps = []
+        merge_fs = []
+    else:
+        # hash-partition the sequences
+        partition_fps = []
+        partition_fs = []
+        for i in range(num_partitions):
+            fd, partition_fp = mkstemp(dir=temp_dir,
+                                       prefix='QiimeExactMatchPartition',
+                                       suffix='.txt')
+            close(fd)
+            partition_fps.append(partition_fp)
+            partition_fs.append(open(partition_fp, 'w'))
+        for i, seq_id, seq in indexed_seqs:
+            partition_fs[hash(seq) % num_partitions].write(
+                '%d\t%s\t%s\n' % (i, seq_id, seq))
+        for partition_f in partition_fs:
+            partition_f.close()
+
+        # dereplicate each partition, writing the unique sequences from
+        # each to a file
+        unique_fps = []
+        for partition_fp in partition_fps:
+            partition_f = open(partition_fp, 'U')
+            partition_seqs = (_parse_partition_line(line)
+                              for line in partition_f)
+            fd, unique_fp = mkstemp(dir=temp_dir,
+                                    prefix='QiimeExactMatchUnique',
+                                    suffix='.txt')
+            close(fd)
+            unique_fps.append(unique_fp)
+            unique_f = open(unique_fp, 'w')
+            for i, seq_id, count, seq in _dereplicate_indexed_seqs(
+                    partition_seqs, exact_match_id_map):
+                unique_f.write('%d\t%s\t%s\n' % (i, seq_id, seq))
+            unique_f.close()
+            partition_f.close()
+            remove(partition_fp)
+        partition_fps = unique_fps
+
+        # merge the unique sequences from all partitions, restoring
+        # the order of first occurrence
+        merge_fs = [open(fp, 'U') for fp in partition_fps]
+        unique_seqs = merge(*[imap(_parse_partition_line, f)
+                              for f in merge_fs])
+        unique_seqs = ((i, seq_id, exact_match_id_map.count(seq_id), seq)
+                       for i, seq_id, seq in unique_seqs)
+
+    try:
+        unique_seqs_f = open(unique_seqs_fp, 'w')
+        for i, seq_id, count, seq in unique_seqs:
+            if write_counts:
+                unique_seqs_f.write('>%s count=%d;\n%s\n' %
+                                    (seq_id, count, seq))
+            else:
+                unique_seqs_f.write('>%s\n%s\n' % (seq_id, seq))
+        unique_seqs_f.close()
+    finally:
+        seqs_f.close()
+        for f in merge_fs:
+            f.close()
+        remove_files(partition_fps, error_on_missing=False)
+
+    return exact_match_id_map
+
+
+def _parse_partition_line(line):
+    """Parse an (index, seq id, seq) line written by dereplicate_fasta"""
+    i, seq_id, seq = line.rstrip('\n').split('\t')
+    return int(i), seq_id, seq
+
+
+def _dereplicate_indexed_seqs(indexed_seqs, exact_match_id_map):
+    """Dereplicate (index, seq id, seq) tuples
+
+    Returns a list of (index, dereplicated seq id, count, seq) for the first
+    occurrence of each unique sequence, in input order, and adds the seq ids
+    for each unique sequence to exact_match_id_map.
+    """
+    seq_ids_by_seq = {}
+    result = []
+    for i, seq_id, seq in indexed_seqs:
+        try:
+            seq_ids_by_seq[seq].append(seq_id)
+        except KeyError:
+            seq_ids = [seq_id]
+            seq_ids_by_seq[seq] = seq_ids
+            result.append((i, 'QiimeExactMatch.%s' % seq_id, seq_ids, seq))
+
+    unique_seqs = []
+    for i, unique_seq_id, seq_ids, seq in result:
+        exact_match_id_map[unique_seq_id] = seq_ids
+        unique_seqs.append((i, unique_seq_id, len(seq_ids), seq))
+    return unique_seqs
+
+
 # Some functions to support merging OTU tables
 # generated one after another. This functionality is currently available
 # via Qiime/scripts/merge_otu_maps.py and will be incorporated into the
 # MetaPickOtus or ChainedPickOtus class when that comes into existence.
 
 
+class CompactOtuMap(object):
+
+    """An OTU map which stores its seq ids in integer arrays
+
+    Each seq id is stored once, in seq_ids, and OTU membership is stored in
+    compressed sparse row form: the seq ids in the i-th OTU (otu_ids[i]) are
+    seq_ids[j] for j in members[offsets[i]:offsets[i + 1]]. Expanding one
+    OTU map by another only combines integer arrays, so lists of seq id
+    strings are only created when OTUs are looked up or iterated over (e.g.,
+    when the final OTU map is written).
+    """
+
+    def __init__(self, otu_ids, offsets, members, seq_ids):
+        self.otu_ids = otu_ids
+        self.offsets = offsets
+        self.members = members
+        self.seq_ids = seq_ids
+        self._otu_index = None
+
+    @classmethod
+    def from_lines(cls, lines):
+        """Parse an OTU map, splitting fields on any whitespace"""
+        otu_ids = []
+        seq_ids = []
+        offsets = [0]
+        for line in lines:
+            fields = line.split()
+            if not fields:
+                continue
+            otu_ids.append(fields[0])
+            seq_ids.extend(fields[1:])
+            offsets.append(len(seq_ids))
+        dtype = _index_dtype(len(seq_ids))
+        return cls(otu_ids, array(offsets, dtype=dtype),
+                   arange(len(seq_ids), dtype=dtype), seq_ids)
+
+    def otu_index(self):
+        """Return a dict mapping each OTU id to its row"""
+        if self._otu_index is None:
+            self._otu_index = dict((otu_id, i)
+                                   for i, otu_id in enumerate(self.otu_ids))
+        return self._otu_index
+
+    def expand_seq_ids(self, seq_id_map):
+        """Replace each seq id with the seq ids of that OTU in seq_id_map
+
+        seq_id_map must be a CompactOtuMap. A KeyError is raised if a seq id
+        is not an OTU id in seq_id_map.
+        """
+        otu_index = seq_id_map.otu_index()
+        rows = array([otu_index[seq_id] for seq_id in self.seq_ids],
+                     dtype=int64)[self.members]
+        lengths, members = seq_id_map._gather(rows)
+        offsets = concatenate(([0], cumsum(lengths)))[self.offsets]
+        return CompactOtuMap(self.otu_ids,
+                             offsets.astype(_index_dtype(len(members))),
+                             members, seq_id_map.seq_ids)
+
+    def expand_failures(self, failures):
+        """Return the list of seq ids in the OTUs listed in failures"""
+        otu_index = self.otu_index()
+        rows = array([otu_index[failure.strip()] for failure in failures],
+                     dtype=int64)
+        lengths, members = self._gather(rows)
+        return [self.seq_ids[j] for j in members]
+
+    def _gather(self, rows):
+        """Return the OTU sizes and concatenated members of rows"""
+        starts = self.offsets[rows].astype(int64)
+        lengths = self.offsets[rows + 1] - starts
+        ends = cumsum(lengths)
+        # position k of the output comes from members[starts[r] + k -
+        # (ends[r] - lengths[r])], where r is the row that k falls into
+        positions = arange(ends[-1] if len(ends) else 0, dtype=int64)
+        positions += repeat(starts - (ends - lengths), lengths)
+        return lengths, self.members[positions]
+
+    def __len__(self):
+        return len(self.otu_ids)
+
+    def __iter__(self):
+        return iter(self.otu_ids)
+
+    def __contains__(self, otu_id):
+        return otu_id in self.otu_index()
+
+    def __getitem__(self, otu_id):
+        i = self.otu_index()[otu_id]
+        return [self.seq_ids[j]
+                for j in self.members[self.offsets[i]:self.offsets[i + 1]]]
+
+    def keys(self):
+        return list(self.otu_ids)
+
+    def iteritems(self):
+        seq_ids = self.seq_ids
+        members = self.members
+        offsets = self.offsets
+        for i, otu_id in enumerate(self.otu_ids):
+            yield otu_id, [seq_ids[j]
+                           for j in members[offsets[i]:offsets[i + 1]]]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+
+def _index_dtype(n):
+    """Return the smallest integer dtype used to index n items"""
+    if n < 2 ** 31:
+        return int32
+    return int64
+
+
 def expand_otu_map_seq_ids(otu_map, seq_id_map):
+    if isinstance(otu_map, CompactOtuMap):
+        return otu_map.expand_seq_ids(seq_id_map)
     for otu_id, seq_ids in otu_map.items():
         mapped_seq_ids = flatten(
             [seq_id_map[seq_id] for seq_id in seq_ids])
@@ -2099,6 +2363,8 @@ def expand_otu_map_seq_ids(otu_map, seq_id_map):
 
 
 def expand_failures(failures, seq_id_map):
+    if isinstance(seq_id_map, CompactOtuMap):
+        return seq_id_map.expand_failures(failures)
     result = []
     for failure in failures:
         failure = failure.strip()
@@ -2106,16 +2372,28 @@ def expand_failures(failures, seq_id_map):
     return result
 
 
-def map_otu_map_files(otu_files, failures_file=None):
-    # passing delim=None splits on any whitespace, so can handle mixed tabs
-    # and spaces
-    result = fields_to_dict(otu_files[0], delim=None)
+def map_otu_map_files(otu_files, failures_file=None, compact=False):
+    """Expand the seq ids in the last of otu_files through the earlier ones
+
+    otu_files: OTU maps (as lists of lines or open files) in the order in
+     which the OTU pickers were run
+    failures_file: if provided, the seq ids in the failures file are
+     expanded instead, and a list of seq ids is returned
+    compact: if True, return a CompactOtuMap rather than a dict, so that
+     seq id lists are only created as the OTU map is written
+
+    Fields are split on any whitespace, so mixed tabs and spaces are
+    handled. A KeyError is raised if an id does not map.
+    """
+    result = CompactOtuMap.from_lines(otu_files[0])
     for otu_file in otu_files[1:]:
-        current_otu_map = fields_to_dict(otu_file, delim=None)
+        current_otu_map = CompactOtuMap.from_lines(otu_file)
         result = expand_otu_map_seq_ids(current_otu_map, result)
     if failures_file:
-        result = expand_failures(failures_file, result)
-    return result
+        return expand_failures(failures_file, result)
+    if compact:
+        return result
+    return result.to_dict()
 
 # End functions to support merging OTU tables
 
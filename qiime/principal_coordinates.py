@@ -1,7 +1,8 @@
 #!/usr/bin/env python
-from skbio.stats.distance import DistanceMatrix
 from skbio.stats.ordination import PCoA
 
+from qiime.parse import parse_distmat_to_skbio
+
 __author__ = "Justin Kuzynski"
 __copyright__ = "Copyright 2011, The QIIME Project"
 __credits__ = ["Justin Kuczynski", "Rob Knight", "Antonio Gonzalez Pena",
@@ -16,7 +17,7 @@ __email__ = "justinak@gmail.com"
 def pcoa(lines):
     """Run PCoA on the distance matrix present on lines"""
     # Parse the distance matrix
-    dist_mtx = DistanceMatrix.read(lines)
+    dist_mtx = parse_distmat_to_skbio(lines)
     # Create the PCoA object
     pcoa_obj = PCoA(dist_mtx)
     # Get the PCoA results and return them
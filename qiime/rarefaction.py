@@ -19,10 +19,11 @@ import os.path
 
 import numpy
 from numpy import inf
+from scipy.special import gammaln
 from skbio.stats import subsample
 from biom.err import errstate
 
-from qiime.util import FunctionWithParams, write_biom_table
+from qiime.util import FunctionWithParams, write_biom_table, create_dir
 from qiime.filter import (filter_samples_from_otu_table,
                           filter_otus_from_otu_table)
 
@@ -124,6 +125,69 @@ class RarefactionMaker(FunctionWithParams):
         if include_full:
             self._write_rarefaction('full', 0, self.otu_table)
 
+    def rarefy_to_collated_alpha(self, output_dir, metrics, tree_path=None,
+                                 small_included=False,
+                                 empty_otus_removed=False,
+                                 subsample_f=subsample, beta_metrics=None,
+                                 beta_output_dir=None):
+        """ computes alpha diversity on each rarefied otu table in memory
+
+        each rarefied table is passed straight to the alpha (and optionally
+        beta) diversity calculations and then discarded, so no rarefied
+        tables are written or parsed. alpha diversity is written to
+        output_dir as one file per metric, in the format of collate_alpha.py.
+        if beta_metrics is given, one distance matrix per metric and
+        rarefied table is written to beta_output_dir, named as
+        beta_diversity.py would name them.
+        """
+        from qiime.alpha_diversity import get_alpha_calcs
+        from qiime.beta_diversity import single_object_beta
+        from qiime.collate_alpha import collate_alpha_results
+
+        all_calcs = get_alpha_calcs(metrics)
+        create_dir(output_dir, fail_on_exist=False)
+        if tree_path:
+            tree = self.getTree(tree_path)
+        else:
+            tree = None
+
+        if beta_metrics:
+            try:
+                beta_metrics = beta_metrics.split(',')
+            except AttributeError:
+                pass
+            create_dir(beta_output_dir, fail_on_exist=False)
+
+        alpha_results = []
+        for depth in self.rare_depths:
+            for rep in range(self.num_reps):
+                sub_otu_table = get_rare_data(self.otu_table,
+                                              depth,
+                                              small_included,
+                                              subsample_f=subsample_f)
+                if empty_otus_removed:
+                    sub_otu_table = filter_otus_from_otu_table(
+                        sub_otu_table, sub_otu_table.ids(axis='observation'),
+                        1, inf, 0, inf)
+
+                if sub_otu_table.is_empty():
+                    continue
+
+                basename = 'rarefaction_%s_%d' % (depth, rep)
+                data, sample_names, calc_names = all_calcs.getResult(
+                    sub_otu_table, tree)
+                alpha_results.append(('alpha_' + basename + '.txt',
+                                      calc_names, sample_names, data))
+
+                for metric in beta_metrics or []:
+                    dm_lines = single_object_beta(sub_otu_table, metric, tree)
+                    f = open(os.path.join(beta_output_dir, '%s_%s.txt' %
+                                          (metric, basename)), 'w')
+                    f.write('\n'.join(dm_lines))
+                    f.close()
+
+        collate_alpha_results(alpha_results, output_dir)
+
     def rarefy_to_list(self, small_included=False, include_full=False,
                        include_lineages=False):
         """ computes rarefied otu tables and returns a list
@@ -158,6 +222,210 @@ class RarefactionMaker(FunctionWithParams):
         write_biom_table(sub_otu_table, fname)
 
 
+class BatchSubsampler(object):
+
+    """Subsamples all samples of an OTU table with vectorized draws
+
+    An instance can be passed as subsample_f to get_rare_data,
+    SingleRarefactionMaker and RarefactionMaker in place of
+    skbio.stats.subsample. Instead of subsampling each sample from Python,
+    the counts of every sample are split in halves, and the number of
+    sequences drawn from each half is drawn from the hypergeometric (or,
+    with replace=True, binomial) distribution for all samples at once.
+    This is repeated until each half is a single OTU, so the rarefied
+    counts have the same distribution as with subsample.
+
+    Each draw is made by inverting the distribution's CDF at a uniform
+    variate. If seed is None the uniforms come from numpy's global random
+    state, so numpy.random.seed makes results reproducible as it does for
+    subsample. Otherwise the uniforms for the sample at index i of an OTU
+    table come from a random state seeded with seed, i and the number of
+    earlier calls, so a sample's rarefied counts do not depend on the
+    other samples in the table, and repeated calls give new rarefactions.
+    """
+
+    def __init__(self, replace=False, seed=None):
+        self.replace = replace
+        self.seed = seed
+        self._calls = 0
+
+    def __call__(self, counts, n):
+        """Subsamples a single vector of counts to n, as subsample does"""
+        counts = numpy.asarray(counts).astype(int)
+        if counts.ndim != 1:
+            raise ValueError("Only 1-D vectors are supported.")
+        if not self.replace and n > counts.sum():
+            raise ValueError("Cannot subsample more items than exist in "
+                             "input counts vector.")
+
+        result = numpy.zeros_like(counts)
+        uniforms = self._uniforms(numpy.array([0, len(counts)]), [0])
+        self._draw(counts, numpy.array([0]), numpy.array([len(counts)]),
+                   numpy.array([n]), uniforms, result)
+        return result
+
+    def subsample_table(self, otu_table, n):
+        """Subsamples samples with at least n sequences to n sequences
+
+        samples with fewer than n sequences are left unchanged. otu_table
+        is modified in place and returned, as Table.transform does.
+        """
+        # the CSC buffers have the same layout that transform iterates over
+        matrix = otu_table.matrix_data.tocsc()
+        indptr = matrix.indptr
+        counts = matrix.data.astype(int)
+        cumulative = numpy.concatenate(([0], numpy.cumsum(counts)))
+        rarefied = cumulative[indptr[1:]] - cumulative[indptr[:-1]] >= n
+
+        result = counts.copy()
+        result[numpy.repeat(rarefied, numpy.diff(indptr))] = 0
+        uniforms = self._uniforms(indptr, numpy.flatnonzero(rarefied))
+        self._draw(counts, indptr[:-1][rarefied], indptr[1:][rarefied],
+                   numpy.repeat(n, rarefied.sum()), uniforms, result)
+
+        sample_indices = dict((s_id, i) for i, s_id in
+                              enumerate(otu_table.ids()))
+
+        def func(x, s_id, s_md):
+            i = sample_indices[s_id]
+            return result[indptr[i]:indptr[i + 1]]
+
+        return otu_table.transform(func, axis='sample')
+
+    def _uniforms(self, indptr, samples):
+        """Returns a uniform variate for each count of the given samples
+
+        sample i has the counts indptr[i] to indptr[i + 1]. Each split of a
+        sample's counts uses the uniform at the position of its midpoint,
+        which no other split of that sample shares.
+        """
+        if self.seed is None:
+            return numpy.random.random_sample(indptr[-1])
+
+        uniforms = numpy.zeros(indptr[-1])
+        for i in samples:
+            random = numpy.random.RandomState([self.seed, self._calls, i])
+            uniforms[indptr[i]:indptr[i + 1]] = \
+                random.random_sample(indptr[i + 1] - indptr[i])
+        self._calls += 1
+        return uniforms
+
+    def _draw(self, counts, starts, stops, draws, uniforms, result):
+        """Writes draws[i] sequences from counts[starts[i]:stops[i]] to result
+
+        result must be zero within the segments, and is not modified
+        outside of them
+        """
+        cumulative = numpy.concatenate(([0], numpy.cumsum(counts)))
+        while len(starts):
+            # single OTUs get all of the draws for their segment, and
+            # segments with no draws are left at zero
+            single = stops - starts == 1
+            result[starts[single]] = draws[single]
+            keep = numpy.flatnonzero((draws > 0) & ~single)
+            if not len(keep):
+                break
+            starts, stops, draws = starts[keep], stops[keep], draws[keep]
+
+            mids = (starts + stops) // 2
+            left = cumulative[mids] - cumulative[starts]
+            right = cumulative[stops] - cumulative[mids]
+            left_draws = self._left_draws(left, right, draws,
+                                          uniforms[mids])
+
+            starts = numpy.concatenate((starts, mids))
+            stops = numpy.concatenate((mids, stops))
+            draws = numpy.concatenate((left_draws, draws - left_draws))
+
+    def _left_draws(self, left, right, draws, uniforms):
+        """Returns the number of draws from the left half of each segment
+
+        left and right are the counts in each half. The inverse CDF is
+        searched outwards from the distribution's mode, alternately
+        stepping up and down, so each segment takes a few standard
+        deviations of steps rather than one step per possible draw.
+        """
+        left = left.astype(float)
+        right = right.astype(float)
+        draws = draws.astype(float)
+        if self.replace:
+            lowest = numpy.where(right > 0, 0, draws)
+            highest = numpy.where(left > 0, draws, 0)
+            mode = numpy.floor((draws + 1) * left / (left + right))
+        else:
+            lowest = numpy.maximum(0, draws - right)
+            highest = numpy.minimum(draws, left)
+            mode = numpy.floor((draws + 1) * (left + 1) /
+                               (left + right + 2))
+        mode = numpy.minimum(numpy.maximum(mode, lowest), highest)
+        result = mode.astype(int)
+
+        todo = numpy.flatnonzero(lowest < highest)
+        left, right, draws, uniforms, lowest, highest, mode = \
+            [x[todo] for x in (left, right, draws, uniforms, lowest, highest,
+                               mode)]
+        # the draws from lo to hi have been searched, and have a total
+        # probability of cdf. k is the last draw searched
+        low_pmf = numpy.exp(self._log_pmf(mode, left, right, draws))
+        high_pmf = low_pmf.copy()
+        cdf = low_pmf.copy()
+        lo, hi, k = mode, mode.copy(), mode.copy()
+        step_up = True
+        while len(todo):
+            done = (uniforms < cdf) | ((lo == lowest) & (hi == highest))
+            result[todo[done]] = k[done]
+            keep = ~done
+            (todo, left, right, draws, uniforms, lowest, highest, lo, hi, k,
+             low_pmf, high_pmf, cdf) = \
+                [x[keep] for x in (todo, left, right, draws, uniforms, lowest,
+                                   highest, lo, hi, k, low_pmf, high_pmf,
+                                   cdf)]
+
+            if step_up:
+                up = hi < highest
+            else:
+                up = lo == lowest
+            step_up = not step_up
+
+            high_pmf[up] *= self._pmf_ratio(hi[up], left[up], right[up],
+                                            draws[up])
+            hi[up] += 1
+            k[up] = hi[up]
+            cdf[up] += high_pmf[up]
+
+            down = ~up
+            low_pmf[down] /= self._pmf_ratio(lo[down] - 1, left[down],
+                                             right[down], draws[down])
+            lo[down] -= 1
+            k[down] = lo[down]
+            cdf[down] += low_pmf[down]
+
+        return result
+
+    def _log_pmf(self, k, left, right, draws):
+        """Returns the log probability of k of draws coming from left"""
+        if self.replace:
+            total = left + right
+            return (_log_choose(draws, k) + k * numpy.log(left / total) +
+                    (draws - k) * numpy.log(right / total))
+        else:
+            return (_log_choose(left, k) + _log_choose(right, draws - k) -
+                    _log_choose(left + right, draws))
+
+    def _pmf_ratio(self, k, left, right, draws):
+        """Returns the probability of k + 1 draws from left over that of k"""
+        if self.replace:
+            return (draws - k) * left / ((k + 1) * right)
+        else:
+            return ((left - k) * (draws - k) /
+                    ((k + 1) * (right - draws + k + 1)))
+
+
+def _log_choose(n, k):
+    """Returns the log of the binomial coefficient n choose k"""
+    return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+
 def get_rare_data(otu_table,
                   seqs_per_sample,
                   include_small_samples=False,
@@ -178,6 +446,9 @@ def get_rare_data(otu_table,
                 inf)
 
         # subsample samples that have too many sequences
+        if hasattr(subsample_f, 'subsample_table'):
+            return subsample_f.subsample_table(otu_table, seqs_per_sample)
+
         def func(x, s_id, s_md):
             if x.sum() < seqs_per_sample:
                 return x
@@ -5,7 +5,6 @@ from __future__ import division
 import re
 from operator import itemgetter
 from numpy import array
-from skbio.parse.sequences import parse_fasta
 from qiime.parse import parse_mapping_file
 
 __author__ = "Greg Caporaso"
@@ -129,6 +128,7 @@ def sort_fasta_by_abundance(fasta_lines, fasta_out_f):
        chokes on very large (e.g., Illumina) files. --Greg **
 
     """
+    from skbio.parse.sequences import parse_fasta
     seq_index = {}
     count = 0
     for seq_id, seq in parse_fasta(fasta_lines):
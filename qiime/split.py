@@ -12,6 +12,7 @@ __email__ = "gregcaporaso@gmail.com"
 
 from numpy import array, in1d
 from itertools import product
+from os.path import getsize
 
 from skbio.parse.sequences import parse_fasta
 from skbio.util import create_dir
@@ -250,3 +251,87 @@ def split_fasta(infile, seqs_per_file, outfile_prefix, working_dir=''):
         current_out_file.close()
 
     return out_files
+
+
+def get_fasta_chunk_offsets(input_fp, num_chunks):
+    """ Return byte offsets splitting input_fp into about num_chunks chunks
+
+        input_fp: path to a fasta file
+        num_chunks: the number of chunks of about equal size (in bytes) to
+         split the file into
+
+        The offsets start at 0, end at the size of the file, and other than
+         these fall at the start of a fasta record, so fewer than num_chunks
+         chunks are defined if some would be empty. The file is not parsed,
+         only the lines around each offset are read.
+    """
+    if num_chunks <= 0:
+        raise ValueError("num_chunks must be > 0!")
+
+    size = getsize(input_fp)
+    offsets = [0]
+    f = open(input_fp, 'rb')
+    for i in range(1, num_chunks):
+        # find the first record starting at or after the i-th split point
+        f.seek(max(size * i // num_chunks, offsets[-1] + 1) - 1)
+        f.readline()
+        offset = f.tell()
+        for line in iter(f.readline, ''):
+            if line.startswith('>'):
+                break
+            offset += len(line)
+        if offset >= size:
+            break
+        offsets.append(offset)
+    f.close()
+    if size > 0:
+        offsets.append(size)
+    return offsets
+
+
+def split_fasta_into_chunks(input_fp, num_chunks, outfile_prefix,
+                            working_dir='', buffer_size=2 ** 20):
+    """ Split input_fp into about num_chunks files of about equal size
+
+        input_fp: path to a fasta file
+        num_chunks: the number of chunks to split input_fp into (see
+         get_fasta_chunk_offsets)
+        out_fileprefix: string used to create output filepath - output
+         filepaths are <out_prefix>.<i>.fasta where i runs from 0 to number
+         of output files
+        working_dir: directory to prepend to temp filepaths (defaults to
+         empty string -- files written to cwd)
+
+        Unlike split_fasta, the sequences don't need to be counted first,
+        as the file is split on byte offsets and the records are copied
+        to the output files as they are. List of output filepaths is
+        returned.
+    """
+    if working_dir and not working_dir.endswith('/'):
+        working_dir += '/'
+        create_dir(working_dir)
+
+    offsets = get_fasta_chunk_offsets(input_fp, num_chunks)
+    out_files = []
+    infile = open(input_fp, 'rb')
+    for start, stop in zip(offsets[:-1], offsets[1:]):
+        current_out_fp = '%s%s.%d.fasta' \
+            % (working_dir, outfile_prefix, len(out_files))
+        current_out_file = open(current_out_fp, 'wb')
+        infile.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = infile.read(min(buffer_size, remaining))
+            if not data:
+                current_out_file.close()
+                infile.close()
+                raise IOError("%s ended before the expected end of chunk "
+                              "%d. Was it modified while being split?"
+                              % (input_fp, len(out_files)))
+            current_out_file.write(data)
+            remaining -= len(data)
+        current_out_file.close()
+        out_files.append(current_out_fp)
+    infile.close()
+
+    return out_files
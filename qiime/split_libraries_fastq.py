@@ -10,13 +10,16 @@ __version__ = "1.9.0-dev"
 __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
-from itertools import izip, cycle
+from itertools import izip, cycle, islice
 from os.path import split, splitext, join
-from os import makedirs
+from os import makedirs, remove, close
+from multiprocessing import Pool
+from tempfile import mkstemp
 
 import numpy as np
 
 from skbio.parse.sequences import parse_fastq
+from skbio.parse.sequences.fastq import ascii_to_phred33, ascii_to_phred64
 from skbio.sequence import DNA
 from skbio.format.sequences import format_fastq_record
 
@@ -25,7 +28,7 @@ from qiime.format import (format_histogram_one_count,
 from qiime.parse import is_casava_v180_or_later
 from qiime.hamming import decode_hamming_8
 from qiime.golay import decode_golay_12
-from qiime.util import qiime_open
+from qiime.util import qiime_open, get_qiime_temp_dir, remove_files
 
 
 class FastqParseError(Exception):
@@ -97,6 +100,23 @@ def read_qual_score_filter(seq, qual, max_run_length, threshold):
     return seq, qual
 
 
+def _has_bad_illumina_qual_digit(header):
+    """Return True if the Illumina quality digit in header is 0"""
+    h = header.split()[0]
+    try:
+        # this block is a little strange because each of these
+        # can throw a ValueError. The same thing needs to be done
+        # in either case, so it doesn't really make sense to split
+        # into two separate try/excepts, particulary because that would
+        # complicate the logic
+        quality_char = header[h.index('#') + 1]
+        illumina_quality_digit = int(quality_char)
+    except ValueError:
+        return False
+    else:
+        return illumina_quality_digit == 0
+
+
 def quality_filter_sequence(header,
                             sequence,
                             quality,
@@ -105,21 +125,9 @@ def quality_filter_sequence(header,
                             min_per_read_length,
                             seq_max_N,
                             filter_bad_illumina_qual_digit):
-    if filter_bad_illumina_qual_digit:
-        h = header.split()[0]
-        try:
-            # this block is a little strange because each of these
-            # can throw a ValueError. The same thing needs to be done
-            # in either case, so it doesn't really make sense to split
-            # into two separate try/excepts, particulary because that would
-            # complicate the logic
-            quality_char = header[h.index('#') + 1]
-            illumina_quality_digit = int(quality_char)
-        except ValueError:
-            pass
-        else:
-            if illumina_quality_digit == 0:
-                return 3, sequence, quality
+    if filter_bad_illumina_qual_digit and \
+       _has_bad_illumina_qual_digit(header):
+        return 3, sequence, quality
 
     sequence, quality = read_qual_score_filter(sequence,
                                                quality,
@@ -134,6 +142,83 @@ def quality_filter_sequence(header,
         return 0, sequence, quality
 
 
+def quality_filter_sequences(headers,
+                             sequences,
+                             qualities,
+                             max_bad_run_length,
+                             phred_quality_threshold,
+                             min_per_read_length,
+                             seq_max_N,
+                             filter_bad_illumina_qual_digit):
+    """Quality filter a block of reads at once
+
+       This is a vectorized version of quality_filter_sequence: the reads
+       are packed into padded (number of reads x max read length) matrices,
+       and the truncation position, N count and minimum length checks are
+       computed for all reads together.
+
+       return value: (array of quality filter results (as defined by
+                      quality_filter_sequence),
+                      array of truncated read lengths)
+    """
+    num_reads = len(sequences)
+    results = np.zeros(num_reads, dtype=int)
+    if num_reads == 0:
+        return results, np.zeros(0, dtype=int)
+
+    lengths = np.array([len(s) for s in sequences])
+    max_length = lengths.max()
+
+    # row/column indices of every base in the padded matrices
+    row_indices = np.repeat(np.arange(num_reads), lengths)
+    starts = np.cumsum(lengths) - lengths
+    col_indices = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+
+    # mark the bad quality positions (padding is never bad)
+    bad = np.zeros((num_reads, max_length), dtype=bool)
+    bad[row_indices, col_indices] = \
+        np.concatenate(qualities) <= phred_quality_threshold
+
+    # a run of bad positions longer than max_bad_run_length exists at
+    # position i if window_size positions starting at i are all bad. The
+    # read is truncated at the start of the bad run containing the first
+    # such window.
+    window_size = max_bad_run_length + 1
+    cum_bad = np.zeros((num_reads, max_length + 1), dtype=int)
+    np.cumsum(bad, axis=1, out=cum_bad[:, 1:])
+    truncation_lengths = lengths.copy()
+    if window_size <= max_length:
+        window_counts = cum_bad[:, window_size:] - cum_bad[:, :-window_size]
+        full_windows = window_counts == window_size
+        has_bad_run = full_windows.any(axis=1)
+        first_windows = full_windows.argmax(axis=1)
+
+        # the position of the last good base at or before each position
+        # (-1 if there is none)
+        last_good = np.where(bad, -1, np.arange(max_length))
+        np.maximum.accumulate(last_good, axis=1, out=last_good)
+        run_starts = last_good[np.arange(num_reads), first_windows] + 1
+        truncation_lengths[has_bad_run] = run_starts[has_bad_run]
+
+    # count the N characters in the truncated reads
+    is_N = np.zeros((num_reads, max_length), dtype=bool)
+    is_N[row_indices, col_indices] = \
+        np.fromstring(''.join(sequences), dtype=np.uint8) == ord('N')
+    cum_N = np.zeros((num_reads, max_length + 1), dtype=int)
+    np.cumsum(is_N, axis=1, out=cum_N[:, 1:])
+    N_counts = cum_N[np.arange(num_reads), truncation_lengths]
+
+    results[N_counts > seq_max_N] = 2
+    results[truncation_lengths < min_per_read_length] = 1
+
+    if filter_bad_illumina_qual_digit:
+        for i, header in enumerate(headers):
+            if _has_bad_illumina_qual_digit(header):
+                results[i] = 3
+
+    return results, truncation_lengths
+
+
 def check_header_match_pre180(header1, header2):
 
     # split on '#' and '/' to handle cases with and without the
@@ -194,6 +279,48 @@ def correct_barcode(barcode, barcode_to_sample_id, correction_fn):
         return num_errors, corrected_barcode, True, sample_id
 
 
+class BarcodeCorrector(object):
+
+    """Memoizing barcode correction engine for a single mapping file
+
+       Instances are built once per mapping file and called with each raw
+       barcode read. The result of correct_barcode is computed at most once
+       per distinct barcode string: barcodes in the mapping file are loaded
+       into the lookup table up front, and every other barcode that is
+       observed is decoded once (e.g., by decode_golay_12, decode_hamming_8
+       or a wrapper around qiime.barcode.correct_barcode_bitwise) and cached,
+       so subsequent occurrences cost a single dict lookup.
+
+       max_cache_size bounds the number of cached barcodes. Once the table is
+       full, barcodes which have not been seen before are still corrected
+       but are no longer stored.
+    """
+
+    def __init__(self, barcode_to_sample_id, correction_fn=None,
+                 max_cache_size=1000000):
+        self.barcode_to_sample_id = barcode_to_sample_id
+        self.correction_fn = correction_fn
+        self.max_cache_size = max_cache_size
+        self._lookup = {}
+        for barcode, sample_id in barcode_to_sample_id.iteritems():
+            self._lookup[barcode] = (0, barcode, False, sample_id)
+
+    def __len__(self):
+        return len(self._lookup)
+
+    def __call__(self, barcode):
+        """Return the correct_barcode result tuple for barcode"""
+        try:
+            return self._lookup[barcode]
+        except KeyError:
+            result = correct_barcode(barcode,
+                                     self.barcode_to_sample_id,
+                                     self.correction_fn)
+            if len(self._lookup) < self.max_cache_size:
+                self._lookup[barcode] = result
+            return result
+
+
 def process_fastq_single_end_read_file_no_barcode(
         fastq_read_f,
         sample_id,
@@ -260,10 +387,6 @@ def process_fastq_single_end_read_file(fastq_read_f,
                                        phred_offset=None):
     """parses fastq single-end read file
     """
-    header_index = 0
-    sequence_index = 1
-    quality_index = 2
-
     seq_id = start_seq_id
     # grab the first lines and then seek back to the beginning of the file
     try:
@@ -275,11 +398,119 @@ def process_fastq_single_end_read_file(fastq_read_f,
         fastq_read_f_line2 = fastq_read_f[1]
 
     if phred_offset is None:
-        post_casava_v180 = is_casava_v180_or_later(fastq_read_f_line1)
-        if post_casava_v180:
-            phred_offset = 33
-        else:
-            phred_offset = 64
+        phred_offset = _get_phred_offset(fastq_read_f_line1)
+
+    # compute the minimum read length as a fraction of the length of the input
+    # read
+    min_per_read_length = min_per_read_length_fraction * \
+        len(fastq_read_f_line2)
+
+    counts = _init_split_libraries_fastq_counts()
+    for sample_id, header, sequence, quality in _process_fastq_reads(
+            fastq_read_f,
+            fastq_barcode_f,
+            barcode_to_sample_id,
+            counts,
+            store_unassigned=store_unassigned,
+            max_bad_run_length=max_bad_run_length,
+            phred_quality_threshold=phred_quality_threshold,
+            min_per_read_length=min_per_read_length,
+            rev_comp=rev_comp,
+            rev_comp_barcode=rev_comp_barcode,
+            seq_max_N=seq_max_N,
+            filter_bad_illumina_qual_digit=filter_bad_illumina_qual_digit,
+            barcode_correction_fn=barcode_correction_fn,
+            max_barcode_errors=max_barcode_errors,
+            strict_header_match=strict_header_match,
+            phred_offset=phred_offset):
+        fasta_header = '%s_%s %s' % (sample_id, seq_id, header)
+        yield fasta_header, sequence, quality, seq_id
+        seq_id += 1
+
+    _write_split_libraries_fastq_counts(counts, barcode_to_sample_id,
+                                        log_f, histogram_f)
+
+
+def _get_phred_offset(fastq_read_f_line1):
+    """ Determine the phred offset from the first line of a fastq file """
+    if is_casava_v180_or_later(fastq_read_f_line1):
+        return 33
+    else:
+        return 64
+
+
+def _init_split_libraries_fastq_counts():
+    """ Return the counters that are tracked while processing fastq reads """
+    return {'input_sequence_count': 0,
+            'count_barcode_not_in_map': 0,
+            'count_too_short': 0,
+            'count_too_many_N': 0,
+            'count_bad_illumina_qual_digit': 0,
+            'count_barcode_errors_exceed_max': 0,
+            'sequence_lengths': [],
+            'seqs_per_sample_counts': {}}
+
+
+def _write_split_libraries_fastq_counts(counts, barcode_to_sample_id,
+                                        log_f, histogram_f):
+    """ Write the log and histogram resulting from processing fastq reads """
+    sequence_lengths = counts['sequence_lengths']
+    seqs_per_sample_counts = counts['seqs_per_sample_counts']
+
+    # Add sample IDs with zero counts to dictionary for logging
+    for curr_sample_id in barcode_to_sample_id.values():
+        if curr_sample_id not in seqs_per_sample_counts.keys():
+            seqs_per_sample_counts[curr_sample_id] = 0
+
+    if log_f is not None:
+        log_str = format_split_libraries_fastq_log(
+            counts['count_barcode_not_in_map'],
+            counts['count_too_short'],
+            counts['count_too_many_N'],
+            counts['count_bad_illumina_qual_digit'],
+            counts['count_barcode_errors_exceed_max'],
+            counts['input_sequence_count'],
+            sequence_lengths,
+            seqs_per_sample_counts)
+        log_f.write(log_str)
+
+    if len(sequence_lengths) and histogram_f is not None:
+        hist, bin_edges = make_histograms(sequence_lengths)
+        histogram_str = format_histogram_one_count(hist, bin_edges)
+        histogram_f.write(histogram_str)
+        histogram_f.write('\n--\n\n')
+
+
+def _process_fastq_reads(fastq_read_f,
+                         fastq_barcode_f,
+                         barcode_to_sample_id,
+                         counts,
+                         store_unassigned,
+                         max_bad_run_length,
+                         phred_quality_threshold,
+                         min_per_read_length,
+                         rev_comp,
+                         rev_comp_barcode,
+                         seq_max_N,
+                         filter_bad_illumina_qual_digit,
+                         barcode_correction_fn,
+                         max_barcode_errors,
+                         strict_header_match,
+                         phred_offset,
+                         quality_filter_block_size=10000):
+    """ Demultiplex and quality filter paired barcode and read records
+
+        Yields (sample_id, header, sequence, quality) for each read that
+        passes, where header is the fasta header without the leading
+        sequence identifier. The counters in counts (as created by
+        _init_split_libraries_fastq_counts) are updated in place. This is
+        shared by the serial and sharded versions of
+        process_fastq_single_end_read_file. Quality filtering is applied to
+        blocks of quality_filter_block_size reads at a time.
+    """
+    header_index = 0
+    sequence_index = 1
+    quality_index = 2
 
     if phred_offset == 33:
         check_header_match_f = check_header_match_180_or_later
@@ -298,24 +529,21 @@ def process_fastq_single_end_read_file(fastq_read_f,
     else:
         barcode_length = None
 
-    # compute the minimum read length as a fraction of the length of the input
-    # read
-    min_per_read_length = min_per_read_length_fraction * \
-        len(fastq_read_f_line2)
-
-    # prep data for logging
-    input_sequence_count = 0
-    count_barcode_not_in_map = 0
-    count_too_short = 0
-    count_too_many_N = 0
-    count_bad_illumina_qual_digit = 0
-    count_barcode_errors_exceed_max = 0
-    sequence_lengths = []
-    seqs_per_sample_counts = {}
+    barcode_corrector = BarcodeCorrector(barcode_to_sample_id,
+                                         barcode_correction_fn)
+    # reads which pass the barcode checks are quality filtered in blocks
+    filter_params = {
+        'max_bad_run_length': max_bad_run_length,
+        'phred_quality_threshold': phred_quality_threshold,
+        'min_per_read_length': min_per_read_length,
+        'seq_max_N': seq_max_N,
+        'filter_bad_illumina_qual_digit': filter_bad_illumina_qual_digit,
+        'rev_comp': rev_comp}
+    block = []
     for bc_data, read_data in izip(
             parse_fastq(fastq_barcode_f, strict=False, phred_offset=phred_offset),
             parse_fastq(fastq_read_f, strict=False, phred_offset=phred_offset)):
-        input_sequence_count += 1
+        counts['input_sequence_count'] += 1
         # Confirm match between barcode and read headers
         if strict_header_match and \
            (not check_header_match_f(bc_data[header_index], read_data[header_index])):
@@ -345,50 +573,77 @@ def process_fastq_single_end_read_file(fastq_read_f,
 
         # correct the barcode (if applicable) and map to sample id
         num_barcode_errors, corrected_barcode, correction_attempted, sample_id = \
-            correct_barcode(
-                barcode,
-                barcode_to_sample_id,
-                barcode_correction_fn)
+            barcode_corrector(barcode)
         # skip samples with too many errors
         if (num_barcode_errors > max_barcode_errors):
-            count_barcode_errors_exceed_max += 1
+            counts['count_barcode_errors_exceed_max'] += 1
             continue
 
         # skip unassignable samples unless otherwise requested
         if sample_id is None:
             if not store_unassigned:
-                count_barcode_not_in_map += 1
+                counts['count_barcode_not_in_map'] += 1
                 continue
             else:
                 sample_id = 'Unassigned'
 
-        quality_filter_result, sequence, quality =\
-            quality_filter_sequence(header,
-                                    sequence,
-                                    quality,
-                                    max_bad_run_length,
-                                    phred_quality_threshold,
-                                    min_per_read_length,
-                                    seq_max_N,
-                                    filter_bad_illumina_qual_digit)
-
-        # process quality result
-        if quality_filter_result != 0:
-            # if the quality filter didn't pass record why and
-            # move on to the next record
-            if quality_filter_result == 1:
-                count_too_short += 1
-            elif quality_filter_result == 2:
-                count_too_many_N += 1
-            elif quality_filter_result == 3:
-                count_bad_illumina_qual_digit += 1
-            else:
-                raise ValueError(
-                    "Unknown quality filter result: %d" %
-                    quality_filter_result)
-            continue
+        header = '%s orig_bc=%s new_bc=%s bc_diffs=%d' %\
+            (header, barcode, corrected_barcode, num_barcode_errors)
+        block.append((sample_id, header, sequence, quality))
+        if len(block) >= quality_filter_block_size:
+            for e in _quality_filter_block(block, counts, **filter_params):
+                yield e
+            block = []
+
+    for e in _quality_filter_block(block, counts, **filter_params):
+        yield e
+
 
-        sequence_lengths.append(len(sequence))
+def _quality_filter_block(block,
+                          counts,
+                          max_bad_run_length,
+                          phred_quality_threshold,
+                          min_per_read_length,
+                          seq_max_N,
+                          filter_bad_illumina_qual_digit,
+                          rev_comp):
+    """ Quality filter a block of (sample_id, header, sequence, quality)
+
+        Reads are filtered with quality_filter_sequences, the counters in
+        counts are updated, and the passing (and truncated) reads are yielded
+        in their input order.
+    """
+    if not block:
+        return
+    sample_ids, headers, sequences, qualities = zip(*block)
+    quality_filter_results, truncation_lengths = \
+        quality_filter_sequences(headers,
+                                 sequences,
+                                 qualities,
+                                 max_bad_run_length,
+                                 phred_quality_threshold,
+                                 min_per_read_length,
+                                 seq_max_N,
+                                 filter_bad_illumina_qual_digit)
+
+    # process quality results, recording why reads didn't pass
+    result_counts = np.bincount(quality_filter_results, minlength=4)
+    if len(result_counts) > 4:
+        raise ValueError("Unknown quality filter result: %d" %
+                         quality_filter_results.max())
+    counts['count_too_short'] += int(result_counts[1])
+    counts['count_too_many_N'] += int(result_counts[2])
+    counts['count_bad_illumina_qual_digit'] += int(result_counts[3])
+
+    sequence_lengths = counts['sequence_lengths']
+    seqs_per_sample_counts = counts['seqs_per_sample_counts']
+    for i in np.flatnonzero(quality_filter_results == 0):
+        sample_id = sample_ids[i]
+        length = truncation_lengths[i]
+        sequence = sequences[i][:length]
+        quality = qualities[i][:length]
+
+        sequence_lengths.append(int(length))
 
         try:
             seqs_per_sample_counts[sample_id] += 1
@@ -399,33 +654,286 @@ def process_fastq_single_end_read_file(fastq_read_f,
             sequence = str(DNA(sequence).rc())
             quality = quality[::-1]
 
-        fasta_header = '%s_%s %s orig_bc=%s new_bc=%s bc_diffs=%d' %\
-            (sample_id, seq_id, header, barcode,
-             corrected_barcode, num_barcode_errors)
-        yield fasta_header, sequence, quality, seq_id
-        seq_id += 1
+        yield sample_id, headers[i], sequence, quality
 
-    # Add sample IDs with zero counts to dictionary for logging
-    for curr_sample_id in barcode_to_sample_id.values():
-        if curr_sample_id not in seqs_per_sample_counts.keys():
-            seqs_per_sample_counts[curr_sample_id] = 0
 
-    if log_f is not None:
-        log_str = format_split_libraries_fastq_log(count_barcode_not_in_map,
-                                                   count_too_short,
-                                                   count_too_many_N,
-                                                   count_bad_illumina_qual_digit,
-                                                   count_barcode_errors_exceed_max,
-                                                   input_sequence_count,
-                                                   sequence_lengths,
-                                                   seqs_per_sample_counts)
-        log_f.write(log_str)
+def process_fastq_single_end_read_file_parallel(
+        sequence_read_fp,
+        barcode_read_fp,
+        barcode_to_sample_id,
+        jobs_to_start=2,
+        store_unassigned=False,
+        max_bad_run_length=0,
+        phred_quality_threshold=2,
+        min_per_read_length_fraction=0.75,
+        rev_comp=False,
+        rev_comp_barcode=False,
+        seq_max_N=0,
+        start_seq_id=0,
+        filter_bad_illumina_qual_digit=False,
+        log_f=None,
+        histogram_f=None,
+        barcode_correction_fn=None,
+        max_barcode_errors=1.5,
+        strict_header_match=True,
+        phred_offset=None,
+        shards_per_job=4,
+        temp_dir=None):
+    """ Demultiplex and quality filter fastq files with a pool of processes
+
+        sequence_read_fp and barcode_read_fp must be uncompressed (i.e.,
+         seekable) fastq files. They are split into byte-range shards
+         aligned to record boundaries, and each shard is processed in a
+         worker process. Shard results are merged in input order, so the
+         yielded records (including the seq_id numbering), the log and the
+         histogram are identical to those produced by
+         process_fastq_single_end_read_file.
+    """
+    if temp_dir is None:
+        temp_dir = get_qiime_temp_dir()
 
-    if len(sequence_lengths) and histogram_f is not None:
-        counts, bin_edges = make_histograms(sequence_lengths)
-        histogram_str = format_histogram_one_count(counts, bin_edges)
-        histogram_f.write(histogram_str)
-        histogram_f.write('\n--\n\n')
+    fastq_read_f = open(sequence_read_fp, 'U')
+    fastq_read_f_line1 = fastq_read_f.readline()
+    fastq_read_f_line2 = fastq_read_f.readline()
+    fastq_read_f.close()
+
+    if phred_offset is None:
+        phred_offset = _get_phred_offset(fastq_read_f_line1)
+    if phred_offset == 33:
+        phred_f = ascii_to_phred33
+    elif phred_offset == 64:
+        phred_f = ascii_to_phred64
+    else:
+        raise ValueError("Invalid PHRED offset: %d" % phred_offset)
+
+    # the minimum read length is always computed from the first read in
+    # the file, not from the first read in each shard
+    min_per_read_length = min_per_read_length_fraction * \
+        len(fastq_read_f_line2)
+
+    process_params = {
+        'store_unassigned': store_unassigned,
+        'max_bad_run_length': max_bad_run_length,
+        'phred_quality_threshold': phred_quality_threshold,
+        'min_per_read_length': min_per_read_length,
+        'rev_comp': rev_comp,
+        'rev_comp_barcode': rev_comp_barcode,
+        'seq_max_N': seq_max_N,
+        'filter_bad_illumina_qual_digit': filter_bad_illumina_qual_digit,
+        'barcode_correction_fn': barcode_correction_fn,
+        'max_barcode_errors': max_barcode_errors,
+        'strict_header_match': strict_header_match,
+        'phred_offset': phred_offset}
+
+    shards = get_fastq_shard_offsets(sequence_read_fp, barcode_read_fp,
+                                     jobs_to_start * shards_per_job)
+    # the shard files are created here, rather than by the workers, so that
+    # all of them can be removed if processing stops early
+    shard_fps = []
+    pool = None
+    try:
+        for i in range(len(shards)):
+            fd, shard_fp = mkstemp(dir=temp_dir,
+                                   prefix='split_libraries_fastq_',
+                                   suffix='.txt')
+            close(fd)
+            shard_fps.append(shard_fp)
+        shard_args = [(sequence_read_fp, barcode_read_fp, read_offset,
+                       barcode_offset, num_records, barcode_to_sample_id,
+                       process_params, shard_fp)
+                      for (read_offset, barcode_offset, num_records), shard_fp
+                      in zip(shards, shard_fps)]
+
+        counts = _init_split_libraries_fastq_counts()
+        seqs_per_sample_counts = counts['seqs_per_sample_counts']
+        seq_id = start_seq_id
+        pool = Pool(jobs_to_start)
+        # imap returns shard results in input order, which allows the
+        # merge to start as soon as the first shard is complete
+        for shard_fp, shard_counts in pool.imap(_process_fastq_shard,
+                                                shard_args):
+            for k in ('input_sequence_count',
+                      'count_barcode_not_in_map',
+                      'count_too_short',
+                      'count_too_many_N',
+                      'count_bad_illumina_qual_digit',
+                      'count_barcode_errors_exceed_max'):
+                counts[k] += shard_counts[k]
+            counts['sequence_lengths'].extend(
+                shard_counts['sequence_lengths'])
+            for sample_id, count in \
+                    shard_counts['seqs_per_sample_counts'].iteritems():
+                try:
+                    seqs_per_sample_counts[sample_id] += count
+                except KeyError:
+                    seqs_per_sample_counts[sample_id] = count
+
+            shard_f = open(shard_fp, 'U')
+            try:
+                for sample_id, header, sequence, quality in \
+                        izip(*[shard_f] * 4):
+                    fasta_header = '%s_%s %s' % (sample_id.rstrip('\n'),
+                                                 seq_id,
+                                                 header.rstrip('\n'))
+                    yield (fasta_header, sequence.rstrip('\n'),
+                           phred_f(quality.rstrip('\n')), seq_id)
+                    seq_id += 1
+            finally:
+                shard_f.close()
+                remove(shard_fp)
+    finally:
+        # stop the workers before removing the files they may be writing
+        if pool is not None:
+            pool.terminate()
+        remove_files(shard_fps, error_on_missing=False)
+
+    _write_split_libraries_fastq_counts(counts, barcode_to_sample_id,
+                                        log_f, histogram_f)
+
+
+def _process_fastq_shard(args):
+    """ Process one shard of a pair of fastq files in a worker process
+
+        The passing reads are written to shard_fp (four lines per read:
+         sample id, header, sequence and quality string) as seq_ids can only
+         be assigned once all preceding shards are complete. Returns
+         shard_fp and the counters for the shard.
+    """
+    (sequence_read_fp, barcode_read_fp, read_offset, barcode_offset,
+     num_records, barcode_to_sample_id, process_params, shard_fp) = args
+    phred_offset = process_params['phred_offset']
+
+    fastq_read_f = open(sequence_read_fp, 'U')
+    fastq_barcode_f = open(barcode_read_fp, 'U')
+    fastq_read_f.seek(read_offset)
+    fastq_barcode_f.seek(barcode_offset)
+    if num_records is None:
+        num_lines = None
+    else:
+        num_lines = 4 * num_records
+
+    counts = _init_split_libraries_fastq_counts()
+    shard_f = open(shard_fp, 'w')
+    for sample_id, header, sequence, quality in _process_fastq_reads(
+            islice(fastq_read_f, num_lines),
+            islice(fastq_barcode_f, num_lines),
+            barcode_to_sample_id,
+            counts,
+            **process_params):
+        shard_f.write('%s\n%s\n%s\n%s\n' % (
+            sample_id, header, sequence,
+            (quality + phred_offset).astype(np.uint8).tostring()))
+    shard_f.close()
+    fastq_read_f.close()
+    fastq_barcode_f.close()
+
+    return shard_fp, counts
+
+
+def get_fastq_shard_offsets(sequence_read_fp, barcode_read_fp, num_shards,
+                            buffer_size=1048576):
+    """ Split a pair of fastq files into shards aligned to record boundaries
+
+        The sequence read file is divided into num_shards byte ranges of
+         approximately equal size, and each boundary is moved forward to the
+         start of the next fastq record. The barcode read file is then split
+         at the same record numbers, so each shard contains matching
+         barcode and sequence records. Files must contain four lines per
+         record, as is the case for Illumina data.
+
+        Returns a list of (sequence read byte offset, barcode read byte
+         offset, number of records) tuples, one per shard. The number of
+         records is None for the last shard, which extends to the end of
+         the files.
+    """
+    fastq_read_f = open(sequence_read_fp, 'rb')
+    fastq_read_f.seek(0, 2)
+    file_size = fastq_read_f.tell()
+
+    record_starts = [0]
+    read_offsets = [0]
+    line_count = 0
+    offset = 0
+    for i in range(1, num_shards):
+        target = max(file_size * i // num_shards, offset + 1)
+        if target >= file_size:
+            break
+        # move to the start of the first line after target
+        fastq_read_f.seek(target - 1)
+        fastq_read_f.readline()
+        line_start = fastq_read_f.tell()
+        line_count += _count_newlines(fastq_read_f, offset, line_start,
+                                      buffer_size)
+        # and from there to the start of the next record
+        fastq_read_f.seek(line_start)
+        while line_count % 4 != 0 and fastq_read_f.readline():
+            line_count += 1
+        offset = fastq_read_f.tell()
+        if offset >= file_size:
+            break
+        record_starts.append(line_count // 4)
+        read_offsets.append(offset)
+    fastq_read_f.close()
+
+    fastq_barcode_f = open(barcode_read_fp, 'rb')
+    barcode_offsets = _find_line_offsets(fastq_barcode_f,
+                                         [4 * r for r in record_starts],
+                                         buffer_size)
+    fastq_barcode_f.close()
+    if len(barcode_offsets) < len(record_starts):
+        raise FastqParseError("Barcode fastq file contains fewer records "
+                              "than the read fastq file. Confirm that the "
+                              "barcode fastq and read fastq that you are "
+                              "passing match one another.")
+
+    num_records = [e - s for s, e in zip(record_starts, record_starts[1:])]
+    num_records.append(None)
+    return zip(read_offsets, barcode_offsets, num_records)
+
+
+def _count_newlines(f, start, end, buffer_size=1048576):
+    """ Count the newline characters in f between byte offsets start and end
+    """
+    f.seek(start)
+    result = 0
+    remaining = end - start
+    while remaining > 0:
+        chunk = f.read(min(buffer_size, remaining))
+        if not chunk:
+            break
+        result += chunk.count('\n')
+        remaining -= len(chunk)
+    return result
+
+
+def _find_line_offsets(f, line_numbers, buffer_size=1048576):
+    """ Return the byte offsets of the starts of line_numbers (sorted) in f
+
+        Lines are numbered from zero. Line numbers beyond the end of the
+         file are not included in the result.
+    """
+    result = []
+    f.seek(0)
+    line_count = 0
+    pos = 0
+    i = 0
+    while i < len(line_numbers):
+        chunk = f.read(buffer_size)
+        if not chunk:
+            break
+        start = 0
+        while i < len(line_numbers):
+            needed = line_numbers[i] - line_count
+            if chunk.count('\n', start) < needed:
+                line_count += chunk.count('\n', start)
+                break
+            for _ in xrange(needed):
+                start = chunk.index('\n', start) + 1
+            line_count += needed
+            result.append(pos + start)
+            i += 1
+        pos += len(chunk)
+    return result
 
 
 def make_histograms(lengths, binwidth=10):
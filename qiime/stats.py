@@ -45,11 +45,13 @@ from numpy import (argsort, array, ceil, empty, fill_diagonal, finfo,
                    log, mean, nan, nonzero, sqrt, std, take, tanh,
                    transpose, seterr as np_seterr, var, arange, corrcoef,
                    trace, ravel, float as np_float, finfo, asarray, isnan,
-                   isinf, abs)
+                   isinf, abs, triu_indices, searchsorted, isfinite, where,
+                   maximum, clip, multiply,
+                   errstate as np_errstate)
 
 from numpy.random import permutation, shuffle, randint
 from biom.table import Table
-from skbio.stats.distance import DistanceMatrix, mantel
+from skbio.stats.distance import DistanceMatrix
 from skbio.util import create_dir
 
 from qiime.format import format_p_value_for_num_iters
@@ -238,6 +240,202 @@ def _quantile(data, quantile):
     return output
 
 
+class MantelPermutations(object):
+
+    """Batched permutation engine for Mantel-type tests.
+
+    Computes the Pearson correlation between a distance matrix and one or
+    more fixed distance matrices, and between each of a series of random
+    row/column permutations of the distance matrix and the fixed matrices.
+
+    The condensed index map (the row and column of each upper triangular
+    element, in DistanceMatrix.condensed_form() order) and the centered fixed
+    matrices are computed once, when the engine is created. Permutations are
+    then evaluated in batches: k permutations are drawn into a k x n array,
+    the condensed forms of the k permuted matrices are gathered from the
+    flattened matrix with a single take into a k x m array (without building
+    any permuted matrix), and their correlations with the fixed
+    matrices are computed with a few array operations along its rows. Batches
+    are sized so that they need no more than max_batch_bytes of working
+    memory.
+
+    Each correlation is computed with the same floating point operations as
+    scipy.stats.pearsonr (which skbio's mantel uses), and the observed
+    correlation is computed in the same way as the permuted ones. Permutations
+    that reproduce the observed distances therefore tie with it exactly.
+    Permutations are drawn one at a time with numpy.random.permutation, in the
+    same order as skbio's mantel, so results (including p-values) are
+    reproducible from a given numpy random seed.
+    """
+
+    def __init__(self, ys, max_batch_bytes=2 ** 27):
+        """Constructs a new MantelPermutations instance.
+
+        Arguments:
+            ys - a list of distance matrices in condensed form that are held
+                fixed (i.e. not permuted). All must have the same length
+            max_batch_bytes - upper bound on the memory used to evaluate a
+                single batch of permutations
+        """
+        ys = asarray(ys, dtype=np_float)
+        if ys.ndim != 2 or ys.shape[1] < 1:
+            raise ValueError("Must provide at least one condensed distance "
+                             "matrix to correlate against.")
+        num_dists = ys.shape[1]
+        size = int(round((1 + sqrt(1 + 8 * num_dists)) / 2))
+        if size * (size - 1) // 2 != num_dists:
+            raise ValueError("%d is not a valid number of distances for a "
+                             "condensed distance matrix." % num_dists)
+
+        self.Size = size
+        rows, cols = triu_indices(size, 1)
+        self._rows = rows
+        self._cols = cols
+
+        self._ys = ys - ys.mean(axis=1)[:, None]
+        self._ys_ss = (self._ys * self._ys).sum(axis=1)
+
+        # Each permutation needs two indices, a value and a product for every
+        # distance. Batches of about 16MB are evaluated fastest, as they stay
+        # in cache between passes, but at least two permutations are taken
+        # at a time if max_batch_bytes allows.
+        perm_bytes = 32 * num_dists
+        self._batch_size = max(1, min(max_batch_bytes // perm_bytes,
+                                      max(2, 2 ** 24 // perm_bytes)))
+
+    def __call__(self, x, num_perms=999):
+        """Correlates x, and num_perms permutations of x, with the fixed ys.
+
+        Returns a 1D array with the correlation of x with each y, and a
+        num_perms x len(ys) array with the correlations of each permutation
+        of x with each y. Correlations are nan where x or y has no variation.
+
+        Arguments:
+            x - the (square) data of the distance matrix to permute
+            num_perms - the number of permutations of x to evaluate
+        """
+        x = asarray(x, dtype=np_float)
+        if x.shape != (self.Size, self.Size):
+            raise ValueError("Distance matrix of size %dx%d does not match "
+                             "the %dx%d distance matrices it is compared "
+                             "against." % (x.shape + (self.Size, self.Size)))
+
+        stats = self._correlate(x[self._rows, self._cols][None, :])[0]
+
+        # The batch buffers are reused, as allocating fresh k x m arrays for
+        # each batch costs as much as the arithmetic on them.
+        flat_x = x.ravel()
+        batch_size = min(self._batch_size, num_perms)
+        num_dists = len(self._rows)
+        orders = empty((batch_size, self.Size), dtype=int)
+        indices = empty((batch_size, num_dists), dtype=int)
+        col_indices = empty((batch_size, num_dists), dtype=int)
+        batch = empty((batch_size, num_dists))
+        work = empty((batch_size, num_dists))
+
+        perm_stats = empty((num_perms, len(self._ys)))
+        for start in range(0, num_perms, self._batch_size):
+            count = min(self._batch_size, num_perms - start)
+            for order in orders[:count]:
+                order[:] = permutation(self.Size)
+            # The flat index in x of each permuted distance. The indices are
+            # all valid, and take only writes to out without buffering it if
+            # mode is not 'raise'.
+            orders[:count].take(self._rows, axis=1, out=indices[:count],
+                                mode='clip')
+            indices[:count] *= self.Size
+            orders[:count].take(self._cols, axis=1, out=col_indices[:count],
+                                mode='clip')
+            indices[:count] += col_indices[:count]
+            flat_x.take(indices[:count], out=batch[:count], mode='clip')
+            perm_stats[start:start + count] = self._correlate(batch[:count],
+                                                              work[:count])
+        return stats, perm_stats
+
+    def _correlate(self, xs, work=None):
+        """Returns the correlation of each row of xs with each y.
+
+        The arithmetic is that of scipy.stats.pearsonr, applied to each row,
+        so a row's correlations do not depend on the other rows in xs. xs
+        must be a C-contiguous float array, and is centered in place. work,
+        if given, is an array of the same shape used for the products.
+        """
+        # numpy only sums each row in the same order as a 1D array (pairwise)
+        # if the rows are contiguous.
+        if work is None:
+            work = empty(xs.shape)
+        xs -= xs.mean(axis=1)[:, None]
+        xs_ss = multiply(xs, xs, out=work).sum(axis=1)
+        result = empty((len(xs), len(self._ys)))
+        with np_errstate(divide='ignore', invalid='ignore'):
+            for i, (y, y_ss) in enumerate(zip(self._ys, self._ys_ss)):
+                result[:, i] = (multiply(xs, y, out=work).sum(axis=1) /
+                                sqrt(xs_ss * y_ss))
+        return clip(result, -1.0, 1.0)
+
+
+def permutation_p_value(stat, perm_stats, alternative='two-sided'):
+    """Returns the permutation p-value of stat given permuted stats.
+
+    The p-value is the proportion of permuted stats (counting stat itself)
+    that are at least as extreme as stat. Returns nan if stat is nan or there
+    are no permuted stats.
+
+    Arguments:
+        stat - the observed test statistic
+        perm_stats - array of test statistics computed on permuted data
+        alternative - 'two-sided', 'greater' or 'less'
+    """
+    num_perms = len(perm_stats)
+    if num_perms == 0 or isnan(stat):
+        return nan
+
+    if alternative == 'two-sided':
+        count = (absolute(perm_stats) >= absolute(stat)).sum()
+    elif alternative == 'greater':
+        count = (perm_stats >= stat).sum()
+    elif alternative == 'less':
+        count = (perm_stats <= stat).sum()
+    else:
+        raise ValueError("Invalid alternative hypothesis '%s'." % alternative)
+    return (count + 1) / (num_perms + 1)
+
+
+def mantel_pearson(x, y, num_perms=999, alternative='two-sided'):
+    """Runs a Mantel test using Pearson correlation on two distance matrices.
+
+    A drop-in replacement for skbio.stats.distance.mantel (with
+    method='pearson' and strict=True) that evaluates the permutations with
+    MantelPermutations. Returns the Mantel r statistic, the p-value and the
+    number of samples.
+
+    Arguments:
+        x, y - DistanceMatrix objects containing the same sample IDs. y is
+            reordered to match x if needed
+        num_perms - the number of permutations to use to compute the p-value
+        alternative - 'two-sided', 'greater' or 'less'
+    """
+    if num_perms < 0:
+        raise ValueError("Number of permutations must be greater than or "
+                         "equal to zero.")
+    if alternative not in ('two-sided', 'greater', 'less'):
+        raise ValueError("Invalid alternative hypothesis '%s'." % alternative)
+    if set(x.ids) != set(y.ids):
+        raise ValueError("IDs exist that are not in both distance matrices.")
+
+    n = x.shape[0]
+    if n < 3:
+        raise ValueError("Distance matrices must have at least 3 matching IDs "
+                         "between them (i.e., minimum 3x3 in size).")
+    if y.ids != x.ids:
+        y = y.filter(x.ids)
+
+    stats, perm_stats = MantelPermutations([y.condensed_form()])(x.data,
+                                                                 num_perms)
+    stat = stats[0]
+    return stat, permutation_p_value(stat, perm_stats[:, 0], alternative), n
+
+
 class DistanceMatrixStats(object):
 
     """Base class for distance matrix-based statistical methods.
@@ -479,28 +677,27 @@ class MantelCorrelogram(CorrelationStats):
         results['mantel_r'] = []
         results['mantel_p'] = []
 
+        # The eco distance matrix is the same in every Mantel test, so share
+        # a single permutation engine between distance classes.
+        permutations = MantelPermutations([eco_dm.condensed_form()])
+
         # Create a model matrix for each distance class, then compute a Mantel
         # test using it and the original eco distance matrix. A model matrix
         # contains ones for each element that is in the current distance class,
-        # and zeros otherwise (zeros on the diagonal as well).
+        # and zeros otherwise (zeros on the diagonal as well, which is always
+        # in class -1).
         for class_num in range(num_classes):
             results['class_index'].append(class_indices[class_num])
-            model_matrix = zeros([dm_size, dm_size], dtype=int)
-            for i in range(dm_size):
-                for j in range(dm_size):
-                    curr_ele = dist_class_matrix[i][j]
-                    if curr_ele == class_num and i != j:
-                        model_matrix[i][j] = 1
-            model_matrix = DistanceMatrix(model_matrix, geo_dm.ids)
+            model_matrix = (dist_class_matrix == class_num).astype(int)
 
             # Count the number of distances in the current distance class.
-            num_distances = int(model_matrix.data.sum())
+            num_distances = int(model_matrix.sum())
             results['num_dist'].append(num_distances)
             if num_distances == 0:
                 results['mantel_r'].append(None)
                 results['mantel_p'].append(None)
             else:
-                row_sums = model_matrix.data.sum(axis=1)
+                row_sums = model_matrix.sum(axis=1)
                 row_sums = map(int, row_sums)
                 has_zero_sum = 0 in row_sums
 
@@ -509,11 +706,8 @@ class MantelCorrelogram(CorrelationStats):
                 # (i.e. the sample doesn't have any distances that fall in the
                 # current class).
                 if not (class_num > ((num_classes // 2) - 1) and has_zero_sum):
-                    # Compute the correlation coefficient without performing
-                    # permutation tests in order to check its sign below.
-                    orig_stat, _, _ = mantel(
-                        model_matrix, eco_dm, method='pearson',
-                        permutations=0, strict=True)
+                    stats, perm_stats = permutations(model_matrix, num_perms)
+                    orig_stat = stats[0]
 
                     # Negate the Mantel r statistic because we are using
                     # distance matrices, not similarity matrices (this is a
@@ -528,10 +722,8 @@ class MantelCorrelogram(CorrelationStats):
                     else:
                         tail_type = 'greater'
 
-                    _, p_val, _ = mantel(
-                        model_matrix, eco_dm, method='pearson',
-                        permutations=num_perms, alternative=tail_type,
-                        strict=True)
+                    p_val = permutation_p_value(orig_stat, perm_stats[:, 0],
+                                                tail_type)
 
                     results['mantel_p'].append(p_val)
                 else:
@@ -630,22 +822,15 @@ class MantelCorrelogram(CorrelationStats):
                                      (0.5 * (next_bp - break_point)))
 
             # Create the matrix of distance classes. Every element in the
-            # matrix tells what distance class the original element belongs to.
-            dist_class_matrix = empty([size, size], dtype=int)
-            for i in range(size):
-                for j in range(size):
-                    if i != j:
-                        curr_ele = dm[i][j]
-                        bps = [(k - 1) for k, bp in enumerate(break_points)
-                               if bp >= curr_ele]
-                        min_bp = min(bps)
-
-                        # If we somehow got a negative breakpoint (possible
-                        # sometimes due to rounding error), put it in the first
-                        # distance class.
-                        dist_class_matrix[i][j] = min_bp if min_bp >= 0 else 0
-                    else:
-                        dist_class_matrix[i][j] = -1
+            # matrix tells what distance class the original element belongs to
+            # (one less than the index of the first breakpoint that is not
+            # smaller than it).
+            dist_class_matrix = searchsorted(break_points, dm.data) - 1
+
+            # If we somehow got a negative breakpoint (possible sometimes due
+            # to rounding error), put it in the first distance class.
+            dist_class_matrix[dist_class_matrix < 0] = 0
+            fill_diagonal(dist_class_matrix, -1)
 
         return dist_class_matrix, class_indices
 
@@ -815,37 +1000,25 @@ class PartialMantel(CorrelationStats):
         res['mantel_p'] = None
 
         dm1, dm2, cdm = self.DistanceMatrices
-        dm1_flat = dm1.condensed_form()
         dm2_flat = dm2.condensed_form()
         cdm_flat = cdm.condensed_form()
 
-        # Get the initial r-values before permuting.
-        rval1 = pearson(dm1_flat, dm2_flat)
-        rval2 = pearson(dm1_flat, cdm_flat)
+        # Get the initial r-values of the first distance matrix, and those of
+        # each permutation of it, against the other two distance matrices.
+        # The correlation between the second and control distance matrices
+        # does not change between permutations.
+        rvals, perm_rvals = MantelPermutations([dm2_flat, cdm_flat])(
+            dm1.data, num_perms)
         rval3 = pearson(dm2_flat, cdm_flat)
 
-        # Calculate the original test statistic (r-value).
-        orig_stat = corr(rval1, rval2, rval3)
-
-        # Calculate permuted r-values and p-values, storing them for use in the
-        # calculation of the final statistic.
-        perm_stats = []
-        numerator = 0
-        for i in range(0, num_perms):
-            # Permute the first distance matrix and calculate new r and
-            # p-values.
-            p1 = permute_2d(dm1, permutation(dm1.shape[0]))
-            dm1_perm = DistanceMatrix(p1, dm1.ids)
-            dm1_perm_flat = dm1_perm.condensed_form()
-            rval1 = pearson(dm1_perm_flat, dm2_flat)
-            rval2 = pearson(dm1_perm_flat, cdm_flat)
-            perm_stats.append(corr(rval1, rval2, rval3))
-
-            if perm_stats[-1] >= orig_stat:
-                numerator += 1
+        # Calculate the original and permuted test statistics (r-values).
+        orig_stat = corr(rvals[0], rvals[1], rval3)
+        perm_stats = corr(perm_rvals[:, 0], perm_rvals[:, 1], rval3)
+
         # Load the final statistics into the result dictionary.
         res['mantel_r'] = orig_stat
-        res['mantel_p'] = (numerator + 1) / (num_perms + 1)
+        res['mantel_p'] = permutation_p_value(orig_stat, perm_stats,
+                                              'greater')
         return res
 
 
@@ -1395,15 +1568,155 @@ def _permute_observations(x, y, num_perms):
     # observation orders in x and y for eg. the mc_t_two_sample test will fail
     # to produce the same results)
     vals.sort()
-    inds = arange(vals.size)
     xs, ys = [], []
-    for i in range(num_perms):
-        shuffle(inds)
+    for inds in _permutation_indices(vals.size, num_perms):
         xs.append(vals[inds[:lenx]])
         ys.append(vals[inds[lenx:]])
     return xs, ys
 
 
+def mc_t_two_sample_rows(x_items, y_items, tails='two-sided',
+                         permutations=999, exp_diff=0,
+                         max_batch_bytes=2 ** 26):
+    """Performs mc_t_two_sample on each row of two matrices at once.
+
+    x_items and y_items are 2D arrays with one row per test (e.g. per OTU)
+    and one column per observation in each group. Every row is tested with
+    the same set of permutations, which are drawn exactly as in
+    mc_t_two_sample after resetting the numpy random seed.
+
+    The observed and parametric results are those of mc_t_two_sample. The
+    nonparametric p-values deliberately differ on tied data (e.g. integer
+    counts): permuted t statistics within a relative tolerance of sqrt(eps)
+    of the observed one are counted as ties, as they are equal up to
+    rounding error. mc_t_two_sample compares the rounded statistics, so it
+    misses some of these ties and can give smaller p-values. Where there
+    are no such ties, the p-values are the same.
+
+    Rather than permuting each row, the t statistics for all rows are
+    computed from per-group sums and sums of squares, which are obtained for
+    a batch of permutations with a single matrix product against the
+    permutations' group membership matrix. Batches are sized so that they
+    need no more than max_batch_bytes of working memory.
+
+    Returns arrays of the observed t statistics, the parametric p-values and
+    the nonparametric p-values, one element per row. The permuted t
+    statistics are not returned.
+
+    Arguments:
+        x_items - 2D array of the first group of observations
+        y_items - 2D array of the second group of observations
+        tails, permutations, exp_diff - see mc_t_two_sample
+        max_batch_bytes - upper bound on the memory used to evaluate a
+            single batch of permutations
+    """
+    if permutations < 0:
+        raise ValueError("Invalid number of permutations: %d. Must be greater "
+                         "than or equal to zero." % permutations)
+    if tails not in ('two-sided', 'low', 'high'):
+        raise ValueError('Unknown direction.')
+
+    x_items = asarray(x_items, dtype=np_float)
+    y_items = asarray(y_items, dtype=np_float)
+    num_rows, nx = x_items.shape
+    ny = y_items.shape[1]
+    if (nx == 1 and ny == 1) or (nx < 1 or ny < 1):
+        raise ValueError("At least one of the sequences of observations is "
+                         "empty, or the sequences each contain only a single "
+                         "observation. Cannot perform the t-test.")
+
+    obs_t = _t_two_sample_from_sums(
+        x_items.sum(axis=1), (x_items ** 2).sum(axis=1),
+        y_items.sum(axis=1), (y_items ** 2).sum(axis=1), nx, ny, exp_diff)
+    param_p_vals = _tprob_array(obs_t, nx + ny - 2., tails)
+
+    nonparam_p_vals = empty(num_rows)
+    nonparam_p_vals.fill(nan)
+    if permutations > 0:
+        # Sorting each row's values makes the permuted groups match those of
+        # _permute_observations.
+        vals = hstack([x_items, y_items])
+        vals.sort(axis=1)
+        sq_vals = vals ** 2
+        total = vals.sum(axis=1)[:, None]
+        total_sq = sq_vals.sum(axis=1)[:, None]
+
+        # Sums are accumulated in a different order than for the observed
+        # statistic, so permuted statistics within rounding error of it
+        # (e.g. from permutations that swap equal values between the groups)
+        # are counted as ties.
+        tolerance = sqrt(MACHEP) * maximum(abs(obs_t), 1)
+        perm_indices = _permutation_indices(nx + ny, permutations)
+        batch_size = max(1, max_batch_bytes // (32 * max(num_rows, nx + ny)))
+        better = zeros(num_rows, dtype=int)
+        for start in range(0, permutations, batch_size):
+            batch = perm_indices[start:start + batch_size]
+            in_x = zeros((nx + ny, len(batch)))
+            in_x[batch[:, :nx], arange(len(batch))[:, None]] = 1
+            sum_x = vals.dot(in_x)
+            sum_sq_x = sq_vals.dot(in_x)
+            perm_t = _t_two_sample_from_sums(sum_x, sum_sq_x, total - sum_x,
+                                             total_sq - sum_sq_x, nx, ny,
+                                             exp_diff)
+            if tails == 'two-sided':
+                better += (abs(perm_t) >=
+                           (abs(obs_t) - tolerance)[:, None]).sum(axis=1)
+            elif tails == 'low':
+                better += (perm_t <= (obs_t + tolerance)[:, None]).sum(axis=1)
+            else:
+                better += (perm_t >= (obs_t - tolerance)[:, None]).sum(axis=1)
+
+        tested = ~(isnan(obs_t) | isnan(param_p_vals))
+        nonparam_p_vals[tested] = (better[tested] + 1) / (permutations + 1)
+
+    return obs_t, param_p_vals, nonparam_p_vals
+
+
+def _t_two_sample_from_sums(sum_x, sum_sq_x, sum_y, sum_sq_y, nx, ny,
+                            exp_diff=0):
+    """Returns t_two_sample t statistics computed from group sums.
+
+    Matches t_two_sample, including using t_one_observation's statistic if
+    one of the groups contains a single observation. Statistics that are not
+    finite (e.g. because there is no variance within the groups) are nan.
+    """
+    if ny == 1 and nx > 1:
+        diff = sum_y / ny - sum_x / nx - exp_diff
+    else:
+        diff = sum_x / nx - exp_diff - sum_y / ny
+    sum_sq_dev = (sum_sq_x - sum_x ** 2 / nx) + (sum_sq_y - sum_y ** 2 / ny)
+    # Rounding error can leave a tiny (or negative) sum of squared deviations
+    # where there is no variance at all.
+    sum_sq_dev[sum_sq_dev <= MACHEP * (sum_sq_x + sum_sq_y)] = 0
+    with np_errstate(divide='ignore', invalid='ignore'):
+        t = diff / sqrt(sum_sq_dev / (nx + ny - 2) * (1 / nx + 1 / ny))
+    t[~isfinite(t)] = nan
+    return t
+
+
+def _tprob_array(t, df, tails):
+    """Returns tprob for each element of the array t."""
+    if tails == 'two-sided':
+        return where(t >= 0, 2 * (1. - tdist.cdf(t, df)), 2 * tdist.cdf(t, df))
+    elif tails == 'high':
+        return 1 - tdist.cdf(t, df)
+    else:
+        return tdist.cdf(t, df)
+
+
+def _permutation_indices(n, num_perms):
+    """Returns a num_perms x n array of successive shuffles of arange(n).
+
+    The shuffles are those that _permute_observations draws.
+    """
+    inds = arange(n)
+    perm_indices = empty((num_perms, n), dtype=int)
+    for i in range(num_perms):
+        shuffle(inds)
+        perm_indices[i] = inds
+    return perm_indices
+
+
 def t_one_observation(x, sample, tails='two-sided', exp_diff=0):
     """Returns t-test for significance of single observation versus a sample.
 
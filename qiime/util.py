@@ -44,21 +44,12 @@ from biom.table import Table
 from cogent.parse.tree import DndParser
 from cogent.cluster.procrustes import procrustes
 
-from skbio.util import remove_files, create_dir
-from skbio.format.sequences import format_fastq_record
 from burrito.util import ApplicationError, CommandLineApplication, FilePath
 from burrito.util import which
-from skbio.sequence import DNASequence
-from skbio.parse.sequences import parse_fasta
-from skbio.parse.sequences import FastaIterator, FastqIterator
-
-from bfillings.blast import Blastall, BlastResult
-from bfillings.formatdb import (build_blast_db_from_fasta_path,
-    build_blast_db_from_fasta_file)
-from qiime_default_reference import (get_template_alignment,
-    get_reference_sequences, get_reference_taxonomy,
-    get_template_alignment_column_mask)
 
+# scikit-bio, bfillings and qiime-default-reference are imported inside the
+# functions that use them: importing skbio alone takes more than a second,
+# and every QIIME script imports this module at startup.
 
 from qcli import make_option, qcli_system_call, parse_command_line_parameters
 
@@ -70,7 +61,6 @@ from qiime.parse import (parse_qiime_config_files,
                          PhyloNode,
                          parse_mapping_file,
                          parse_denoiser_mapping,
-                         parse_fastq,
                          mapping_file_to_dict)
 
 # for backward compatibility - compute_seqs_per_library_stats has
@@ -260,8 +250,22 @@ class FunctionWithParams(object):
             return result
 
 
+def remove_files(list_of_filepaths, error_on_missing=True):
+    """Remove list of filepaths (see skbio.util.remove_files)"""
+    from skbio.util import remove_files as _remove_files
+    return _remove_files(list_of_filepaths, error_on_missing=error_on_missing)
+
+
+def create_dir(dir_name, fail_on_exist=False, handle_errors_externally=False):
+    """Create a directory safely (see skbio.util.create_dir)"""
+    from skbio.util import create_dir as _create_dir
+    return _create_dir(dir_name, fail_on_exist=fail_on_exist,
+                       handle_errors_externally=handle_errors_externally)
+
+
 def trim_fasta(fasta_lines, output_length):
     """trim fasta seqs to output_length bases """
+    from skbio.parse.sequences import parse_fasta
     for seq_id, seq in parse_fasta(fasta_lines):
         yield '>%s\n%s\n' % (seq_id, seq[:output_length])
 
@@ -341,6 +345,9 @@ def load_qiime_config():
 
     # For files that are defined in the qiime-default-reference package,
     # add values to the qiime_config if they haven't already been defined.
+    from qiime_default_reference import (get_template_alignment,
+                                         get_reference_sequences,
+                                         get_reference_taxonomy)
     qiime_config['pick_otus_reference_seqs_fp'] = \
         qiime_config['pick_otus_reference_seqs_fp'] or get_reference_sequences()
 
@@ -356,7 +363,7 @@ def load_qiime_config():
     return qiime_config
 
 def qiime_blast_seqs(seqs,
-                     blast_constructor=Blastall,
+                     blast_constructor=None,
                      blast_program='blastn',
                      blast_db=None,
                      refseqs=None,
@@ -371,8 +378,16 @@ def qiime_blast_seqs(seqs,
 
     seqs: a list (or object with list-like interace) of (seq_id, seq)
      tuples (e.g., the output of parse_fasta)
+    blast_constructor: the application controller to run (default:
+     bfillings.blast.Blastall)
 
     """
+    from bfillings.blast import Blastall, BlastResult
+    from bfillings.formatdb import (build_blast_db_from_fasta_path,
+                                    build_blast_db_from_fasta_file)
+
+    if blast_constructor is None:
+        blast_constructor = Blastall
 
     assert blast_db or refseqs_fp or refseqs, \
         'Must provide either a blast_db or a fasta ' +\
@@ -426,7 +441,7 @@ def qiime_blast_seqs(seqs,
 
 
 def qiime_blastx_seqs(seqs,
-                      blast_constructor=Blastall,
+                      blast_constructor=None,
                       blast_db=None,
                       refseqs=None,
                       refseqs_fp=None,
@@ -514,6 +529,7 @@ def write_seqs_to_fastq(fp, seqs, write_mode='w'):
 
         seqs: list of (seq_id,seq,qual_id,qual) tuples
     """
+    from skbio.format.sequences import format_fastq_record
     with open(fp, write_mode) as f:
         for s in seqs:
             f.write(format_fastq_record(s[0], s[1], s[3]))
@@ -584,6 +600,7 @@ def split_sequence_file_on_sample_ids_to_files(seqs,
           hitting errors arising from too many files being open when working
           with large numbers of samples ids (e.g. > 1024 on linux)
     """
+    from skbio.parse.sequences import FastaIterator, FastqIterator
     create_dir(output_dir)
     file_lookup = {}
     all_fps = []
@@ -722,6 +739,43 @@ def get_options_lookup():
                     ' [default: %default]',
                     default=qiime_config['jobs_to_start'])
 
+    result['step_cache_dir_workflow'] =\
+        make_option('--step_cache_dir', type='string',
+                    help='Directory in which to cache the output of workflow'
+                    ' steps. Steps which have already been run with the same'
+                    ' parameters and input files have their output restored'
+                    ' from the cache rather than being run again'
+                    ' [default: %default; no caching]',
+                    default=None)
+    result['step_cache_max_size_workflow'] =\
+        make_option('--step_cache_max_size', type='float',
+                    help='Maximum size of the step cache in gigabytes. The'
+                    ' least recently used steps are removed from the cache'
+                    ' when it grows larger than this [default: %default]',
+                    default=10.0)
+    result['rerun_cached_steps_workflow'] =\
+        make_option('--rerun_cached_steps', action='store_true',
+                    help='Run all workflow steps, rather than restoring their'
+                    ' output from the step cache. Their output is still'
+                    ' stored in the cache [default: %default]',
+                    default=False)
+    result['in_process_workflow'] =\
+        make_option('--in_process', action='store_true',
+                    help='Run QIIME scripts called by the workflow in'
+                    ' processes forked from the workflow process, rather'
+                    ' than starting a new python interpreter for each. This'
+                    ' avoids the time taken to start python and import'
+                    ' modules for each step [default: %default]',
+                    default=False)
+    result['concurrent_jobs_workflow'] =\
+        make_option('--concurrent_jobs', type='int',
+                    help='Number of workflow steps to run at the same time.'
+                    ' Steps are only run at the same time if they don\'t'
+                    ' depend on each other\'s output. This is independent'
+                    ' of -a and -O, which parallelize individual steps'
+                    ' [default: %default]',
+                    default=1)
+
     # Define options used by the parallel scripts
     result['jobs_to_start'] =\
         make_option('-O', '--jobs_to_start', type='int',
@@ -744,8 +798,10 @@ def get_options_lookup():
                     default=False)
     result['cluster_jobs_fp'] =\
         make_option('-U', '--cluster_jobs_fp',
-                    help='path to cluster jobs script (defined in qiime_config) ' +
-                    ' [default: %default]',
+                    help='path to cluster jobs script (defined in qiime_config). ' +
+                    'Pass "local" to run the jobs in a pool of processes on ' +
+                    'this machine and merge the results as soon as the ' +
+                    'jobs complete, without polling [default: %default]',
                     default=qiime_config['cluster_jobs_fp'] or
                     'start_parallel_jobs.py')
     result['suppress_polling'] =\
@@ -1029,6 +1085,7 @@ def degap_fasta_aln(seqs):
     seqs: list of label,seq pairs
     """
 
+    from skbio.sequence import DNASequence
     for (label, seq) in seqs:
         yield DNASequence(seq, id=label).degap()
 
@@ -1302,22 +1359,26 @@ def inflate_denoiser_output(
 # Functions for counting sequences in fasta files
 
 
-def count_seqs(fasta_filepath, parser=parse_fasta):
+def count_seqs(fasta_filepath, parser=None):
     """ Count the sequences in fasta_filepath
 
         fasta_filepath: string indicating the full path to the file
+        parser: callable yielding records from an open file (default:
+         skbio's parse_fasta)
     """
     # Open the file and pass it to py_count_seqs_from_file -- wrapping
     # this makes for easier unit testing
     return count_seqs_from_file(open(fasta_filepath, 'U'), parser=parser)
 
 
-def count_seqs_from_file(fasta_file, parser=parse_fasta):
+def count_seqs_from_file(fasta_file, parser=None):
     """Return number of sequences in fasta_file (no format checking performed)
 
         fasta_file: an open file object
 
     """
+    if parser is None:
+        from skbio.parse.sequences import parse_fasta as parser
     result = 0
     lens = []
     for record in parser(fasta_file):
@@ -1346,6 +1407,7 @@ def count_seqs_in_filepaths(fasta_filepaths, seq_counter=count_seqs):
         # if the file is actually fastq, use the fastq parser.
         # otherwise use the fasta parser
         if fasta_filepath.endswith('.fastq'):
+            from skbio.parse.sequences import parse_fastq
             parser = partial(parse_fastq, enforce_qual_range=False)
         elif fasta_filepath.endswith('.tre') or \
                 fasta_filepath.endswith('.ph') or \
@@ -1356,7 +1418,7 @@ def count_seqs_in_filepaths(fasta_filepaths, seq_counter=count_seqs):
                 t = DndParser(f, constructor=PhyloNode)
                 return zip(t.iterTips(), repeat(''))
         else:
-            parser = parse_fasta
+            parser = None
 
         try:
             # get the count of sequences in the current file
@@ -1521,6 +1583,7 @@ def subsample_fasta(input_fasta_fp,
     percent_subsample: percent of sequences to write
     """
 
+    from skbio.parse.sequences import parse_fasta
     input_fasta = open(input_fasta_fp, "U")
 
     output_fasta = open(output_fp, "w")
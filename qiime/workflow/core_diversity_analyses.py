@@ -184,7 +184,8 @@ def run_core_diversity_analyses(
             "biom summarize-table -i %s -o %s %s" % \
             (biom_fp, biom_table_stats_output_fp, params_str)
         commands.append([('Generate BIOM table summary',
-                          biom_table_summary_cmd)])
+                          biom_table_summary_cmd,
+                          [biom_fp], [biom_table_stats_output_fp])])
     else:
         logger.write("Skipping 'biom summarize-table' as %s exists.\n\n"
                      % biom_table_stats_output_fp)
@@ -202,7 +203,7 @@ def run_core_diversity_analyses(
             (biom_fp, filtered_biom_fp, sampling_depth)
         commands.append(
             [('Filter low sequence count samples from table (minimum sequence count: %d)' % sampling_depth,
-              filter_samples_cmd)])
+              filter_samples_cmd, [biom_fp], [filtered_biom_fp])])
     else:
         logger.write("Skipping filter_samples_from_otu_table.py as %s exists.\n\n"
                      % filtered_biom_fp)
@@ -215,7 +216,7 @@ def run_core_diversity_analyses(
             (biom_fp, rarefied_biom_fp, sampling_depth)
         commands.append(
             [('Rarify the OTU table to %d sequences/sample' % sampling_depth,
-              single_rarefaction_cmd)])
+              single_rarefaction_cmd, [biom_fp], [rarefied_biom_fp])])
     else:
         logger.write("Skipping single_rarefaction.py as %s exists.\n\n"
                      % rarefied_biom_fp)
@@ -276,7 +277,9 @@ def run_core_diversity_analyses(
                         (dm_fp, category, boxplots_output_dir,
                          mapping_fp, params_str)
                     commands.append([('Boxplots (%s)' % category,
-                                      boxplots_cmd)])
+                                      boxplots_cmd,
+                                      [dm_fp, mapping_fp],
+                                      [plot_output_fp, stats_output_fp])])
                 else:
                     logger.write("Skipping make_distance_boxplots.py for %s as %s exists.\n\n"
                                  % (category, plot_output_fp))
@@ -356,7 +359,9 @@ def run_core_diversity_analyses(
                          params_str)
                     commands.append(
                         [('Compare alpha diversity (%s)' % alpha_metric,
-                          compare_alpha_cmd)])
+                          compare_alpha_cmd,
+                          [collated_alpha_diversity_fp, mapping_fp],
+                          [compare_alpha_output_dir])])
                     for category in categories:
                         alpha_comparison_stat_fp = '%s/%s_stats.txt' % \
                             (compare_alpha_output_dir, category)
@@ -456,7 +461,9 @@ def run_core_diversity_analyses(
                     (rarefied_biom_fp, mapping_fp, category,
                      group_signifance_fp, params_str)
                 commands.append([('Group significance (%s)' % category,
-                                  group_significance_cmd)])
+                                  group_significance_cmd,
+                                  [rarefied_biom_fp, mapping_fp],
+                                  [group_signifance_fp])])
             else:
                 logger.write("Skipping group_significance.py for %s as %s exists.\n\n"
                              % (category, group_signifance_fp))
@@ -469,7 +476,8 @@ def run_core_diversity_analyses(
     if not exists(filtered_biom_gzip_fp):
         commands.append(
             [('Compress the filtered BIOM table', 'gzip %s' %
-              filtered_biom_fp)])
+              filtered_biom_fp, [filtered_biom_fp],
+              [filtered_biom_fp, filtered_biom_gzip_fp])])
     else:
         logger.write("Skipping compressing of filtered BIOM table as %s exists.\n\n"
                      % filtered_biom_gzip_fp)
@@ -482,7 +490,8 @@ def run_core_diversity_analyses(
     if not exists(rarified_biom_gzip_fp):
         commands.append(
             [('Compress the rarified BIOM table', 'gzip %s' %
-              rarefied_biom_fp)])
+              rarefied_biom_fp, [rarefied_biom_fp],
+              [rarefied_biom_fp, rarified_biom_gzip_fp])])
     else:
         logger.write("Skipping compressing of rarified BIOM table as %s exists.\n\n"
                      % rarified_biom_gzip_fp)
@@ -90,7 +90,8 @@ def run_beta_diversity_through_plots(otu_table_fp,
             (otu_table_fp, even_sampled_otu_table_fp, sampling_depth)
         commands.append([
             ('Sample OTU table at %d seqs/sample' % sampling_depth,
-             single_rarefaction_cmd)])
+             single_rarefaction_cmd,
+             [otu_table_fp], [even_sampled_otu_table_fp])])
         otu_table_fp = even_sampled_otu_table_fp
         otu_table_dir, otu_table_filename = split(even_sampled_otu_table_fp)
         otu_table_basename, otu_table_ext = splitext(otu_table_filename)
@@ -114,8 +115,13 @@ def run_beta_diversity_through_plots(otu_table_fp,
 
         params_str = get_params_str(bdiv_params_copy)
 
+        bdiv_input_fps = [otu_table_fp]
         if tree_fp:
             params_str = '%s -t %s ' % (params_str, tree_fp)
+            bdiv_input_fps.append(tree_fp)
+
+        orig_beta_div_fp = '%s/%s_%s.txt' % \
+            (output_dir, beta_diversity_metric, otu_table_basename)
 
         # Build the beta-diversity command
         if parallel:
@@ -127,20 +133,21 @@ def run_beta_diversity_through_plots(otu_table_fp,
             beta_div_cmd = 'parallel_beta_diversity.py -i %s -o %s --metrics %s -T %s' %\
                 (otu_table_fp, output_dir, beta_diversity_metric, params_str)
             commands.append(
-                [('Beta Diversity (%s)' % beta_diversity_metric, beta_div_cmd)])
+                [('Beta Diversity (%s)' % beta_diversity_metric, beta_div_cmd,
+                  bdiv_input_fps, [orig_beta_div_fp])])
         else:
             beta_div_cmd = 'beta_diversity.py -i %s -o %s --metrics %s %s' %\
                 (otu_table_fp, output_dir, beta_diversity_metric, params_str)
             commands.append(
-                [('Beta Diversity (%s)' % beta_diversity_metric, beta_div_cmd)])
+                [('Beta Diversity (%s)' % beta_diversity_metric, beta_div_cmd,
+                  bdiv_input_fps, [orig_beta_div_fp])])
 
-        orig_beta_div_fp = '%s/%s_%s.txt' % \
-            (output_dir, beta_diversity_metric, otu_table_basename)
         beta_div_fp = '%s/%s_dm.txt' % \
             (output_dir, beta_diversity_metric)
         commands.append(
             [('Rename distance matrix (%s)' % beta_diversity_metric,
-              'mv %s %s' % (orig_beta_div_fp, beta_div_fp))])
+              'mv %s %s' % (orig_beta_div_fp, beta_div_fp),
+              [orig_beta_div_fp], [orig_beta_div_fp, beta_div_fp])])
         dm_fps.append((beta_diversity_metric, beta_div_fp))
 
         # Prep the principal coordinates command
@@ -153,7 +160,8 @@ def run_beta_diversity_through_plots(otu_table_fp,
         pc_cmd = 'principal_coordinates.py -i %s -o %s %s' %\
             (beta_div_fp, pc_fp, params_str)
         commands.append(
-            [('Principal coordinates (%s)' % beta_diversity_metric, pc_cmd)])
+            [('Principal coordinates (%s)' % beta_diversity_metric, pc_cmd,
+              [beta_div_fp], [pc_fp])])
 
         # Generate emperor plots
         if not suppress_emperor_plots:
@@ -174,7 +182,7 @@ def run_beta_diversity_through_plots(otu_table_fp,
 
             commands.append(
                 [('Make emperor plots, %s)' % beta_diversity_metric,
-                  emperor_command)])
+                  emperor_command, [pc_fp, mapping_fp], [emperor_dir])])
 
     # Call the command handler on the list of commands
     command_handler(commands,
@@ -253,7 +261,8 @@ def run_alpha_rarefaction(otu_table_fp,
             'multiple_rarefactions.py -i %s -m %s -x %s -s %s -o %s %s' %\
             (otu_table_fp, min_rare_depth, max_rare_depth, step,
              rarefaction_dir, params_str)
-    commands.append([('Alpha rarefaction', rarefaction_cmd)])
+    commands.append([('Alpha rarefaction', rarefaction_cmd,
+                      [otu_table_fp], [rarefaction_dir])])
 
     # Prep the alpha diversity command
     alpha_diversity_dir = '%s/alpha_div/' % output_dir
@@ -262,8 +271,10 @@ def run_alpha_rarefaction(otu_table_fp,
         params_str = get_params_str(params['alpha_diversity'])
     except KeyError:
         params_str = ''
+    alpha_diversity_input_fps = [rarefaction_dir]
     if tree_fp:
         params_str += ' -t %s' % tree_fp
+        alpha_diversity_input_fps.append(tree_fp)
     if parallel:
         params_str += ' %s' % get_params_str(params['parallel'])
         # Build the alpha diversity command
@@ -277,7 +288,8 @@ def run_alpha_rarefaction(otu_table_fp,
             (rarefaction_dir, alpha_diversity_dir, params_str)
 
     commands.append(
-        [('Alpha diversity on rarefied OTU tables', alpha_diversity_cmd)])
+        [('Alpha diversity on rarefied OTU tables', alpha_diversity_cmd,
+          alpha_diversity_input_fps, [alpha_diversity_dir])])
 
     # Prep the alpha diversity collation command
     alpha_collated_dir = '%s/alpha_div_collated/' % output_dir
@@ -289,13 +301,16 @@ def run_alpha_rarefaction(otu_table_fp,
     # Build the alpha diversity collation command
     alpha_collated_cmd = 'collate_alpha.py -i %s -o %s %s' %\
         (alpha_diversity_dir, alpha_collated_dir, params_str)
-    commands.append([('Collate alpha', alpha_collated_cmd)])
+    commands.append([('Collate alpha', alpha_collated_cmd,
+                      [alpha_diversity_dir], [alpha_collated_dir])])
 
     if not retain_intermediate_files:
         commands.append([('Removing intermediate files',
-                          'rm -r %s %s' % (rarefaction_dir, alpha_diversity_dir))])
+                          'rm -r %s %s' % (rarefaction_dir, alpha_diversity_dir),
+                          [], [rarefaction_dir, alpha_diversity_dir])])
     else:
-        commands.append([('Skipping removal of intermediate files.', '')])
+        commands.append([('Skipping removal of intermediate files.', '',
+                          [], [])])
 
     # Prep the make rarefaction plot command(s)
     try:
@@ -313,7 +328,8 @@ def run_alpha_rarefaction(otu_table_fp,
             'make_rarefaction_plots.py -i %s -m %s -o %s %s' %\
             (alpha_collated_dir, mapping_fp, rarefaction_plot_dir, params_str)
         commands.append(
-            [('Rarefaction plot: %s' % 'All metrics', make_rarefaction_plot_cmd)])
+            [('Rarefaction plot: %s' % 'All metrics', make_rarefaction_plot_cmd,
+              [alpha_collated_dir, mapping_fp], [rarefaction_plot_dir])])
     else:
         rarefaction_plot_dir_stddev = '%s/alpha_rarefaction_plots_stddev/' % output_dir
         rarefaction_plot_dir_stderr = '%s/alpha_rarefaction_plots_stderr/' % output_dir
@@ -327,13 +343,15 @@ def run_alpha_rarefaction(otu_table_fp,
             (alpha_collated_dir, mapping_fp, rarefaction_plot_dir_stddev,
              params_str)
         commands.append(
-            [('Rarefaction plot: %s' % 'All metrics', make_rarefaction_plot_cmd)])
+            [('Rarefaction plot: %s' % 'All metrics', make_rarefaction_plot_cmd,
+              [alpha_collated_dir, mapping_fp], [rarefaction_plot_dir_stddev])])
         make_rarefaction_plot_cmd =\
             'make_rarefaction_plots.py -i %s -m %s -o %s %s --std_type stderr' %\
             (alpha_collated_dir, mapping_fp, rarefaction_plot_dir_stderr,
              params_str)
         commands.append(
-            [('Rarefaction plot: %s' % 'All metrics', make_rarefaction_plot_cmd)])
+            [('Rarefaction plot: %s' % 'All metrics', make_rarefaction_plot_cmd,
+              [alpha_collated_dir, mapping_fp], [rarefaction_plot_dir_stderr])])
 
     # Call the command handler on the list of commands
     command_handler(commands,
@@ -12,6 +12,7 @@ __email__ = "gregcaporaso@gmail.com"
 
 from os.path import split, splitext, getsize, exists, abspath, join
 from shutil import copyfile, rmtree
+from functools import partial
 from numpy import inf
 from copy import deepcopy
 from skbio.util import create_dir, remove_files
@@ -376,12 +377,22 @@ def iterative_pick_subsampled_open_reference_otus(
         denovo_otu_picking_method='uclust',
         reference_otu_picking_method='uclust_ref',
         status_update_callback=print_to_stdout,
-        minimum_failure_threshold=100000):
+        minimum_failure_threshold=100000,
+        checkpoints=None):
     """ Call the pick_subsampled_open_reference_otus workflow on multiple inputs
          and handle processing of the results.
+
+        checkpoints is used as in pick_subsampled_open_reference_otus. When
+         resuming, the partial output of an iteration is kept so that the
+         iteration resumes at its first incomplete step.
     """
     create_dir(output_dir)
     commands = []
+    if checkpoints is not None:
+        command_handler = partial(command_handler, step_cache=checkpoints)
+        remove_partial_output = not checkpoints.resume
+    else:
+        remove_partial_output = True
 
     if logger is None:
         logger = WorkflowLogger(generate_log_fp(output_dir),
@@ -402,7 +413,8 @@ def iterative_pick_subsampled_open_reference_otus(
     repset_fasta_fps = []
     for i, input_fp in enumerate(input_fps):
         iteration_output_dir = '%s/%d/' % (output_dir, i)
-        if iteration_output_exists(iteration_output_dir, min_otu_size):
+        if iteration_output_exists(iteration_output_dir, min_otu_size,
+                                   remove_partial_output):
             # if the output from an iteration already exists, skip that
             # iteration (useful for continuing failed runs)
             log_input_md5s(logger, [input_fp, refseqs_fp])
@@ -433,7 +445,8 @@ def iterative_pick_subsampled_open_reference_otus(
                                                 denovo_otu_picking_method=denovo_otu_picking_method,
                                                 reference_otu_picking_method=reference_otu_picking_method,
                                                 status_update_callback=status_update_callback,
-                                                minimum_failure_threshold=minimum_failure_threshold)
+                                                minimum_failure_threshold=minimum_failure_threshold,
+                                                checkpoints=checkpoints)
         # perform post-iteration file shuffling whether the previous iteration's
         # data previously existed or was just computed.
         # step1 otu map and failures can only be used for the first iteration
@@ -454,7 +467,8 @@ def iterative_pick_subsampled_open_reference_otus(
     if not (exists(otu_table_fp) and getsize(otu_table_fp) > 0):
         merge_cmd = 'merge_otu_tables.py -i %s -o %s' %\
             (','.join(otu_table_fps), otu_table_fp)
-        commands.append([("Merge OTU tables", merge_cmd)])
+        commands.append([("Merge OTU tables", merge_cmd, otu_table_fps,
+                          [otu_table_fp])])
 
     # Build master rep set
     final_repset_fp = '%s/rep_set.fna' % output_dir
@@ -576,7 +590,8 @@ def pick_subsampled_open_reference_otus(input_fp,
                                         denovo_otu_picking_method='uclust',
                                         reference_otu_picking_method='uclust_ref',
                                         status_update_callback=print_to_stdout,
-                                        minimum_failure_threshold=100000):
+                                        minimum_failure_threshold=100000,
+                                        checkpoints=None):
     """ Run the data preparation steps of Qiime
 
         The steps performed by this function are:
@@ -587,6 +602,10 @@ def pick_subsampled_open_reference_otus(input_fp,
           - Pick reference OTUs on all failures using the
              representative set from step 4 as the reference set.
 
+        If checkpoints (a qiime.workflow.util.WorkflowCheckpoints) is
+         passed, the completed OTU picking steps are recorded in it, and
+         when resuming a run, steps which completed in the previous run are
+         not run again.
     """
     # for now only allowing uclust/usearch/sortmerna+sumaclust for otu picking
     allowed_denovo_otu_picking_methods = ['uclust', 'usearch61', 'sumaclust']
@@ -602,6 +621,9 @@ def pick_subsampled_open_reference_otus(input_fp,
         % (reference_otu_picking_method,
            ','.join(allowed_reference_otu_picking_methods))
 
+    if checkpoints is not None:
+        command_handler = partial(command_handler, step_cache=checkpoints)
+
     # Prepare some variables for the later steps
     index_links = []
     input_dir, input_filename = split(input_fp)
@@ -647,18 +669,24 @@ def pick_subsampled_open_reference_otus(input_fp,
             prefilter_dir = '%s/prefilter_otus/' % output_dir
             prefilter_failures_list_fp = '%s/%s_failures.txt' % \
                 (prefilter_dir, input_basename)
+            prefilter_otu_map_fp = '%s/%s_otus.txt' % \
+                (prefilter_dir, input_basename)
             prefilter_pick_otu_cmd = pick_reference_otus(
                 input_fp, prefilter_dir, reference_otu_picking_method,
                 prefilter_refseqs_fp, parallel, params, logger, prefilter_percent_id)
             commands.append(
-                [('Pick Reference OTUs (prefilter)', prefilter_pick_otu_cmd)])
+                [('Pick Reference OTUs (prefilter)', prefilter_pick_otu_cmd,
+                  [input_fp, prefilter_refseqs_fp],
+                  [prefilter_otu_map_fp, prefilter_failures_list_fp])])
 
             prefiltered_input_fp = '%s/prefiltered_%s%s' %\
                 (prefilter_dir, input_basename, input_ext)
             filter_fasta_cmd = 'filter_fasta.py -f %s -o %s -s %s -n' %\
                 (input_fp, prefiltered_input_fp, prefilter_failures_list_fp)
             commands.append(
-                [('Filter prefilter failures from input', filter_fasta_cmd)])
+                [('Filter prefilter failures from input', filter_fasta_cmd,
+                  [input_fp, prefilter_failures_list_fp],
+                  [prefiltered_input_fp])])
             index_links.append(
             ('Pre-filtered sequence identifiers '
              '(failed to hit reference at %1.1f%% identity)' % (float(prefilter_percent_id)*100),
@@ -693,18 +721,22 @@ def pick_subsampled_open_reference_otus(input_fp,
         step1_pick_otu_cmd = pick_reference_otus(
             input_fp, step1_dir, reference_otu_picking_method,
             refseqs_fp, parallel, params, logger)
-        commands.append([('Pick Reference OTUs', step1_pick_otu_cmd)])
-
-        # Build the failures fasta file
         step1_failures_list_fp = '%s/%s_failures.txt' % \
             (step1_dir, input_basename)
+        commands.append([('Pick Reference OTUs', step1_pick_otu_cmd,
+                          [input_fp, refseqs_fp],
+                          [step1_otu_map_fp, step1_failures_list_fp])])
+
+        # Build the failures fasta file
         step1_failures_fasta_fp = \
             '%s/failures.fasta' % step1_dir
         step1_filter_fasta_cmd = 'filter_fasta.py -f %s -s %s -o %s' %\
             (input_fp, step1_failures_list_fp, step1_failures_fasta_fp)
 
         commands.append([('Generate full failures fasta file',
-                          step1_filter_fasta_cmd)])
+                          step1_filter_fasta_cmd,
+                          [input_fp, step1_failures_list_fp],
+                          [step1_failures_fasta_fp])])
 
         # Call the command handler on the list of commands
         command_handler(commands,
@@ -717,7 +749,8 @@ def pick_subsampled_open_reference_otus(input_fp,
         '%s/step1_rep_set.fna' % step1_dir
     step1_pick_rep_set_cmd = 'pick_rep_set.py -i %s -o %s -f %s' %\
         (step1_otu_map_fp, step1_repset_fasta_fp, input_fp)
-    commands.append([('Pick rep set', step1_pick_rep_set_cmd)])
+    commands.append([('Pick rep set', step1_pick_rep_set_cmd,
+                      [step1_otu_map_fp, input_fp], [step1_repset_fasta_fp])])
 
     # Call the command handler on the list of commands
     command_handler(commands,
@@ -744,9 +777,19 @@ def pick_subsampled_open_reference_otus(input_fp,
         create_dir(step2_dir)
         step2_input_fasta_fp = \
                                '%s/subsampled_failures.fasta' % step2_dir
-        subsample_fasta(step1_failures_fasta_fp,
-                        step2_input_fasta_fp,
-                        percent_subsample)
+        # the subsample is random, so it must not be redrawn when resuming,
+        # or none of the later steps could be skipped
+        subsample_step = ('Subsample the failures fasta file',
+                          'subsample_fasta %s %s %f' %
+                          (step1_failures_fasta_fp, step2_input_fasta_fp,
+                           percent_subsample),
+                          [step1_failures_fasta_fp], [step2_input_fasta_fp])
+        if checkpoints is None or not checkpoints.is_complete(subsample_step):
+            subsample_fasta(step1_failures_fasta_fp,
+                            step2_input_fasta_fp,
+                            percent_subsample)
+            if checkpoints is not None:
+                checkpoints.mark_complete(subsample_step)
 
         logger.write('# Subsample the failures fasta file using API \n' +
                  'python -c "import qiime; qiime.util.subsample_fasta' +
@@ -764,14 +807,17 @@ def pick_subsampled_open_reference_otus(input_fp,
                                      logger)
         step2_otu_map_fp = '%s/subsampled_failures_otus.txt' % step2_dir
 
-        commands.append([('Pick de novo OTUs for new clusters', step2_cmd)])
+        commands.append([('Pick de novo OTUs for new clusters', step2_cmd,
+                          [step2_input_fasta_fp], [step2_otu_map_fp])])
 
         # Prep the rep set picking command for the subsampled failures
         step2_repset_fasta_fp = '%s/step2_rep_set.fna' % step2_dir
         step2_rep_set_cmd = 'pick_rep_set.py -i %s -o %s -f %s' %\
             (step2_otu_map_fp, step2_repset_fasta_fp, step2_input_fasta_fp)
         commands.append(
-            [('Pick representative set for subsampled failures', step2_rep_set_cmd)])
+            [('Pick representative set for subsampled failures',
+              step2_rep_set_cmd, [step2_otu_map_fp, step2_input_fasta_fp],
+              [step2_repset_fasta_fp])])
 
         step3_dir = '%s/step3_otus/' % output_dir
         step3_otu_map_fp = '%s/failures_otus.txt' % step3_dir
@@ -794,7 +840,9 @@ def pick_subsampled_open_reference_otus(input_fp,
             logger)
 
         commands.append([
-            ('Pick reference OTUs using de novo rep set', step3_cmd)])
+            ('Pick reference OTUs using de novo rep set', step3_cmd,
+             [step1_failures_fasta_fp, step2_repset_fasta_fp],
+             [step3_otu_map_fp, step3_failures_list_fp])])
 
         index_links.append(
             ('Final map of OTU identifier to sequence identifers (i.e., "OTU map")',
@@ -809,7 +857,9 @@ def pick_subsampled_open_reference_otus(input_fp,
                 (step1_failures_fasta_fp,
                  step3_failures_list_fp, step3_failures_fasta_fp)
             commands.append([('Create fasta file of step3 failures',
-                            step3_filter_fasta_cmd)])
+                              step3_filter_fasta_cmd,
+                              [step1_failures_fasta_fp, step3_failures_list_fp],
+                              [step3_failures_fasta_fp])])
 
             failures_fp = step3_failures_fasta_fp
             failures_otus_fp = 'failures_failures_otus.txt'
@@ -828,7 +878,8 @@ def pick_subsampled_open_reference_otus(input_fp,
                                      logger)
 
         step4_otu_map_fp = '%s/%s' % (step4_dir, failures_otus_fp)
-        commands.append([('Pick de novo OTUs on %s failures' % failures_step, step4_cmd)])
+        commands.append([('Pick de novo OTUs on %s failures' % failures_step,
+                          step4_cmd, [failures_fp], [step4_otu_map_fp])])
 
         # Merge the otu maps, note that we are explicitly using the '>' operator
         # otherwise passing the --force flag on the script interface would
@@ -836,12 +887,17 @@ def pick_subsampled_open_reference_otus(input_fp,
         cat_otu_tables_cmd = 'cat %s %s %s > %s' %\
             (step1_otu_map_fp, step3_otu_map_fp,
              step4_otu_map_fp, merged_otu_map_fp)
-        commands.append([('Merge OTU maps', cat_otu_tables_cmd)])
+        commands.append([('Merge OTU maps', cat_otu_tables_cmd,
+                          [fp for fp in [step1_otu_map_fp, step3_otu_map_fp,
+                                         step4_otu_map_fp] if fp],
+                          [merged_otu_map_fp])])
         step4_repset_fasta_fp = '%s/step4_rep_set.fna' % step4_dir
         step4_rep_set_cmd = 'pick_rep_set.py -i %s -o %s -f %s' %\
             (step4_otu_map_fp, step4_repset_fasta_fp, failures_fp)
         commands.append(
-            [('Pick representative set for subsampled failures', step4_rep_set_cmd)])
+            [('Pick representative set for subsampled failures',
+              step4_rep_set_cmd, [step4_otu_map_fp, failures_fp],
+              [step4_repset_fasta_fp])])
     else:
         # Merge the otu maps, note that we are explicitly using the '>' operator
         # otherwise passing the --force flag on the script interface would
@@ -854,11 +910,18 @@ def pick_subsampled_open_reference_otus(input_fp,
 
         cat_otu_tables_cmd = 'cat %s %s > %s' %\
             (step1_otu_map_fp, step3_otu_map_fp, merged_otu_map_fp)
-        commands.append([('Merge OTU maps', cat_otu_tables_cmd)])
-
-        # Move the step 3 failures file to the top-level directory
-        commands.append([('Move final failures file to top-level directory',
-                          'mv %s %s/final_failures.txt' % (failures_fp, output_dir))])
+        commands.append([('Merge OTU maps', cat_otu_tables_cmd,
+                          [fp for fp in [step1_otu_map_fp, step3_otu_map_fp]
+                           if fp],
+                          [merged_otu_map_fp])])
+
+        # Copy the step 3 failures file to the top-level directory (it's
+        # copied rather than moved, as it's also a checkpointed output of
+        # the step that wrote it)
+        final_failures_fp = '%s/final_failures.txt' % output_dir
+        commands.append([('Copy final failures file to top-level directory',
+                          'cp %s %s' % (failures_fp, final_failures_fp),
+                          [failures_fp], [final_failures_fp])])
 
     command_handler(commands,
                     status_update_callback,
@@ -955,7 +1018,8 @@ def pick_subsampled_open_reference_otus(input_fp,
 
     make_otu_table_cmd = 'make_otu_table.py -i %s -o %s' %\
         (otu_no_singletons_fp, otu_table_fp)
-    commands.append([("Make the otu table", make_otu_table_cmd)])
+    commands.append([("Make the otu table", make_otu_table_cmd,
+                      [otu_no_singletons_fp], [otu_table_fp])])
     index_links.append(
         ('OTU table exluding OTUs with fewer than %d sequences' % min_otu_size,
          otu_table_fp,
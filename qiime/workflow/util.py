@@ -13,11 +13,30 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 import sys
-from os.path import join
+import re
+import atexit
+import gc
+from os import (listdir, remove, rename, utime, walk, fork, waitpid, dup2,
+                _exit, WIFSIGNALED, WTERMSIG, WEXITSTATUS)
+from os.path import (join, normpath, exists, isdir, getsize, getmtime,
+                     islink, dirname)
+from shutil import copy2, copytree, rmtree
+from hashlib import md5
 from datetime import datetime
+from functools import partial
+from importlib import import_module
+from runpy import run_path
+from shlex import split as shlex_split
+from tempfile import TemporaryFile
+from traceback import print_exc
+from threading import Thread, Lock
+from Queue import Queue
 from cogent.util.misc import safe_md5
+from skbio.util import create_dir
 from qiime.util import (qiime_system_call,
-                        get_qiime_library_version)
+                        get_qiime_library_version,
+                        get_qiime_scripts_dir,
+                        ScriptsDirError)
 
 
 def generate_log_fp(output_dir,
@@ -98,43 +117,622 @@ def print_commands(commands,
         for e in c:
             status_update_callback('#%s' % e[0])
             print '%s' % e[1]
-            logger.write('# %s command\n%s\n\n' % e)
+            logger.write('# %s command\n%s\n\n' % e[:2])
+
+
+# modules imported by most QIIME scripts, which are imported before the
+# first script is run in process so that each script doesn't import them
+_in_process_preimports = ['numpy', 'scipy.stats', 'biom', 'skbio', 'cogent',
+                          'matplotlib', 'qiime.parse', 'qiime.format',
+                          'qiime.util']
+# held by qiime_script_call while forking, and by call_commands_concurrently
+# while writing output
+_fork_lock = Lock()
+# commands containing any of these are run by the shell
+_shell_syntax = re.compile(r'[;&|<>`$*?(){}~\\\n]')
+
+
+def get_in_process_script_fp(command):
+    """Return the filepath of the QIIME script command runs, if it can be run
+    in process, and None otherwise
+
+        Commands can be run in process if they run one of the QIIME scripts
+         and don't use any shell syntax (e.g., pipes, redirection or
+         variables).
+    """
+    if _shell_syntax.search(command):
+        return None
+    try:
+        args = shlex_split(command)
+    except ValueError:
+        return None
+    if not args or '/' in args[0] or not args[0].endswith('.py'):
+        return None
+    try:
+        script_fp = join(get_qiime_scripts_dir(), args[0])
+    except ScriptsDirError:
+        return None
+    if not exists(script_fp):
+        return None
+    return script_fp
+
+
+def qiime_script_call(command):
+    """Run command, running QIIME scripts in process where possible
+
+        QIIME scripts (see get_in_process_script_fp) are run in a child
+         process forked from this one, so they don't pay the cost of
+         starting python and importing the modules which this process has
+         already imported. Other commands are run with qiime_system_call.
+         Returns stdout, stderr and the return value, as qiime_system_call
+         does. Forks are serialized with _fork_lock, which code writing
+         output while other threads may call this function (e.g.,
+         call_commands_concurrently) should also hold.
+    """
+    script_fp = get_in_process_script_fp(command)
+    if script_fp is None:
+        return qiime_system_call(command)
+
+    for module_name in _in_process_preimports:
+        try:
+            import_module(module_name)
+        except ImportError:
+            pass
+    args = shlex_split(command)[1:]
+
+    stdout_f = TemporaryFile()
+    stderr_f = TemporaryFile()
+    # Commands may be run by several threads at once (see
+    # call_commands_concurrently). Forking with _fork_lock held ensures that
+    # no other thread is forking or writing output, so the child doesn't
+    # inherit a lock held by another thread, and flushing under the lock
+    # ensures that buffered output isn't written by the child too.
+    with _fork_lock:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = fork()
+    if pid == 0:
+        return_value = 1
+        # only the exit functions that the script registers are run
+        del atexit._exithandlers[:]
+        try:
+            dup2(stdout_f.fileno(), 1)
+            dup2(stderr_f.fileno(), 2)
+            sys.argv = [script_fp] + args
+            run_path(script_fp, run_name='__main__')
+            return_value = 0
+        except SystemExit as e:
+            if e.code is None:
+                return_value = 0
+            elif isinstance(e.code, int):
+                return_value = e.code
+            else:
+                sys.stderr.write('%s\n' % e.code)
+        except:
+            print_exc()
+        finally:
+            # _exit skips the interpreter's clean up, so it is done here:
+            # the script's exit functions are run, and then releasing the
+            # traceback frees the script's objects (closing files it left
+            # open).
+            try:
+                atexit._run_exitfuncs()
+            except:
+                # the error has already been written to stderr
+                pass
+            sys.exc_clear()
+            gc.collect()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            # exit statuses are a single byte
+            if not 0 <= return_value < 256:
+                return_value = 1
+            _exit(return_value)
+
+    status = waitpid(pid, 0)[1]
+    if WIFSIGNALED(status):
+        return_value = -WTERMSIG(status)
+    else:
+        return_value = WEXITSTATUS(status)
+    stdout_f.seek(0)
+    stderr_f.seek(0)
+    stdout = stdout_f.read()
+    stderr = stderr_f.read()
+    stdout_f.close()
+    stderr_f.close()
+    return stdout, stderr, return_value
 
 
 def call_commands_serially(commands,
                            status_update_callback,
                            logger,
-                           close_logger_on_success=True):
-    """Run list of commands, one after another """
+                           close_logger_on_success=True,
+                           step_cache=None,
+                           in_process=False):
+    """Run list of commands, one after another
+
+        If step_cache (a WorkflowStepCache) is passed, the outputs of
+         commands which were run before with the same inputs are restored
+         from it rather than running the commands again. If in_process is
+         True, QIIME scripts are run in process (see qiime_script_call).
+    """
+    if in_process:
+        system_call_f = qiime_script_call
+    else:
+        system_call_f = qiime_system_call
     logger.write("Executing commands.\n\n")
     for c in commands:
         for e in c:
-            status_update_callback('%s\n%s' % e)
-            logger.write('# %s command \n%s\n\n' % e)
-            stdout, stderr, return_value = qiime_system_call(e[1])
-            if return_value != 0:
-                msg = "\n\n*** ERROR RAISED DURING STEP: %s\n" % e[0] +\
-                    "Command run was:\n %s\n" % e[1] +\
-                    "Command returned exit status: %d\n" % return_value +\
-                    "Stdout:\n%s\nStderr\n%s\n" % (stdout, stderr)
-                logger.write(msg)
-                logger.close()
-                raise WorkflowError(msg)
-            # in the no error case, we write commands' output to the log
-            # and also echo to this proc's stdout/stderr
+            status_update_callback('%s\n%s' % e[:2])
+            logger.write('# %s command \n%s\n\n' % e[:2])
+            key = None
+            if step_cache is not None:
+                key = step_cache.get_key(e)
+                if key is not None and step_cache.restore(key, e):
+                    logger.write("%s\n\n" % step_cache.restored_message)
+                    continue
+            stdout, stderr, return_value = system_call_f(e[1])
+            _handle_command_result(e, stdout, stderr, return_value, logger)
+            if key is not None:
+                step_cache.store(key, e)
+    if close_logger_on_success:
+        logger.close()
+
+
+def _handle_command_result(e, stdout, stderr, return_value, logger):
+    """Log the result of command e, raising WorkflowError if it failed """
+    if return_value != 0:
+        msg = "\n\n*** ERROR RAISED DURING STEP: %s\n" % e[0] +\
+            "Command run was:\n %s\n" % e[1] +\
+            "Command returned exit status: %d\n" % return_value +\
+            "Stdout:\n%s\nStderr\n%s\n" % (stdout, stderr)
+        logger.write(msg)
+        logger.close()
+        raise WorkflowError(msg)
+    # in the no error case, we write commands' output to the log
+    # and also echo to this proc's stdout/stderr
+    else:
+        # write stdout and stderr to log file
+        logger.write("Stdout:\n%s\nStderr:\n%s\n" % (stdout, stderr))
+        # write stdout to stdout
+        if stdout:
+            print stdout
+        # write stderr to stderr
+        if stderr:
+            sys.stderr.write(stderr)
+
+
+def _paths_overlap(fp1, fp2):
+    """Return True if fp1 and fp2 are the same path, or one contains the other
+    """
+    fp1 = normpath(fp1)
+    fp2 = normpath(fp2)
+    return fp1 == fp2 or fp1.startswith(fp2 + '/') or \
+        fp2.startswith(fp1 + '/')
+
+
+def get_command_dependencies(commands):
+    """Return the flattened commands and the indices each one depends on
+
+        Each command is a (description, command) tuple, or a
+         (description, command, input_fps, output_fps) tuple declaring the
+         files (or directories) which the command reads and writes. A
+         command depends on the previous command in its list of commands,
+         on earlier commands which write its inputs or outputs, and on
+         earlier commands which read its outputs. Commands which don't
+         declare their inputs and outputs depend on all earlier commands,
+         and all later commands depend on them.
+    """
+    flat_commands = []
+    dependencies = []
+    last_barrier = None
+    for c in commands:
+        for j, e in enumerate(c):
+            i = len(flat_commands)
+            deps = set()
+            if j > 0:
+                deps.add(i - 1)
+            if len(e) < 4:
+                deps.update(range(i))
+                last_barrier = i
             else:
-                # write stdout and stderr to log file
-                logger.write("Stdout:\n%s\nStderr:\n%s\n" % (stdout, stderr))
-                # write stdout to stdout
-                if stdout:
-                    print stdout
-                # write stderr to stderr
-                if stderr:
-                    sys.stderr.write(stderr)
+                if last_barrier is not None:
+                    deps.add(last_barrier)
+                input_fps, output_fps = e[2], e[3]
+                for k, prev_e in enumerate(flat_commands):
+                    if len(prev_e) < 4:
+                        continue
+                    prev_input_fps, prev_output_fps = prev_e[2], prev_e[3]
+                    for fp in output_fps:
+                        if [prev_fp for prev_fp in
+                                list(prev_input_fps) + list(prev_output_fps)
+                                if _paths_overlap(fp, prev_fp)]:
+                            deps.add(k)
+                    for fp in input_fps:
+                        if [prev_fp for prev_fp in prev_output_fps
+                                if _paths_overlap(fp, prev_fp)]:
+                            deps.add(k)
+            flat_commands.append(e)
+            dependencies.append(deps)
+    return flat_commands, dependencies
+
+
+def call_commands_concurrently(commands,
+                               status_update_callback,
+                               logger,
+                               close_logger_on_success=True,
+                               max_concurrent_jobs=2,
+                               step_cache=None,
+                               in_process=False):
+    """Run list of commands, running independent commands at the same time
+
+        Up to max_concurrent_jobs commands are run at once, as soon as the
+         commands they depend on have completed (see
+         get_command_dependencies). Each command's output is logged when it
+         completes. If a command fails, no more commands are started, and
+         WorkflowError is raised once the running commands have completed.
+         step_cache and in_process are used as in call_commands_serially.
+    """
+    if in_process:
+        system_call_f = qiime_script_call
+    else:
+        system_call_f = qiime_system_call
+    logger.write("Executing commands.\n\n")
+    flat_commands, dependencies = get_command_dependencies(commands)
+    keys = [None] * len(flat_commands)
+    results = Queue()
+
+    def run_command(i):
+        # always put a result on the queue, or the main loop would wait for
+        # it forever
+        try:
+            result = system_call_f(flat_commands[i][1])
+        except Exception as e:
+            result = e
+        results.put((i, result))
+
+    pending = range(len(flat_commands))
+    completed = set()
+    num_running = 0
+    failure = None
+    # output is written with _fork_lock held (see qiime_script_call)
+    _fork_lock.acquire()
+    try:
+        while num_running > 0 or (pending and failure is None):
+            ready = failure is None
+            while ready:
+                ready = False
+                for i in [i for i in pending if dependencies[i] <= completed]:
+                    e = flat_commands[i]
+                    if step_cache is not None:
+                        keys[i] = step_cache.get_key(e)
+                        if (keys[i] is not None and
+                                step_cache.restore(keys[i], e)):
+                            status_update_callback('%s\n%s' % e[:2])
+                            logger.write('# %s command \n%s\n\n' % e[:2])
+                            logger.write("%s\n\n" %
+                                         step_cache.restored_message)
+                            pending.remove(i)
+                            completed.add(i)
+                            # commands depending on this one may now be ready
+                            ready = True
+                            continue
+                    if num_running >= max_concurrent_jobs:
+                        break
+                    status_update_callback('%s\n%s' % e[:2])
+                    pending.remove(i)
+                    num_running += 1
+                    Thread(target=run_command, args=(i,)).start()
+            if num_running == 0:
+                continue
+            # let the running commands fork while waiting for one of them
+            _fork_lock.release()
+            try:
+                i, result = results.get()
+            finally:
+                _fork_lock.acquire()
+            num_running -= 1
+            if isinstance(result, Exception) or result[2] != 0:
+                if failure is None:
+                    failure = (i, result)
+                continue
+            stdout, stderr, return_value = result
+            logger.write('# %s command \n%s\n\n' % flat_commands[i][:2])
+            _handle_command_result(flat_commands[i], stdout, stderr,
+                                   return_value, logger)
+            if keys[i] is not None:
+                step_cache.store(keys[i], flat_commands[i])
+            completed.add(i)
+    finally:
+        _fork_lock.release()
+
+    if failure is not None:
+        i, result = failure
+        e = flat_commands[i]
+        logger.write('# %s command \n%s\n\n' % e[:2])
+        if isinstance(result, Exception):
+            msg = "\n\n*** ERROR RAISED DURING STEP: %s\n" % e[0] +\
+                "Command run was:\n %s\n" % e[1] +\
+                "Command could not be run: %s: %s\n" % (
+                    result.__class__.__name__, result)
+            logger.write(msg)
+            logger.close()
+            raise WorkflowError(msg)
+        stdout, stderr, return_value = result
+        _handle_command_result(e, stdout, stderr, return_value, logger)
     if close_logger_on_success:
         logger.close()
 
 
+def _get_path_size(fp):
+    """Return the size of fp in bytes, including everything under it """
+    if not isdir(fp):
+        return getsize(fp)
+    result = 0
+    for dirpath, dirnames, filenames in walk(fp):
+        for filename in filenames:
+            result += getsize(join(dirpath, filename))
+    return result
+
+
+class WorkflowStepCache(object):
+
+    """Cache of the outputs of workflow commands, keyed on their inputs
+
+        Commands which declare their inputs and outputs (see
+         get_command_dependencies) are keyed on the command (with the
+         declared filepaths replaced, so the same command writing to a
+         different output directory has the same key), the md5 sums of the
+         contents of the input files and the QIIME version. Outputs are
+         stored under cache_dir, and the least recently used entries are
+         removed when the cache is larger than max_size bytes. If force is
+         True, outputs are never restored, but are still stored.
+    """
+
+    restored_message = "Restored output from step cache."
+
+    def __init__(self, cache_dir, max_size=10 * 1024 ** 3, force=False):
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._force = force
+        # md5 sums of input files, keyed on their path, size and
+        # modification time, so files which are the input to several
+        # commands are only read once
+        self._md5s = {}
+        create_dir(cache_dir)
+
+    def _get_md5(self, fp):
+        """Return the md5 sum of fp's contents, or of everything under it """
+        if isdir(fp):
+            result = md5()
+            for dirpath, dirnames, filenames in walk(fp):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    file_fp = join(dirpath, filename)
+                    result.update(file_fp[len(fp):])
+                    result.update(self._get_md5(file_fp))
+            return result.hexdigest()
+        stat_key = (fp, getsize(fp), getmtime(fp))
+        if stat_key not in self._md5s:
+            self._md5s[stat_key] = safe_md5(open(fp, 'rb')).hexdigest()
+        return self._md5s[stat_key]
+
+    def get_key(self, e):
+        """Return the key of command e, or None if it can't be cached
+
+            Commands which don't declare any outputs, or whose inputs don't
+             exist, aren't cached.
+        """
+        if len(e) < 4 or not e[3]:
+            return None
+        input_fps = [normpath(fp) for fp in e[2]]
+        output_fps = [normpath(fp) for fp in e[3]]
+        if not all(map(exists, input_fps)):
+            return None
+        command = e[1]
+        # replace the longest paths first, so paths which contain others
+        # are replaced whole
+        placeholders = []
+        for fps, label in [(e[2], 'input'), (e[3], 'output')]:
+            for i, fp in enumerate(fps):
+                placeholder = '<%s %d>' % (label, i)
+                placeholders.append((fp, placeholder))
+                placeholders.append((normpath(fp), placeholder))
+        # commands are often passed the directory to write their outputs to
+        for i, fp in enumerate(output_fps):
+            output_dir = dirname(fp)
+            if output_dir:
+                placeholder = '<output %d dir>' % i
+                placeholders.append((output_dir + '/', placeholder))
+                placeholders.append((output_dir, placeholder))
+        for fp, placeholder in sorted(placeholders,
+                                      key=lambda p: len(p[0]),
+                                      reverse=True):
+            command = command.replace(fp, placeholder)
+        key = md5(get_qiime_library_version())
+        key.update(command)
+        for fp in input_fps:
+            key.update(self._get_md5(fp))
+        return key.hexdigest()
+
+    def restore(self, key, e):
+        """Restore the outputs of command e, returning False on a cache miss
+        """
+        entry_dir = join(self._cache_dir, key)
+        if self._force or not exists(entry_dir):
+            return False
+        for i, fp in enumerate(e[3]):
+            fp = normpath(fp)
+            cached_fp = join(entry_dir, str(i))
+            if isdir(fp) and not islink(fp):
+                rmtree(fp)
+            elif exists(fp):
+                remove(fp)
+            # outputs which didn't exist after the command was run (e.g.,
+            # files it moved or removed) aren't stored
+            if exists(cached_fp) and dirname(fp):
+                create_dir(dirname(fp))
+            if isdir(cached_fp):
+                copytree(cached_fp, fp)
+            elif exists(cached_fp):
+                copy2(cached_fp, fp)
+        # mark the entry as recently used
+        utime(entry_dir, None)
+        return True
+
+    def store(self, key, e):
+        """Store the outputs of command e, which was just run """
+        entry_dir = join(self._cache_dir, key)
+        if exists(entry_dir):
+            rmtree(entry_dir)
+        # copy the outputs to a temporary directory first, so an
+        # interrupted copy doesn't leave an incomplete entry
+        tmp_entry_dir = entry_dir + '.tmp'
+        if exists(tmp_entry_dir):
+            rmtree(tmp_entry_dir)
+        create_dir(tmp_entry_dir)
+        for i, fp in enumerate(e[3]):
+            fp = normpath(fp)
+            cached_fp = join(tmp_entry_dir, str(i))
+            if isdir(fp):
+                copytree(fp, cached_fp)
+            elif exists(fp):
+                copy2(fp, cached_fp)
+        rename(tmp_entry_dir, entry_dir)
+        self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entries until under max_size """
+        entries = []
+        for key in listdir(self._cache_dir):
+            entry_dir = join(self._cache_dir, key)
+            if key.endswith('.tmp') or not isdir(entry_dir):
+                continue
+            entries.append((getmtime(entry_dir), _get_path_size(entry_dir),
+                            entry_dir))
+        entries.sort()
+        total_size = sum([size for mtime, size, entry_dir in entries])
+        for mtime, size, entry_dir in entries:
+            if total_size <= self._max_size:
+                break
+            rmtree(entry_dir)
+            total_size -= size
+
+
+class WorkflowCheckpoints(WorkflowStepCache):
+
+    """Record of the workflow commands completed in an output directory
+
+        This is used like a WorkflowStepCache, but rather than copying the
+         outputs of commands, it records the md5 sums of their (declared)
+         inputs and outputs in a manifest file. If resume is True, commands
+         recorded in the manifest are not run again, provided that their
+         outputs are unchanged and that their inputs are unchanged or have
+         been removed (e.g., moved by the command itself). Commands are keyed
+         on the command alone, as the manifest belongs to one output
+         directory.
+    """
+
+    restored_message = "Completed in a previous run. Skipping."
+
+    def __init__(self, manifest_fp, resume=True):
+        self.manifest_fp = manifest_fp
+        self.resume = resume
+        self._md5s = {}
+        # maps keys to lists of (kind, filepath, md5) tuples, where kind is
+        # input or output
+        self._entries = {}
+        if resume and exists(manifest_fp):
+            for line in open(manifest_fp, 'U'):
+                if not line.strip() or line.startswith('#'):
+                    continue
+                key, kind, fp, md5_sum = line.rstrip('\n').split('\t')
+                self._entries.setdefault(key, []).append((kind, fp, md5_sum))
+
+    def get_key(self, e):
+        """Return the key of command e, or None if it can't be checkpointed
+        """
+        if len(e) < 4 or not e[3]:
+            return None
+        return md5(e[1]).hexdigest()
+
+    def restore(self, key, e):
+        """Return True if command e completed in a previous run """
+        if not self.resume or key not in self._entries:
+            return False
+        for kind, fp, md5_sum in self._entries[key]:
+            if kind == 'output':
+                if not exists(fp) or self._get_md5(fp) != md5_sum:
+                    return False
+            elif exists(fp) and self._get_md5(fp) != md5_sum:
+                return False
+        return True
+
+    def store(self, key, e):
+        """Record command e as completed, and rewrite the manifest """
+        entry = []
+        for kind, fps in [('input', e[2]), ('output', e[3])]:
+            for fp in fps:
+                fp = normpath(fp)
+                # outputs which the command didn't create aren't recorded
+                if exists(fp):
+                    entry.append((kind, fp, self._get_md5(fp)))
+        self._entries[key] = entry
+        # write to a temporary file first, so an interrupted write doesn't
+        # leave an incomplete manifest
+        tmp_manifest_fp = self.manifest_fp + '.tmp'
+        manifest_f = open(tmp_manifest_fp, 'w')
+        manifest_f.write('# QIIME workflow checkpoints: key, input or '
+                         'output, filepath, md5 sum\n')
+        for key in sorted(self._entries):
+            for kind, fp, md5_sum in self._entries[key]:
+                manifest_f.write('%s\t%s\t%s\t%s\n' % (key, kind, fp, md5_sum))
+        manifest_f.close()
+        rename(tmp_manifest_fp, self.manifest_fp)
+
+    def is_complete(self, e):
+        """Return True if step e, which isn't run as a command, completed in
+        a previous run"""
+        key = self.get_key(e)
+        return key is not None and self.restore(key, e)
+
+    def mark_complete(self, e):
+        """Record step e, which isn't run as a command, as completed """
+        key = self.get_key(e)
+        if key is not None:
+            self.store(key, e)
+
+
+def get_command_handler(opts, print_only=False):
+    """Return the command handler selected by a workflow script's options
+
+        opts must have the concurrent_jobs, in_process, step_cache_dir,
+         step_cache_max_size and rerun_cached_steps workflow options (see
+         qiime.util.get_options_lookup). If print_only is True, the commands
+         are only printed and the other options are ignored.
+    """
+    if print_only:
+        return print_commands
+
+    if opts.concurrent_jobs > 1:
+        command_handler = partial(call_commands_concurrently,
+                                  max_concurrent_jobs=opts.concurrent_jobs)
+    else:
+        command_handler = call_commands_serially
+
+    if opts.in_process:
+        command_handler = partial(command_handler, in_process=True)
+
+    if opts.step_cache_dir is not None:
+        step_cache = WorkflowStepCache(
+            opts.step_cache_dir,
+            max_size=int(opts.step_cache_max_size * 1024 ** 3),
+            force=opts.rerun_cached_steps)
+        command_handler = partial(command_handler, step_cache=step_cache)
+
+    return command_handler
+
+
 def print_to_stdout(s):
     print s
 
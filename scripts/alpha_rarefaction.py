@@ -15,8 +15,7 @@ from qiime.util import make_option
 from os import makedirs
 from qiime.util import load_qiime_config
 from qiime.parse import parse_qiime_parameters
-from qiime.workflow.util import (print_commands,
-                                 call_commands_serially,
+from qiime.workflow.util import (get_command_handler,
                                  print_to_stdout,
                                  no_status_updates,
                                  validate_and_set_jobs_to_start)
@@ -78,6 +77,11 @@ script_info['optional_options'] = [
                 help='the upper limit of rarefaction depths ' +
                 '[default: median sequence/sample count]'),
     options_lookup['jobs_to_start_workflow'],
+    options_lookup['concurrent_jobs_workflow'],
+    options_lookup['in_process_workflow'],
+    options_lookup['step_cache_dir_workflow'],
+    options_lookup['step_cache_max_size_workflow'],
+    options_lookup['rerun_cached_steps_workflow'],
     make_option('--retain_intermediate_files', action='store_true', help='retain '
                 'intermediate files: rarefied OTU tables (rarefaction) and alpha diversity '
                 'results (alpha_div). By default these will be erased [default: %default]',
@@ -133,10 +137,7 @@ def main():
             option_parser.error("Output directory already exists. Please choose"
                                 " a different directory, or force overwrite with -f.")
 
-    if print_only:
-        command_handler = print_commands
-    else:
-        command_handler = call_commands_serially
+    command_handler = get_command_handler(opts, print_only)
 
     if verbose:
         status_update_callback = print_to_stdout
@@ -99,6 +99,14 @@ script_info['optional_options'] = [
                 'Pass to skip this step if you\'re already passing a minimal tree.' +
                 ' Beware with "full_tree" metrics, as extra tips in the tree' +
                 ' change the result'),
+    make_option('-b', '--binary_output', action='store_true', default=False,
+                help='Write distance matrices in QIIME\'s binary distance' +
+                ' matrix format rather than as tab-separated text. Binary' +
+                ' distance matrices are much faster to write and read for' +
+                ' large numbers of samples, and are detected automatically' +
+                ' by scripts which read distance matrices. When --rows is' +
+                ' passed, the rows are written in a binary format which is' +
+                ' read by parallel_beta_diversity.py. [default: %default]'),
 ]
 script_info['option_label'] = {'input_path': 'OTU table filepath',
                                'rows': 'List of samples for compute',
@@ -106,6 +114,7 @@ script_info['option_label'] = {'input_path': 'OTU table filepath',
                                'show_metrics': 'Show metrics',
                                'tree_path': 'Newick tree filepath',
                                'full_tree': 'Tree already trimmed',
+                               'binary_output': 'Write binary output',
                                'output_dir': 'Output directory'}
 
 script_info['version'] = __version__
@@ -139,10 +148,12 @@ def main():
 
     if os.path.isdir(opts.input_path):
         multiple_file_beta(opts.input_path, opts.output_dir, opts.metrics,
-                           opts.tree_path, opts.rows, full_tree=opts.full_tree)
+                           opts.tree_path, opts.rows, full_tree=opts.full_tree,
+                           binary_output=opts.binary_output)
     elif os.path.isfile(opts.input_path):
         single_file_beta(opts.input_path, opts.metrics, opts.tree_path,
-                         opts.output_dir, opts.rows, full_tree=opts.full_tree)
+                         opts.output_dir, opts.rows, full_tree=opts.full_tree,
+                         binary_output=opts.binary_output)
     else:
         stderr.write("io error, input path not valid.  Does it exist?")
         exit(1)
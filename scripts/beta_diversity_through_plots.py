@@ -17,8 +17,7 @@ from os import makedirs
 from qiime.util import load_qiime_config, parse_command_line_parameters,\
     get_options_lookup
 from qiime.parse import parse_qiime_parameters
-from qiime.workflow.util import (print_commands,
-                                 call_commands_serially,
+from qiime.workflow.util import (get_command_handler,
                                  print_to_stdout,
                                  no_status_updates,
                                  validate_and_set_jobs_to_start)
@@ -82,7 +81,12 @@ script_info['optional_options'] = [
     make_option('--suppress_emperor_plots', action='store_true',
                 help='Do not generate emperor plots [default: %default]',
                 default=False),
-    options_lookup['jobs_to_start_workflow']]
+    options_lookup['jobs_to_start_workflow'],
+    options_lookup['concurrent_jobs_workflow'],
+    options_lookup['in_process_workflow'],
+    options_lookup['step_cache_dir_workflow'],
+    options_lookup['step_cache_max_size_workflow'],
+    options_lookup['rerun_cached_steps_workflow']]
 script_info['version'] = __version__
 
 
@@ -126,10 +130,7 @@ def main():
 
     create_dir(output_dir, fail_on_exist=not opts.force)
 
-    if print_only:
-        command_handler = print_commands
-    else:
-        command_handler = call_commands_serially
+    command_handler = get_command_handler(opts, print_only)
 
     if verbose:
         status_update_callback = print_to_stdout
@@ -17,12 +17,10 @@ from qiime.util import (load_qiime_config,
                         get_options_lookup,
                         create_dir)
 from qiime.parse import parse_qiime_parameters
-from qiime.workflow.util import (print_commands,
-                                 call_commands_serially,
+from qiime.workflow.util import (get_command_handler,
                                  print_to_stdout,
                                  no_status_updates,
-                                 validate_and_set_jobs_to_start,
-                                 print_commands)
+                                 validate_and_set_jobs_to_start)
 from qiime.workflow.core_diversity_analyses import run_core_diversity_analyses
 
 qiime_config = load_qiime_config()
@@ -112,7 +110,12 @@ script_info['optional_options'] = [
                 help='Don\'t fail if output directory exists, but attempt to recover ' +
                 'from the failed run. [default: %default]',
                 default=False),
-    options_lookup['jobs_to_start_workflow']
+    options_lookup['jobs_to_start_workflow'],
+    options_lookup['concurrent_jobs_workflow'],
+    options_lookup['in_process_workflow'],
+    options_lookup['step_cache_dir_workflow'],
+    options_lookup['step_cache_max_size_workflow'],
+    options_lookup['rerun_cached_steps_workflow']
 ]
 script_info['version'] = __version__
 
@@ -169,10 +172,7 @@ def main():
     # isn't trying to recover from a failed run, raise an error.
     create_dir(output_dir, fail_on_exist=not opts.recover_from_failure)
 
-    if print_only:
-        command_handler = print_commands
-    else:
-        command_handler = call_commands_serially
+    command_handler = get_command_handler(opts, print_only)
 
     if verbose:
         status_update_callback = print_to_stdout
@@ -209,6 +209,10 @@ script_info['script_usage'].append(
     ("Find which OTUs are differentially represented in the sample groups formed by 'before_after' based on bootstrapped T-testing with 100 permutations:",
      "",
      "%prog -i otu_table.biom -m map_overlapping.txt -c before_after -s nonparametric_t_test --permutations 100 -o btt_ocs.txt"))
+script_info['script_usage'].append(
+    ("Run the bootstrapped Mann-Whitney U test on the sample groups formed by 'before_after' using 4 processes. Passing a seed makes the results reproducible, whatever the number of processes:",
+     "",
+     "%prog -i otu_table.biom -m map_overlapping.txt -c before_after -s bootstrap_mann_whitney_u -O 4 --seed 42 -o bmwu_ocs.txt"))
 
 script_info['output_description'] = """
 This script generates a tab separated output file with the following headers:
@@ -257,13 +261,26 @@ script_info['optional_options'] = [
                 'Only their intersecting samples will be used for calculations.'),
     make_option('--print_non_overlap', action='store_true', default=False,
                 help='If this flag is passed the script will display the samples that' +
-                ' do not overlap between the mapping file and the biom file.')]
+                ' do not overlap between the mapping file and the biom file.'),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='number of processes to use. Blocks of observations are ' +
+                'tested in parallel on this machine, and the FDR and Bonferroni ' +
+                'corrections are applied once all blocks are complete ' +
+                '[default: %default]'),
+    make_option('--seed', type='int', default=None,
+                help='seed for the random number generator used by the ' +
+                'bootstrapped and nonparametric tests. Results for a given seed ' +
+                'are the same for any number of jobs [default: random]')]
 
 script_info['version'] = __version__
 
 
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
+
+    if opts.jobs_to_start < 1:
+        option_parser.error('--jobs_to_start must be at least 1. You passed '
+                            '%d' % opts.jobs_to_start)
     # sync the mapping file and the biom file
     tmp_bt = load_table(opts.otu_table_fp)
     tmp_pmf, _ = parse_mapping_file_to_dict(opts.mapping_fp)
@@ -323,7 +340,8 @@ def main():
     data_feed = group_significance_row_generator(bt, cat_sam_indices)
     test_stats, pvals, means = run_group_significance_test(
         data_feed, opts.test,
-        GROUP_TEST_CHOICES, int(opts.permutations))
+        GROUP_TEST_CHOICES, int(opts.permutations),
+        jobs_to_start=opts.jobs_to_start, seed=opts.seed)
 
     # calculate corrected pvals
     fdr_pvals = array(benjamini_hochberg_step_down(pvals))
@@ -83,7 +83,8 @@ def main():
         failures_f = None
 
     try:
-        result = map_otu_map_files(otu_files, failures_file=failures_f)
+        result = map_otu_map_files(otu_files, failures_file=failures_f,
+                                   compact=True)
     except KeyError as e:
         print ('Some keys do not map (' + str(e) + ') -- is the order of'
                ' your OTU maps equivalent to the order in which the OTU pickers'
@@ -96,7 +97,7 @@ def main():
         of.write('\n'.join(result))
         of.close()
     else:
-        write_otu_map(result.items(), output_fp)
+        write_otu_map(result.iteritems(), output_fp)
 
 
 if __name__ == "__main__":
@@ -17,7 +17,7 @@ from skbio.stats import subsample
 
 from qiime.util import parse_command_line_parameters, create_dir
 from qiime.util import make_option
-from qiime.rarefaction import RarefactionMaker
+from qiime.rarefaction import RarefactionMaker, BatchSubsampler
 
 script_info = {}
 script_info[
@@ -31,8 +31,13 @@ script_info['script_usage'].append(
      """Generate rarefied OTU tables beginning with 10 (-m) sequences/sample through 140 (-x) sequences per sample in steps of of 10 (-s), performing 2 iterations at each sampling depth (-n). All resulting OTU tables will be written to 'rarefied_otu_tables' (-o). Any sample containing fewer sequences in the input file than the requested number of sequences per sample is removed from the output rarefied otu table.""",
      """%prog -i otu_table.biom -m 10 -x 140 -s 10 -n 2 -o rarefied_otu_tables/"""))
 
+script_info['script_usage'].append(
+    ("""Compute collated alpha diversity without writing rarefied OTU tables:""",
+     """Rarefy as above, but compute the observed_otus and PD_whole_tree alpha diversity metrics (-a) on each rarefied OTU table in memory. One file per metric is written to 'alpha_div_collated' (-o) in the format of collate_alpha.py, and no rarefied OTU tables are written. Adding -b also writes a distance matrix for each rarefied OTU table to 'alpha_div_collated/beta_div/'.""",
+     """%prog -i otu_table.biom -m 10 -x 140 -s 10 -n 2 -a observed_otus,PD_whole_tree -t rep_set.tre -o alpha_div_collated/"""))
+
 script_info[
-    'output_description'] = """The result of multiple_rarefactions.py consists of a number of biom files, which depend on the minimum/maximum number of sequences per samples, steps and iterations. The files have the same otu table format as the input otu_table.biom, and are named in the following way: rarefaction_100_0.biom, where "100" corresponds to the sequences per sample and "0" the iteration."""
+    'output_description'] = """The result of multiple_rarefactions.py consists of a number of biom files, which depend on the minimum/maximum number of sequences per samples, steps and iterations. The files have the same otu table format as the input otu_table.biom, and are named in the following way: rarefaction_100_0.biom, where "100" corresponds to the sequences per sample and "0" the iteration. If alpha diversity metrics are passed with -a, the output directory instead contains one collated alpha diversity file per metric, in the format written by collate_alpha.py, and (if -b is passed) a beta_div directory containing one distance matrix per beta diversity metric and rarefied OTU table."""
 
 script_info['required_options'] = [
     make_option('-i', '--input_path',
@@ -65,7 +70,26 @@ script_info['optional_options'] = [
                 help='Retain OTUs of all zeros, which are usually omitted from' +
                 ' the output OTU tables. [default: %default]'),
     make_option('--subsample_multinomial', default=False, action='store_true',
-                help='subsample using subsampling with replacement [default: %default]')
+                help='subsample using subsampling with replacement [default: %default]'),
+    make_option('--batch_subsampling', default=False, action='store_true',
+                help='subsample all samples at once using vectorized draws.' +
+                ' This is faster than subsampling each sample in turn, and' +
+                ' gives rarefied counts with the same distribution, but' +
+                ' different counts for a given random seed' +
+                ' [default: %default]'),
+    make_option('-a', '--alpha_metrics', default=None, type='string',
+                help='Comma-separated list of alpha diversity metrics. If' +
+                ' passed, these metrics are computed on each rarefied OTU' +
+                ' table in memory and collated alpha diversity files are' +
+                ' written to the output directory instead of the rarefied' +
+                ' OTU tables [default: %default]'),
+    make_option('-b', '--beta_metrics', default=None, type='string',
+                help='Comma-separated list of beta diversity metrics to' +
+                ' compute on each rarefied OTU table in memory. Only used' +
+                ' with -a [default: %default]'),
+    make_option('-t', '--tree_path', default=None, type='existing_filepath',
+                help='Input newick tree filepath, required for' +
+                ' phylogenetic metrics. Only used with -a [default: %default]')
 ]
 
 script_info['option_label'] = {'input_path': 'OTU table filepath',
@@ -75,7 +99,10 @@ script_info['option_label'] = {'input_path': 'OTU table filepath',
                                'step': 'Step size',
                                'num_reps': '# of iterations',
                                'lineages_included': 'Include lineages',
-                               'keep_empty_otus': 'Retain empty OTUs'}
+                               'keep_empty_otus': 'Retain empty OTUs',
+                               'alpha_metrics': 'Alpha diversity metrics',
+                               'beta_metrics': 'Beta diversity metrics',
+                               'tree_path': 'Newick tree filepath'}
 
 script_info['version'] = __version__
 
@@ -86,15 +113,66 @@ def main():
     if opts.step <= 0:
         option_parser.error("step must be greater than 0")
 
+    if opts.beta_metrics and not opts.alpha_metrics:
+        option_parser.error("-b/--beta_metrics can only be used with "
+                            "-a/--alpha_metrics")
+
+    if opts.alpha_metrics:
+        # validate the metrics before rarefying, so that errors raised while
+        # computing diversity aren't reported as usage errors
+        from qiime.alpha_diversity import get_alpha_calcs
+        from qiime.beta_diversity import (get_nonphylogenetic_metric,
+                                          get_phylogenetic_metric,
+                                          list_known_metrics)
+        try:
+            alpha_calcs = get_alpha_calcs(opts.alpha_metrics)
+        except ValueError as e:
+            option_parser.error(str(e))
+        phylogenetic_metrics = [
+            metric for metric, calc in
+            zip(opts.alpha_metrics.split(','), alpha_calcs.Calcs)
+            if calc.IsPhylogenetic]
+        for metric in (opts.beta_metrics or '').split(','):
+            if not metric:
+                continue
+            try:
+                get_nonphylogenetic_metric(metric)
+            except AttributeError:
+                try:
+                    get_phylogenetic_metric(metric)
+                except AttributeError:
+                    option_parser.error(
+                        "Could not find beta diversity metric %s. Known "
+                        "metrics are: %s" %
+                        (metric, ', '.join(list_known_metrics())))
+                phylogenetic_metrics.append(metric)
+        if phylogenetic_metrics and not opts.tree_path:
+            option_parser.error("-t/--tree_path is required for the "
+                                "phylogenetic metrics: %s" %
+                                ', '.join(phylogenetic_metrics))
+
     create_dir(opts.output_path, fail_on_exist=False)
     maker = RarefactionMaker(opts.input_path, opts.min, opts.max,
                              opts.step, opts.num_reps)
 
-    if opts.subsample_multinomial:
+    if opts.batch_subsampling:
+        subsample_f = BatchSubsampler(replace=opts.subsample_multinomial)
+    elif opts.subsample_multinomial:
         subsample_f = partial(subsample, replace=True)
     else:
         subsample_f = subsample
 
+    if opts.alpha_metrics:
+        maker.rarefy_to_collated_alpha(
+            opts.output_path,
+            opts.alpha_metrics,
+            tree_path=opts.tree_path,
+            empty_otus_removed=(not opts.keep_empty_otus),
+            subsample_f=subsample_f,
+            beta_metrics=opts.beta_metrics,
+            beta_output_dir=os.path.join(opts.output_path, 'beta_div'))
+        return
+
     maker.rarefy_to_files(opts.output_path,
                           False,
                           include_lineages=opts.lineages_included,
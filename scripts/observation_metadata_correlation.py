@@ -13,10 +13,9 @@ __email__ = "wdwvt1@gmail.com"
 from qiime.util import (parse_command_line_parameters, make_option,
                         sync_biom_and_mf)
 from qiime.stats import (benjamini_hochberg_step_down, bonferroni_correction,
-                         assign_correlation_pval, correlate, pearson,
-                         spearman, kendall, cscore)
+                         pearson, spearman, kendall, cscore)
 from qiime.otu_significance import (correlate_output_formatter, sort_by_pval,
-                                    run_paired_t, is_computable_float)
+                                    run_correlation_test, is_computable_float)
 from qiime.parse import parse_mapping_file_to_dict
 from biom import load_table
 from numpy import array, where
@@ -118,6 +117,10 @@ script_info['script_usage'].append(
     ("Example 2:",
      "Calculate the correlation between OTUs in the table and the pH of the samples from whence they came using bootstrapping and pearson correlation:",
      "%prog -i otu_table.biom -m map.txt -c pH -s pearson --pval_assignment_method bootstrapped --permutations 100 -o pearson_bootstrapped.txt"))
+script_info['script_usage'].append(
+    ("Example 3:",
+     "As above, but spread the features over 4 processes. Passing --seed makes the bootstrapped p-values reproducible regardless of the number of processes:",
+     "%prog -i otu_table.biom -m map.txt -c pH -s pearson --pval_assignment_method bootstrapped --permutations 100 -O 4 --seed 42 -o pearson_bootstrapped_O4.txt"))
 
 script_info['output_description']= """
 The output will be a tab-delimited file with the following headers. Each row
@@ -162,7 +165,14 @@ script_info['optional_options']=[
         help='Key to extract metadata from BIOM table. [default: %default]'),
     make_option('--permutations', default=1000, type=int,
         help='Number of permutations to use for bootstrapped p-value '
-        'calculations. [default: %default]')]
+        'calculations. [default: %default]'),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+        help='Number of processes to spread the features over. '
+        '[default: %default]'),
+    make_option('--seed', type='int', default=None,
+        help='Seed for the random number generator used for bootstrapped '
+        'p-values. Features are seeded individually, so results do not '
+        'depend on --jobs_to_start. [default: random]')]
 
 script_info['version'] = __version__
 
@@ -171,6 +181,9 @@ def main():
 
     if opts.test == 'cscore' and opts.pval_assignment_method != 'bootstrapped':
         option_parser.error(cscore_error_text)
+    if opts.jobs_to_start < 1:
+        option_parser.error('--jobs_to_start must be at least 1. You passed '
+                            '%d' % opts.jobs_to_start)
 
     bt = load_table(opts.otu_table_fp)
     pmf, _ = parse_mapping_file_to_dict(opts.mapping_fp)
@@ -204,20 +217,14 @@ def main():
     if bt.shape[1] <= 3:
         option_parser.error(filtration_error_text)
 
-    rhos = []
-    pvals = []
-    for feature_vector in bt.iter_data(axis='observation'):
-        rho = correlate(feature_vector, md_values_to_correlate,
-                        method=opts.test)
-        pval = assign_correlation_pval(rho, len(feature_vector),
-                                       method=opts.pval_assignment_method,
+    data_generator = ((feature_vector, md_values_to_correlate)
+                      for feature_vector in bt.iter_data(axis='observation'))
+    rhos, pvals = run_correlation_test(data_generator, opts.test,
+                                       bootstrap_functions,
+                                       opts.pval_assignment_method,
                                        permutations=opts.permutations,
-                                       perm_test_fn=\
-                                            bootstrap_functions[opts.test],
-                                       v1=feature_vector,
-                                       v2=md_values_to_correlate)
-        rhos.append(rho)
-        pvals.append(pval)
+                                       jobs_to_start=opts.jobs_to_start,
+                                       seed=opts.seed)
 
     fdr_pvals = benjamini_hochberg_step_down(pvals)
     bon_pvals = bonferroni_correction(pvals)
@@ -58,6 +58,12 @@ script_info['optional_options'] = [
                 help='levels: min, min+step... for level <= max [default: %default]'),
     make_option('--subsample_multinomial', default=False, action='store_true',
                 help='subsample using subsampling with replacement [default: %default]'),
+    make_option('--batch_subsampling', default=False, action='store_true',
+                help='subsample all samples at once using vectorized draws.' +
+                ' This is faster than subsampling each sample in turn, and' +
+                ' gives rarefied counts with the same distribution, but' +
+                ' different counts for a given random seed' +
+                ' [default: %default]'),
     options_lookup['retain_temp_files'],
     options_lookup['suppress_submit_jobs'],
     options_lookup['poll_directly'],
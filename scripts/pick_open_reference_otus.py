@@ -11,12 +11,14 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 from os import makedirs
+from os.path import join
 
 from qiime.util import (parse_command_line_parameters,
                          make_option, get_options_lookup, load_qiime_config)
 from qiime.parse import parse_qiime_parameters
 from qiime.workflow.util import (validate_and_set_jobs_to_start,
-                                 call_commands_serially, print_commands, no_status_updates, print_to_stdout)
+                                 call_commands_serially, print_commands, no_status_updates, print_to_stdout,
+                                 WorkflowCheckpoints)
 from qiime.workflow.pick_open_reference_otus import (
     pick_subsampled_open_reference_otus,
     iterative_pick_subsampled_open_reference_otus)
@@ -236,6 +238,13 @@ script_info['script_usage'].append(("", "Run the subsampled open-reference "
                                     "-o $PWD/ucrss_iter_no_tax/ -s 0.1 -p $PWD/ucrss_params.txt "
                                     "--suppress_taxonomy_assignment"))
 
+script_info['script_usage'].append(("", "Resume the first run above in "
+                                    "ucrss_sortmerna_sumaclust/ (e.g., after it failed part way through). "
+                                    "OTU picking steps which completed in that run, and whose output files "
+                                    "are unchanged, are not run again.", "%prog -i $PWD/seqs1.fna "
+                                    "-r $PWD/refseqs.fna -o $PWD/ucrss_sortmerna_sumaclust/ "
+                                    "-p $PWD/ucrss_smr_suma_params.txt -m sortmerna_sumaclust --resume"))
+
 script_info['script_usage_output_to_remove'] = [
     '$PWD/ucrss/', '$PWD/ucrss_iter/', '$PWD/ucrss_usearch/',
     '$PWD/ucrss_iter_no_tree/', '$PWD/ucrss_iter_no_tax/',
@@ -276,6 +285,13 @@ script_info['optional_options'] = [
     make_option('-f', '--force', action='store_true', dest='force',
                 help='Force overwrite of existing output directory (note: existing '
                 'files in output_dir will not be removed) [default: %default]'),
+    make_option('--resume', action='store_true', default=False,
+                help='Resume a previous run in output_dir (e.g., one which '
+                'failed part way through). OTU picking steps which completed '
+                'in that run are not run again, provided that their output '
+                'files are unchanged. The completed steps and the md5 sums of '
+                'their input and output files are recorded in '
+                'output_dir/checkpoints.txt [default: %default]'),
     # print to shell script doesn't work for this workflow as there is a mix of
     # command calls and api calls. i need to refactor the workflow scripts...
     # make_option('-w','--print_only',action='store_true',
@@ -396,7 +412,7 @@ def main():
     try:
         makedirs(output_dir)
     except OSError:
-        if opts.force:
+        if opts.force or opts.resume:
             pass
         else:
             option_parser.error("Output directory already exists. Please "
@@ -412,6 +428,9 @@ def main():
     else:
         status_update_callback = no_status_updates
 
+    checkpoints = WorkflowCheckpoints(join(output_dir, 'checkpoints.txt'),
+                                      resume=opts.resume)
+
     if len(input_fps) == 1:
         pick_subsampled_open_reference_otus(input_fp=input_fps[0],
                                             refseqs_fp=refseqs_fp, output_dir=output_dir,
@@ -429,7 +448,8 @@ def main():
                                             denovo_otu_picking_method=denovo_otu_picking_method,
                                             reference_otu_picking_method=reference_otu_picking_method,
                                             status_update_callback=status_update_callback,
-                                            minimum_failure_threshold=minimum_failure_threshold)
+                                            minimum_failure_threshold=minimum_failure_threshold,
+                                            checkpoints=checkpoints)
     else:
         iterative_pick_subsampled_open_reference_otus(input_fps=input_fps,
                                                       refseqs_fp=refseqs_fp, output_dir=output_dir,
@@ -447,7 +467,8 @@ def main():
                                                       denovo_otu_picking_method=denovo_otu_picking_method,
                                                       reference_otu_picking_method=reference_otu_picking_method,
                                                       status_update_callback=status_update_callback,
-                                                      minimum_failure_threshold=minimum_failure_threshold)
+                                                      minimum_failure_threshold=minimum_failure_threshold,
+                                                      checkpoints=checkpoints)
 
 if __name__ == "__main__":
     main()
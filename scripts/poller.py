@@ -52,8 +52,11 @@ script_info['optional_options'] = [
                 help='List of files and directories to remove after run'
                 ' [default: %default]'),
     make_option('-t', '--time_to_sleep', type='int',
-                help='time to wait between calls to status_callback_f'
-                ' (in seconds) [default: %default]', default=3)
+                help='maximum time to wait between calls to'
+                ' check_run_complete_f (in seconds). check_run_complete_f is'
+                ' also called as soon as files are written to the directories'
+                ' of the files in check_run_complete_file, where this can be'
+                ' detected [default: %default]', default=3)
 ]
 
 
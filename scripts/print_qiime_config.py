@@ -34,7 +34,7 @@ except ImportError as e:
 
 try:
     from tempfile import mkdtemp
-    from skbio.util import remove_files
+    from pkg_resources import get_distribution, DistributionNotFound
     from burrito.util import ApplicationNotFoundError, ApplicationError
 except ImportError as e:
     raise ImportError("%s\n%s" % (e, core_dependency_missing_msg))
@@ -51,7 +51,8 @@ try:
                             parse_command_line_parameters,
                             make_option,
                             qiime_system_call,
-                            get_qiime_temp_dir)
+                            get_qiime_temp_dir,
+                            remove_files)
     from qiime.denoiser.utils import check_flowgram_ali_exe
 except ImportError as e:
     raise ImportError("%s\n%s" % (e, core_dependency_missing_msg))
@@ -77,26 +78,32 @@ except ImportError as e:
     raise ImportError("%s\n%s" % (e, core_dependency_missing_msg))
 
 
+def get_distribution_version(distribution_name):
+    """Return the installed version of a distribution, or None
+
+    The version is read from the package metadata, so the (possibly slow to
+    import) package itself is not imported.
+    """
+    try:
+        return get_distribution(distribution_name).version
+    except DistributionNotFound:
+        return None
+
+
+skbio_lib_version = get_distribution_version('scikit-bio')
+if skbio_lib_version is None:
+    raise ImportError("No module named skbio\n%s" %
+                      core_dependency_missing_msg)
+
 try:
-    from skbio import __version__ as skbio_lib_version
     from burrito.util import which
 except ImportError as e:
     raise ImportError("%s\n%s" % (e, core_dependency_missing_msg))
 
-try:
-    from pandas import __version__ as pandas_lib_version
-except ImportError:
-    pandas_lib_version = "Not installed."
-
-try:
-    from matplotlib import __version__ as matplotlib_lib_version
-except ImportError:
-    matplotlib_lib_version = "Not installed."
-
-try:
-    from emperor import __version__ as emperor_lib_version
-except ImportError:
-    emperor_lib_version = "Not installed."
+pandas_lib_version = get_distribution_version('pandas') or "Not installed."
+matplotlib_lib_version = (get_distribution_version('matplotlib') or
+                          "Not installed.")
+emperor_lib_version = get_distribution_version('emperor') or "Not installed."
 
 try:
     from burrito import __version__ as burrito_lib_version
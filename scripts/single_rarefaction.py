@@ -16,7 +16,7 @@ from skbio.stats import subsample
 
 from qiime.util import parse_command_line_parameters
 from qiime.util import make_option
-from qiime.rarefaction import SingleRarefactionMaker
+from qiime.rarefaction import SingleRarefactionMaker, BatchSubsampler
 
 script_info = {}
 script_info['brief_description'] = """Perform rarefaction on an otu table"""
@@ -58,7 +58,13 @@ script_info['optional_options'] = [
                 help='Retain OTUs of all zeros, which are usually omitted from' +
                 ' the output OTU tables. [default: %default]'),
     make_option('--subsample_multinomial', default=False, action='store_true',
-                help='subsample using subsampling with replacement [default: %default]')
+                help='subsample using subsampling with replacement [default: %default]'),
+    make_option('--batch_subsampling', default=False, action='store_true',
+                help='subsample all samples at once using vectorized draws.' +
+                ' This is faster than subsampling each sample in turn, and' +
+                ' gives rarefied counts with the same distribution, but' +
+                ' different counts for a given random seed' +
+                ' [default: %default]')
 ]
 script_info['option_label'] = {'input_path': 'OTU table filepath',
                                'output_path': 'Output filepath',
@@ -73,7 +79,9 @@ script_info['version'] = __version__
 def main():
     option_parser, opts, args = parse_command_line_parameters(**script_info)
 
-    if opts.subsample_multinomial:
+    if opts.batch_subsampling:
+        subsample_f = BatchSubsampler(replace=opts.subsample_multinomial)
+    elif opts.subsample_multinomial:
         subsample_f = partial(subsample, replace=True)
     else:
         subsample_f = subsample
@@ -19,7 +19,8 @@ from skbio.format.sequences import format_fastq_record
 from qiime.util import parse_command_line_parameters, make_option, gzip_open
 from qiime.parse import parse_mapping_file
 from qiime.split_libraries_fastq import (process_fastq_single_end_read_file,
-                                         BARCODE_DECODER_LOOKUP, process_fastq_single_end_read_file_no_barcode)
+                                         BARCODE_DECODER_LOOKUP, process_fastq_single_end_read_file_no_barcode,
+                                         process_fastq_single_end_read_file_parallel)
 from qiime.split_libraries import check_map
 from qiime.split_libraries_fastq import get_illumina_qual_chars
 from qiime.golay import get_invalid_golay_barcodes
@@ -136,7 +137,14 @@ script_info['optional_options'] = [
                 choices=['33', '64'], help="the ascii offset to use when "
                 "decoding phred scores (either 33 or 64). Warning: in most "
                 "cases you don't need to pass this value "
-                "[default: determined automatically]")
+                "[default: determined automatically]"),
+    make_option('-O', '--jobs_to_start', type='int', default=1,
+                help='number of processes to use for demultiplexing and quality '
+                'filtering each lane. Uncompressed barcoded input files are split '
+                'into shards which are processed in parallel on this machine; the '
+                'output is identical to that of a single process run. Gzipped or '
+                'non-barcoded input is always processed by a single process '
+                '[default: %default]')
     # NEED TO FIX THIS FUNCTIONALITY - CURRENTLY READING THE WRONG FIELD
     # make_option('--filter_bad_illumina_qual_digit',
     #    action='store_true',
@@ -173,6 +181,7 @@ def main():
     store_demultiplexed_fastq = opts.store_demultiplexed_fastq
     barcode_type = opts.barcode_type
     max_barcode_errors = opts.max_barcode_errors
+    jobs_to_start = opts.jobs_to_start
 
     # if this is not a demultiplexed run,
     if barcode_type == 'not-barcoded':
@@ -205,6 +214,10 @@ def main():
         option_parser.error('--last_bad_quality_char is no longer supported. '
                             'Use -q instead (see option help text by passing -h)')
 
+    if jobs_to_start < 1:
+        option_parser.error('--jobs_to_start must be at least 1. You passed '
+                            '%d' % jobs_to_start)
+
     if not (0 <= min_per_read_length_fraction <= 1):
         option_parser.error('--min_per_read_length_fraction must be between '
                             '0 and 1 (inclusive). You passed %1.5f' %
@@ -297,10 +310,16 @@ def main():
                     (sequence_read_fp,
                      str(safe_md5(open(sequence_read_fp)).hexdigest())))
 
-        if sequence_read_fp.endswith('.gz'):
-            sequence_read_f = gzip_open(sequence_read_fp)
-        else:
-            sequence_read_f = open(sequence_read_fp, 'U')
+        # the parallel code reads the (uncompressed) files by path
+        parallel = (jobs_to_start > 1 and barcode_read_fp is not None and
+                    not sequence_read_fp.endswith('.gz') and
+                    not barcode_read_fp.endswith('.gz'))
+
+        if not parallel:
+            if sequence_read_fp.endswith('.gz'):
+                sequence_read_f = gzip_open(sequence_read_fp)
+            else:
+                sequence_read_f = open(sequence_read_fp, 'U')
 
         seq_id = start_seq_id
 
@@ -309,24 +328,41 @@ def main():
                         (barcode_read_fp,
                          safe_md5(open(barcode_read_fp)).hexdigest()))
 
-            if barcode_read_fp.endswith('.gz'):
-                barcode_read_f = gzip_open(barcode_read_fp)
+            if not parallel:
+                if barcode_read_fp.endswith('.gz'):
+                    barcode_read_f = gzip_open(barcode_read_fp)
+                else:
+                    barcode_read_f = open(barcode_read_fp, 'U')
+
+            if parallel:
+                seq_generator = process_fastq_single_end_read_file_parallel(
+                    sequence_read_fp, barcode_read_fp, barcode_to_sample_id,
+                    jobs_to_start=jobs_to_start,
+                    store_unassigned=retain_unassigned_reads,
+                    max_bad_run_length=max_bad_run_length,
+                    phred_quality_threshold=phred_quality_threshold,
+                    min_per_read_length_fraction=min_per_read_length_fraction,
+                    rev_comp=rev_comp, rev_comp_barcode=rev_comp_barcode,
+                    seq_max_N=seq_max_N, start_seq_id=start_seq_id,
+                    filter_bad_illumina_qual_digit=filter_bad_illumina_qual_digit,
+                    log_f=log_f, histogram_f=histogram_f,
+                    barcode_correction_fn=barcode_correction_fn,
+                    max_barcode_errors=max_barcode_errors,
+                    phred_offset=phred_offset)
             else:
-                barcode_read_f = open(barcode_read_fp, 'U')
-
-            seq_generator = process_fastq_single_end_read_file(
-                sequence_read_f, barcode_read_f, barcode_to_sample_id,
-                store_unassigned=retain_unassigned_reads,
-                max_bad_run_length=max_bad_run_length,
-                phred_quality_threshold=phred_quality_threshold,
-                min_per_read_length_fraction=min_per_read_length_fraction,
-                rev_comp=rev_comp, rev_comp_barcode=rev_comp_barcode,
-                seq_max_N=seq_max_N, start_seq_id=start_seq_id,
-                filter_bad_illumina_qual_digit=filter_bad_illumina_qual_digit,
-                log_f=log_f, histogram_f=histogram_f,
-                barcode_correction_fn=barcode_correction_fn,
-                max_barcode_errors=max_barcode_errors,
-                phred_offset=phred_offset)
+                seq_generator = process_fastq_single_end_read_file(
+                    sequence_read_f, barcode_read_f, barcode_to_sample_id,
+                    store_unassigned=retain_unassigned_reads,
+                    max_bad_run_length=max_bad_run_length,
+                    phred_quality_threshold=phred_quality_threshold,
+                    min_per_read_length_fraction=min_per_read_length_fraction,
+                    rev_comp=rev_comp, rev_comp_barcode=rev_comp_barcode,
+                    seq_max_N=seq_max_N, start_seq_id=start_seq_id,
+                    filter_bad_illumina_qual_digit=filter_bad_illumina_qual_digit,
+                    log_f=log_f, histogram_f=histogram_f,
+                    barcode_correction_fn=barcode_correction_fn,
+                    max_barcode_errors=max_barcode_errors,
+                    phred_offset=phred_offset)
         else:
             seq_generator = process_fastq_single_end_read_file_no_barcode(
                 sequence_read_f, sample_ids[i],
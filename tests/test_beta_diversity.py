@@ -210,6 +210,18 @@ class BetaDiversityCalcTests(TestCase):
                                  sams.index(col_sams[k])]
                         npt.assert_almost_equal(row_v1, full_v1)
 
+            # several rows at once, in a different order than the table
+            rows = [sam for sam in sams if sam not in missing_sams][::-1]
+            single_file_beta(input_path, [metric], tree_path, output_dir,
+                             rowids=','.join(rows))
+            col_sams, row_sams, row_dmtx = parse_matrix(open(row_outname))
+            self.assertEqual(row_sams, rows)
+            for j in range(len(rows)):
+                for k in range(len(sams)):
+                    npt.assert_almost_equal(
+                        row_dmtx[j, k],
+                        dmtx[sams.index(row_sams[j]), sams.index(col_sams[k])])
+
             # full tree run:
             if 'full_tree' in str(metric).lower():
                 continue
@@ -267,6 +279,34 @@ class BetaDiversityCalcTests(TestCase):
         self.single_file_beta(missing_otu_table, missing_tree,
                               missing_sams=['M'], use_metric_list=True)
 
+    def test_single_file_beta_binary_output(self):
+        """single_file_beta should write binary distance matrices"""
+        fd, input_path = mkstemp(suffix='.txt')
+        os.close(fd)
+        in_fname = os.path.split(input_path)[1]
+        f = open(input_path, 'w')
+        f.write(l19_otu_table)
+        f.close()
+        fd, tree_path = mkstemp(suffix='.tre')
+        os.close(fd)
+        f = open(tree_path, 'w')
+        f.write(l19_tree)
+        f.close()
+        output_dir = mkdtemp()
+        self.files_to_remove.extend([input_path, tree_path])
+        self.folders_to_remove.append(output_dir)
+
+        for metric in ['bray_curtis', 'weighted_unifrac']:
+            single_file_beta(input_path, metric, tree_path, output_dir)
+            exp_sams, exp_dmtx = parse_distmat(
+                open(os.path.join(output_dir, metric + '_' + in_fname)))
+            single_file_beta(input_path, metric, tree_path, output_dir,
+                             binary_output=True)
+            sams, dmtx = parse_distmat(
+                open(os.path.join(output_dir, metric + '_' + in_fname)))
+            self.assertEqual(sams, exp_sams)
+            npt.assert_almost_equal(dmtx, exp_dmtx)
+
     def single_object_beta(self, otu_table, metric, tree_string,
                            missing_sams=None):
         """ running single_file_beta should give same result using --rows"""
@@ -19,10 +19,16 @@ from qiime.parse import make_envs_dict
 from qiime.beta_metrics import (
     _reorder_unifrac_res,
     make_unifrac_metric,
-    make_unifrac_row_metric)
+    make_unifrac_row_metric,
+    UniFracCounts,
+    dist_unweighted_unifrac,
+    sparse_nonphylogenetic_distances,
+    sparse_nonphylogenetic_metrics)
+from qiime.beta_diversity import get_nonphylogenetic_metric
+from scipy.sparse import csr_matrix
 from qiime.parse import parse_newick
 from cogent.core.tree import PhyloNode
-from cogent.maths.unifrac.fast_tree import (unifrac)
+from cogent.maths.unifrac.fast_tree import (unifrac, weighted_unifrac)
 import warnings
 
 
@@ -274,6 +280,99 @@ class FunctionTests(TestCase):
                 self.assertEqual(res_row[j], res[i, j])
         warnings.resetwarnings()
 
+    def test_unifrac_counts(self):
+        """ UniFracCounts should match fast_unifrac for each metric"""
+        tree = parse_newick(self.l19_treestr, PhyloNode)
+        unifrac_counts = UniFracCounts(self.l19_data, self.l19_taxon_names,
+                                       tree, self.l19_sample_names)
+        for metric, weighted, unifrac_f in [
+                ('unweighted', False, unifrac),
+                ('weighted', True, weighted_unifrac),
+                ('weighted_normalized', 'correct', weighted_unifrac)]:
+            exp = make_unifrac_metric(weighted, unifrac_f, True)(
+                self.l19_data, self.l19_taxon_names, tree,
+                self.l19_sample_names)
+            obs = unifrac_counts.distances(metric)
+            assert_almost_equal(obs, exp)
+            assert_almost_equal(unifrac_counts.distances(metric, [3, 0]),
+                                exp[[3, 0]])
+
+            # the temporary arrays can be split into blocks
+            small_blocks = UniFracCounts(
+                self.l19_data, self.l19_taxon_names, tree,
+                self.l19_sample_names, block_size=5)
+            assert_almost_equal(small_blocks.distances(metric), exp)
+
+        self.assertRaises(ValueError, unifrac_counts.distances, 'G')
+        self.assertRaises(ValueError, UniFracCounts, self.l19_data,
+                          ['x'] * 9, tree, self.l19_sample_names)
+
+    def test_unifrac_counts_missing_samples(self):
+        """ UniFracCounts should handle samples with no seqs on the tree"""
+        # taxa 1 and 2 are not in the tree, so sam1 has no seqs on the tree
+        treestr = '((((tax7:0.1,tax3:0.2):.98,tax8:.3, tax4:.3):.4, ' +\
+            '((tax6:.09):0.43):0.5):.2,' +\
+            '(tax9:0.3, endbigtaxon:.08));'
+        tree = parse_newick(treestr, PhyloNode)
+        data = self.l19_data.copy()
+        data[3] = 0
+        data[8] = data[9]
+        warnings.filterwarnings('ignore')
+        unifrac_counts = UniFracCounts(data, self.l19_taxon_names, tree,
+                                       self.l19_sample_names)
+        exp = make_unifrac_metric(False, unifrac, True)(
+            data, self.l19_taxon_names, tree, self.l19_sample_names)
+        obs = unifrac_counts.distances('unweighted')
+        warnings.resetwarnings()
+        assert_almost_equal(obs, exp)
+        self.assertEqual(obs[0, 3], 0.0)
+        self.assertEqual(obs[0, 1], 1.0)
+        self.assertEqual(obs[8, 9], 0.0)
+        self.assertEqual(obs[0, 0], 0.0)
+        for metric in UniFracCounts.metrics:
+            warnings.filterwarnings('ignore')
+            full = unifrac_counts.distances(metric)
+            rows = unifrac_counts.distances(metric, range(len(data)))
+            warnings.resetwarnings()
+            assert_almost_equal(rows, full)
+
+    def test_dist_unweighted_unifrac(self):
+        """ dist_unweighted_unifrac should match fast_unifrac"""
+        tree = parse_newick(self.l19_treestr, PhyloNode)
+        exp = make_unifrac_metric(False, unifrac, True)(
+            self.l19_data, self.l19_taxon_names, tree, self.l19_sample_names)
+        for make_subtree in (True, False):
+            obs = dist_unweighted_unifrac(
+                self.l19_data, self.l19_taxon_names, tree,
+                self.l19_sample_names, make_subtree=make_subtree)
+            assert_almost_equal(obs, exp)
+
+    def test_sparse_nonphylogenetic_distances(self):
+        """ sparse metrics should match the dense distance_transform metrics
+        """
+        data = self.l19_data.astype(float)
+        data[4] = 0
+        data[7] *= 0.37
+        for metric in sparse_nonphylogenetic_metrics:
+            exp = get_nonphylogenetic_metric(metric)(data)
+            for block_size in (1, 10, 4194304):
+                obs = sparse_nonphylogenetic_distances(
+                    csr_matrix(data), metric, block_size=block_size)
+                assert_almost_equal(obs, exp)
+                obs = sparse_nonphylogenetic_distances(
+                    csr_matrix(data), metric, [4, 0, 18],
+                    block_size=block_size)
+                assert_almost_equal(obs, exp[[4, 0, 18]])
+
+    def test_sparse_nonphylogenetic_distances_invalid(self):
+        """ sparse metrics should raise errors on unknown metrics and data
+        """
+        data = csr_matrix(self.l19_data)
+        self.assertRaises(ValueError, sparse_nonphylogenetic_distances, data,
+                          'gower')
+        self.assertRaises(ValueError, sparse_nonphylogenetic_distances,
+                          -data, 'bray_curtis')
+
 # run tests if called from command line
 if __name__ == '__main__':
     main()
@@ -8,8 +8,10 @@ __version__ = "1.9.0-dev"
 __maintainer__ = "Justin Kuczynski"
 __email__ = "justinak@gmail.com"
 
-from qiime.collate_alpha import make_output_row
+from qiime.collate_alpha import make_output_row, collate_alpha_results
 from unittest import TestCase, main
+from shutil import rmtree
+from tempfile import mkdtemp
 import os
 import numpy
 
@@ -30,6 +32,25 @@ class FunctionTests(TestCase):
                               f_data, fname, num_cols, all_samples)
         self.assertEqual(res, ['alpha_rarefaction_10_7', 10, 7, '0.4', '0.8'])
 
+    def test_collate_alpha_results(self):
+        alpha_results = [
+            ('alpha_rarefaction_20_0.txt', ['met1', 'met2'], ['s2'],
+             numpy.array([[.5, 2.]])),
+            ('alpha_rarefaction_10_0.txt', ['met1', 'met2'], ['s1', 's2'],
+             numpy.array([[.4, 1.], [.8, 3.]]))]
+        output_dir = mkdtemp(prefix='test_collate_alpha', suffix='')
+        try:
+            collate_alpha_results(alpha_results, output_dir)
+            self.assertItemsEqual(os.listdir(output_dir),
+                                  ['met1.txt', 'met2.txt'])
+            obs = open(os.path.join(output_dir, 'met1.txt')).read()
+        finally:
+            rmtree(output_dir)
+        self.assertEqual(obs.splitlines(),
+                         ['\tsequences per sample\titeration\ts1\ts2',
+                          'alpha_rarefaction_10_0.txt\t10\t0\t0.4\t0.8',
+                          'alpha_rarefaction_20_0.txt\t20\t0\tn/a\t0.5'])
+
 # run tests if called from command line
 if __name__ == '__main__':
     main()
@@ -33,7 +33,8 @@ from qiime.format import (format_distance_matrix, build_prefs_string,
                           format_p_value_for_num_iters, format_mapping_file, illumina_data_to_fastq,
                           format_mapping_html_data, format_te_prefs,
                           format_tep_file_lines, format_jnlp_file_lines,
-                          format_fastq_record, format_histograms_two_bins)
+                          format_fastq_record, format_histograms_two_bins,
+                          write_binary_distance_matrix)
 from biom.parse import parse_biom_table
 from biom.table import Table
 from StringIO import StringIO
@@ -319,6 +320,20 @@ class TopLevelTests(TestCase):
                          '\t11\t22\t33\n11\t1\t2\t3\n22\t4\t5\t6\n33\t7\t8\t9')
         self.assertRaises(ValueError, format_distance_matrix, labels[:2], a)
 
+    def test_write_binary_distance_matrix(self):
+        """write_binary_distance_matrix should write header and condensed dm
+        """
+        fd, dm_fp = mkstemp(prefix='FormatTests_', suffix='.txt')
+        close(fd)
+        self.files_to_remove.append(dm_fp)
+        a = array([[0, 1, 2], [1, 0, 3.5], [2, 3.5, 0]])
+        write_binary_distance_matrix(['a', 'b', 'c'], a, dm_fp)
+        header = 'QIIME binary distance matrix\t1\n\ta\tb\tc\n'
+        exp = header + '\n' * 2 + array([1, 2, 3.5], '<f8').tostring()
+        self.assertEqual(open(dm_fp, 'rb').read(), exp)
+        self.assertRaises(ValueError, write_binary_distance_matrix,
+                          ['a', 'b'], a, dm_fp)
+
     def test_format_matrix(self):
         """format_matrix should return tab-delimited mat"""
         a = [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
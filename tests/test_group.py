@@ -533,6 +533,24 @@ class GroupTests(TestCase):
         self.assertEqual(_get_groupings(self.tiny_dist_matrix_header,
                                         self.tiny_dist_matrix, self.tiny_groups, within=False), [])
 
+    def test_get_groupings_sample_order(self):
+        """_get_groupings() follows the order of sample IDs in the groups and
+        ignores sample IDs that are not in the distance matrix."""
+        header = ['a', 'b', 'c', 'd']
+        dm = array([[0.0, 0.1, 0.2, 0.3],
+                    [0.1, 0.0, 0.4, 0.5],
+                    [0.2, 0.4, 0.0, 0.6],
+                    [0.3, 0.5, 0.6, 0.0]])
+        groups = {'x': ['c', 'missing', 'a', 'b'], 'y': ['d']}
+        obs = dict(((g1, g2), d) for g1, g2, d in
+                   _get_groupings(header, dm, groups, within=True))
+        self.assertEqual(obs, {('x', 'x'): [0.2, 0.4, 0.1]})
+
+        obs = _get_groupings(header, dm, groups, within=False)
+        self.assertEqual(len(obs), 1)
+        self.assertEqual(set(obs[0][:2]), set(['x', 'y']))
+        self.assertEqual(obs[0][2], [0.6, 0.3, 0.5])
+
     def test_get_groupings_invalid_distance_matrix(self):
         """Handles asymmetric and/or hollow distance matrices correctly."""
         self.assertRaises(ValueError, _get_groupings, ['foo', 'bar'],
@@ -18,10 +18,11 @@ from qiime.otu_significance import (get_sample_cats, get_cat_sample_groups,
                                     run_grouped_correlation, CORRELATION_TEST_CHOICES,
                                     grouped_correlation_formatter, correlation_row_generator,
                                     run_correlation_test, is_computable_float,
-                                    correlate_output_formatter, _add_metadata)
+                                    correlate_output_formatter, _add_metadata,
+                                    observation_blocks)
 from qiime.stats import (assign_correlation_pval, fisher, 
                          fisher_population_correlation)
-from numpy import array, hstack, corrcoef, asarray, nan, inf
+from numpy import array, hstack, corrcoef, asarray, nan, inf, vstack
 from numpy.random import seed
 from numpy.testing import assert_almost_equal
 from os import remove
@@ -102,6 +103,18 @@ class GroupSignificanceFunctionsTests(TestCase):
         obs = get_sample_indices(cat_sample_groups, bt)
         self.assertEqual(exp, obs)
 
+    def test_observation_blocks(self):
+        """Test observation_blocks yields all rows in blocks."""
+        bt = parse_biom_table(BT_IN_1)
+        data = asarray([d for d in bt.iter_data(dense=True,
+                                                axis='observation')])
+        obs = list(observation_blocks(bt, 4))
+        self.assertEqual([len(block) for block in obs], [4, 2])
+        assert_almost_equal(vstack(obs), data)
+        obs = list(observation_blocks(bt))
+        self.assertEqual(len(obs), 1)
+        assert_almost_equal(obs[0], data)
+
     def test_group_significance_row_generator(self):
         """Test group_significance_row_generator works."""
         # run with ordered example
@@ -112,6 +125,13 @@ class GroupSignificanceFunctionsTests(TestCase):
         obs = list(group_significance_row_generator(bt, sample_indices))
         exp = zip(data.take([0, 1], 1),
                   data.take([3, 2], 1), data.take([4, 5], 1))
+        self.assertEqual(len(obs), len(exp))
+        for o, e in zip(obs, exp):
+            assert_almost_equal(e, o)
+        # run with blocks smaller than the table
+        obs = list(group_significance_row_generator(bt, sample_indices,
+                                                    block_size=4))
+        self.assertEqual(len(obs), len(exp))
         for o, e in zip(obs, exp):
             assert_almost_equal(e, o)
         # run with unequal length example
@@ -139,8 +159,10 @@ class GroupSignificanceFunctionsTests(TestCase):
                           -1.5065313062753816, -
                           0.043884559904114794, -1.0631239617935129,
                           -1.2878361428003895]
-        # we are expecting 1001 comparisons)
-        exp_pvals = map(lambda x: x / 1001., [888, 899, 279, 1001, 489, 299])
+        # we are expecting 1001 comparisons). every row is tested against the
+        # same permutations, so each p-value is what mc_t_two_sample gives
+        # for that row after seed(0).
+        exp_pvals = map(lambda x: x / 1001., [888, 898, 308, 1001, 513, 308])
         exp_means = [[52.333333333333336, 48.333333333333336],
                      [34.0, 30.333333333333332],
                      [20.0, 49.333333333333336],
@@ -172,7 +194,7 @@ class GroupSignificanceFunctionsTests(TestCase):
                           0.2322539745918096, 0.16469600468808282,
                           -0.49589486133213057]
         # we are expecting 1001 comparisons)
-        exp_pvals = map(lambda x: x / 1001., [821, 719, 916, 935, 938, 604])
+        exp_pvals = map(lambda x: x / 1001., [821, 720, 914, 952, 940, 619])
         exp_means = [[43.5, 51.75],
                      [29.75, 34.75],
                      [41.5, 40.0],
@@ -186,6 +208,17 @@ class GroupSignificanceFunctionsTests(TestCase):
         assert_almost_equal(exp_test_stats, obs_test_stats)
         assert_almost_equal(exp_pvals, obs_pvals)
         assert_almost_equal(exp_means, obs_means)
+        # the block size doesn't change the results
+        row_gen = group_significance_row_generator(bt_4, sample_indices,
+                                                   block_size=4)
+        seed(0)
+        obs_test_stats, obs_pvals, obs_means = \
+            run_group_significance_test(row_gen, 'nonparametric_t_test',
+                                        GROUP_TEST_CHOICES, reps=1000,
+                                        block_size=4)
+        assert_almost_equal(exp_test_stats, obs_test_stats)
+        assert_almost_equal(exp_pvals, obs_pvals)
+        assert_almost_equal(exp_means, obs_means)
 
         # test with parametric t test
         # bt_1 agrees with Prism
@@ -562,6 +595,40 @@ class GroupSignificanceFunctionsTests(TestCase):
         assert_almost_equal(exp_pvals, obs_pvals)
         assert_almost_equal(exp_means, obs_means)
 
+    def test_run_group_significance_test_jobs(self):
+        """Test results don't depend on the number of jobs or block size."""
+        bt_4 = parse_biom_table(BT_4)
+        sample_indices = {'cat1': [0, 1, 2, 3], 'cat2': [4, 5, 6, 7]}
+        for test in ['bootstrap_mann_whitney_u', 'nonparametric_t_test',
+                     'kruskal_wallis']:
+            row_gen = group_significance_row_generator(bt_4, sample_indices)
+            exp = run_group_significance_test(row_gen, test,
+                                              GROUP_TEST_CHOICES, reps=100,
+                                              seed=42)
+            for jobs_to_start, block_size in (1, 4), (2, 1), (3, 2):
+                row_gen = group_significance_row_generator(bt_4,
+                                                           sample_indices)
+                obs = run_group_significance_test(
+                    row_gen, test, GROUP_TEST_CHOICES, reps=100,
+                    block_size=block_size, jobs_to_start=jobs_to_start,
+                    seed=42)
+                for o, e in zip(obs, exp):
+                    assert_almost_equal(o, e)
+
+        # without a seed, the results only depend on the prng state
+        row_gen = group_significance_row_generator(bt_4, sample_indices)
+        seed(0)
+        exp = run_group_significance_test(row_gen, 'bootstrap_mann_whitney_u',
+                                          GROUP_TEST_CHOICES, reps=100,
+                                          jobs_to_start=2)
+        row_gen = group_significance_row_generator(bt_4, sample_indices)
+        seed(0)
+        obs = run_group_significance_test(row_gen, 'bootstrap_mann_whitney_u',
+                                          GROUP_TEST_CHOICES, reps=100,
+                                          block_size=2, jobs_to_start=3)
+        for o, e in zip(obs, exp):
+            assert_almost_equal(o, e)
+
     def test_group_significance_output_formatter(self):
         """output_formatter works"""
         # Using ANOVA test for example
@@ -704,6 +771,12 @@ class GroupedCorrelationTests(TestCase):
         self.assertEqual(obs_cvs, self.cvs1)
         assert_almost_equal(obs_mds, self.mds1)
         assert_almost_equal(obs_otus, self.otus1)
+        # run with blocks smaller than the table
+        obs_cvs, obs_mds, obs_otus = grouped_correlation_row_generator(
+            bt, pmf, category, gc_to_samples, block_size=3)
+        self.assertEqual(obs_cvs, self.cvs1)
+        assert_almost_equal(obs_mds, self.mds1)
+        assert_almost_equal(obs_otus, self.otus1)
         # make sure it throws an error on non float md
         self.assertRaises(ValueError, grouped_correlation_row_generator, bt,
                           pmf, 'field', gc_to_samples)
@@ -818,6 +891,10 @@ class GroupedCorrelationTests(TestCase):
                         array([1., 2., 3., 4., 5., 6.]))]
 
         assert_almost_equal(data_result, data_output)
+        # run with blocks smaller than the table
+        data_result = list(correlation_row_generator(bt, pmf, 'test_corr',
+                                                     block_size=4))
+        assert_almost_equal(data_result, data_output)
 
     def test_run_correlation_test(self):
         """Test run_correlation_test works."""
@@ -962,6 +1039,26 @@ class GroupedCorrelationTests(TestCase):
                                                   permutations=1000)
         assert_almost_equal(exp_bootstrapped_pvals, obs_pvals)
 
+    def test_run_correlation_test_jobs(self):
+        """Test results don't depend on the number of jobs or block size."""
+        bt = parse_biom_table(BT_4)
+        pmf = dict((s, {'test_corr': str(i)})
+                   for i, s in enumerate(bt.ids(axis='sample')))
+        data_gen = correlation_row_generator(bt, pmf, 'test_corr')
+        exp = run_correlation_test(data_gen, 'spearman',
+                                   CORRELATION_TEST_CHOICES,
+                                   pval_assignment_method='bootstrapped',
+                                   permutations=100, seed=42)
+        for jobs_to_start, block_size in (1, 4), (2, 1), (3, 2):
+            data_gen = correlation_row_generator(bt, pmf, 'test_corr')
+            obs = run_correlation_test(data_gen, 'spearman',
+                                       CORRELATION_TEST_CHOICES,
+                                       pval_assignment_method='bootstrapped',
+                                       permutations=100,
+                                       block_size=block_size,
+                                       jobs_to_start=jobs_to_start, seed=42)
+            assert_almost_equal(obs, exp)
+
     def test_is_computable_float(self):
         '''Test that an arbitrary input can be converted to float.'''
         self.assertRaises(ValueError, is_computable_float, 'adkfjsdkfj')
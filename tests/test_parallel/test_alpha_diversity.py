@@ -88,6 +88,26 @@ class ParallelAlphaDiversityTests(TestCase):
         output_fps = glob(join(self.test_out, '*txt'))
         self.assertEqual(len(output_fps), len(self.rt_fps))
 
+    def test_parallel_alpha_diversity_local(self):
+        """parallel alpha diversity functions as expected with local jobs
+        """
+        params = {'metrics': 'observed_species,chao1,PD_whole_tree',
+                  'tree_path': self.tree_fp,
+                  'jobs_to_start': 2
+                  }
+        app = ParallelAlphaDiversity(cluster_jobs_fp='local',
+                                     jobs_to_start=2)
+        r = app(self.rt_fps,
+                self.test_out,
+                params,
+                job_prefix='ATEST',
+                poll_directly=False,
+                suppress_submit_jobs=False)
+        output_fps = glob(join(self.test_out, '*txt'))
+        self.assertEqual(len(output_fps), len(self.rt_fps))
+        # temporary files are removed once the jobs complete
+        self.assertFalse(exists(join(self.test_out, 'ATEST')))
+
     def test_parallel_alpha_diversity_wo_tree(self):
         """parallel alpha diversity functions as expected without tree
         """
@@ -24,8 +24,10 @@ from biom.parse import parse_biom_table
 from qiime.parse import parse_distmat
 from qiime.util import get_qiime_temp_dir
 from qiime.test import initiate_timeout, disable_timeout
+from qiime.format import write_binary_distance_rows
 from qiime.parallel.beta_diversity import (ParallelBetaDiversitySingle,
-                                           ParallelBetaDiversityMultiple)
+                                           ParallelBetaDiversityMultiple,
+                                           assemble_distance_matrix)
 
 
 class ParallelBetaDiversityTests(TestCase):
@@ -109,6 +111,29 @@ class ParallelBetaDiversitySingleTests(ParallelBetaDiversityTests):
             dm_sample_ids = parse_distmat(open(dm_fp))[0]
             self.assertItemsEqual(dm_sample_ids, input_sample_ids)
 
+    def test_parallel_beta_diversity_local(self):
+        """ parallel beta diveristy functions in single file mode locally """
+        params = {'metrics': 'weighted_unifrac,unweighted_unifrac',
+                  'tree_path': self.tree_fp,
+                  'jobs_to_start': 3,
+                  'full_tree': False
+                  }
+        app = ParallelBetaDiversitySingle(cluster_jobs_fp='local',
+                                          jobs_to_start=3)
+        r = app(self.input1_fp,
+                self.test_out,
+                params,
+                job_prefix='BTEST',
+                poll_directly=False,
+                suppress_submit_jobs=False)
+        input_sample_ids = parse_biom_table(
+            open(self.input1_fp, 'U')).ids()
+        dm_fps = glob(join(self.test_out, '*weighted_unifrac*'))
+        self.assertEqual(len(dm_fps), 2)
+        for dm_fp in dm_fps:
+            dm_sample_ids = parse_distmat(open(dm_fp))[0]
+            self.assertItemsEqual(dm_sample_ids, input_sample_ids)
+
     def test_parallel_beta_diversity_wo_tree(self):
         """ parallel beta diveristy functions in single file mode """
         params = {'metrics': 'bray_curtis',
@@ -130,6 +155,31 @@ class ParallelBetaDiversitySingleTests(ParallelBetaDiversityTests):
             dm_sample_ids = parse_distmat(open(dm_fp))[0]
             self.assertItemsEqual(dm_sample_ids, input_sample_ids)
 
+    def test_assemble_distance_matrix(self):
+        """ assemble_distance_matrix places row blocks in the matrix """
+        labels = ['s1', 's2', 's3']
+        dm = [[0.0, 0.5, 0.25], [0.5, 0.0, 1.0], [0.25, 1.0, 0.0]]
+        fp1 = join(self.test_out, 'rows1.bin')
+        write_binary_distance_rows(['s3', 's1'], labels, [dm[2], dm[0]],
+                                   fp1)
+        # text row blocks, as written without beta_diversity.py -b
+        fp2 = join(self.test_out, 'rows2.txt')
+        open(fp2, 'w').write('\ts1\ts2\ts3\ns2\t0.5\t0.0\t1.0')
+        exp = '\ts1\ts2\ts3\ns1\t0.0\t0.5\t0.25\n' + \
+            's2\t0.5\t0.0\t1.0\ns3\t0.25\t1.0\t0.0'
+
+        output_fp = join(self.test_out, 'dm.txt')
+        assemble_distance_matrix([fp1, fp2], open(output_fp, 'w'))
+        self.assertEqual(open(output_fp).read(), exp)
+
+        # large matrices are assembled in a memory-mapped file
+        assemble_distance_matrix([fp1, fp2], open(output_fp, 'w'),
+                                 max_in_memory_bytes=0)
+        self.assertEqual(open(output_fp).read(), exp)
+
+        self.assertRaises(ValueError, assemble_distance_matrix, [fp1],
+                          open(output_fp, 'w'))
+
 
 class ParallelBetaDiversityMultipleTests(ParallelBetaDiversityTests):
 
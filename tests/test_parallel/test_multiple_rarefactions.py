@@ -73,7 +73,8 @@ class ParallelMultipleRarefactionsTests(TestCase):
                   'num_reps': 2,
                   'jobs_to_start': 2,
                   'suppress_lineages_included': False,
-                  'subsample_multinomial': False}
+                  'subsample_multinomial': False,
+                  'batch_subsampling': False}
         r(self.input1_fp,
           self.test_out,
           params,
@@ -15,6 +15,7 @@ from glob import glob
 from os import close
 from os.path import exists, join
 from tempfile import mkstemp, mkdtemp
+from StringIO import StringIO
 
 from skbio.util import remove_files
 from unittest import TestCase, main
@@ -22,7 +23,8 @@ from qiime.parallel.pick_otus import (ParallelPickOtusSortMeRNA,
                                       ParallelPickOtusUclustRef,
                                       ParallelPickOtusBlast,
                                       ParallelPickOtusTrie,
-                                      greedy_partition)
+                                      greedy_partition,
+                                      merge_otu_map_files)
 from qiime.util import get_qiime_temp_dir
 from qiime.test import initiate_timeout, disable_timeout
 from qiime.parse import parse_otu_map
@@ -323,6 +325,37 @@ class ParallelPickOtusFunctionTests(TestCase):
         self.assertEquals(obs_levels, [11, 10])
         self.assertEquals(obs_part, [['6', '3', '2'], ['5', '4', '1']])
 
+    def test_merge_otu_map_files(self):
+        """merge_otu_map_files combines OTUs across maps"""
+        otu_maps = ['0\ts1\ts2\n2\ts3\n',
+                    '\n1\ts4\n0\ts5\n',
+                    '2\ts6\ts7\n3\n']
+        otu_map_fps = []
+        for otu_map in otu_maps:
+            fd, otu_map_fp = mkstemp(dir=get_qiime_temp_dir(),
+                                     prefix='qiime_parallel_otu_map',
+                                     suffix='.txt')
+            close(fd)
+            open(otu_map_fp, 'w').write(otu_map)
+            otu_map_fps.append(otu_map_fp)
+
+        exp = '0\ts1\ts2\ts5\n2\ts3\ts6\ts7\n1\ts4\n3\n'
+        try:
+            obs = StringIO()
+            merge_otu_map_files(otu_map_fps, obs)
+            self.assertEqual(obs.getvalue(), exp)
+
+            # fewer files may be kept open than there are OTU maps
+            obs = StringIO()
+            merge_otu_map_files(otu_map_fps, obs, max_open_files=1)
+            self.assertEqual(obs.getvalue(), exp)
+        finally:
+            remove_files(otu_map_fps)
+
+        obs = StringIO()
+        merge_otu_map_files([], obs)
+        self.assertEqual(obs.getvalue(), '')
+
 
 refseqs1 = """>r1
 CTGGGCCGTGTCTCAGTCCCAATGTGGCCGTTTACCCTCTCAGGCCGGCTACGCATCATCGCCTTGGTGGGCCGTTACCTCACCAACTAGCTAATGCGCCGCAGGTCCATCCATGTTCACGCCTTGATGGGCGCTTTAATATACTGAGCATGCGCTCTGTATACCTATCCGGTTTTAGCTACCGTTTCCAGCAGTTATCCCGGACACATGGGCTAGG
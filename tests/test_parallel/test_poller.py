@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+from __future__ import division
+
+__author__ = "Greg Caporaso"
+__copyright__ = "Copyright 2011, The QIIME project"
+__credits__ = ["Greg Caporaso"]
+__license__ = "GPL"
+__version__ = "1.9.0-dev"
+__maintainer__ = "Greg Caporaso"
+__email__ = "gregcaporaso@gmail.com"
+
+from os import rename
+from os.path import join
+from shutil import rmtree
+from tempfile import mkdtemp
+from threading import Timer
+from time import time
+from unittest import TestCase, main
+
+from qiime.util import get_qiime_temp_dir
+from qiime.parallel.poller import (poller, basic_check_run_complete_f,
+                                   DirectoryWatcher)
+
+
+class PollerTests(TestCase):
+
+    def setUp(self):
+        self.test_out = mkdtemp(dir=get_qiime_temp_dir(),
+                                prefix='qiime_poller_tests_',
+                                suffix='')
+        self.fps = [join(self.test_out, 'f%d.txt' % i) for i in range(3)]
+
+    def tearDown(self):
+        rmtree(self.test_out)
+
+    def _write_output(self, fp):
+        """ write fp as parallel jobs do, by moving it into place """
+        open(fp + '.tmp', 'w').write('x\n')
+        rename(fp + '.tmp', fp)
+
+    def test_basic_check_run_complete_f(self):
+        """ basic_check_run_complete_f drops filepaths found to exist """
+        lines = ['%s\n' % fp for fp in self.fps]
+        self.assertFalse(basic_check_run_complete_f(lines))
+        self.assertEqual(len(lines), 3)
+
+        self._write_output(self.fps[0])
+        self._write_output(self.fps[2])
+        self.assertFalse(basic_check_run_complete_f(lines))
+        self.assertEqual(lines, ['%s\n' % fp for fp in self.fps[1:]])
+
+        self._write_output(self.fps[1])
+        self.assertTrue(basic_check_run_complete_f(lines))
+
+    def test_directory_watcher(self):
+        """ DirectoryWatcher.wait returns on timeout or file events """
+        watcher = DirectoryWatcher([self.test_out])
+        start = time()
+        watcher.wait(0.1)
+        self.assertTrue(time() - start >= 0.1)
+        watcher.close()
+
+        # non-existent directories are ignored
+        watcher = DirectoryWatcher([join(self.test_out, 'not_a_dir')])
+        start = time()
+        watcher.wait(0.1)
+        self.assertTrue(time() - start >= 0.1)
+        watcher.close()
+
+    def test_poller(self):
+        """ poller returns soon after the last output file is written """
+        results = []
+        for i, fp in enumerate(self.fps):
+            Timer(0.1 * (i + 1), self._write_output, [fp]).start()
+        start = time()
+        poller(basic_check_run_complete_f,
+               lambda f: results.append('processed'),
+               lambda f: results.append('cleaned'),
+               ['%s\n' % fp for fp in self.fps],
+               [],
+               [],
+               seconds_to_sleep=1)
+        self.assertEqual(results, ['processed', 'cleaned'])
+        self.assertTrue(time() - start < 1.1)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,9 +10,10 @@ __version__ = "1.9.0-dev"
 __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
-from os import close
-from os.path import exists
-from tempfile import mkstemp
+from os import close, listdir
+from os.path import exists, join
+from shutil import rmtree
+from tempfile import mkstemp, mkdtemp
 from unittest import TestCase, main
 
 from skbio.util import remove_files
@@ -241,6 +242,42 @@ class ParallelWrapperTests(TestCase):
         self.assertEqual(actual_5, 5)
         self.assertEqual(actual_40, 1)
 
+    def test_run_local_job(self):
+        """_run_local_job strips the shell wrapping and runs the command"""
+        cmd = '/bin/bash; echo hello ; echo world; exit'
+        self.assertEqual(self.pw._run_local_job(cmd),
+                         (cmd, 'hello\nworld\n', '', 0))
+        cmd = '/bin/bash; echo hello ; false; exit'
+        self.assertEqual(self.pw._run_local_job(cmd)[3], 1)
+        # a failing subcommand stops the job and sets its status
+        cmd = '/bin/bash; false; echo hello; exit'
+        self.assertEqual(self.pw._run_local_job(cmd), (cmd, '', '', 1))
+
+    def test_get_worker_commands(self):
+        """_get_worker_commands runs each command once from jobs_to_start jobs
+        """
+        working_dir = mkdtemp(dir=get_qiime_temp_dir(),
+                              prefix='qiime_parallel_tests_')
+        commands = ['/bin/bash; echo %d >> %s; exit' %
+                    (i, join(working_dir, 'out.txt')) for i in range(5)]
+        self.pw.files_to_remove = []
+        self.pw._jobs_to_start = 2
+        actual = self.pw._get_worker_commands(commands, 'TEST',
+                                              working_dir)
+        self.assertEqual(len(actual), 2)
+        self.assertEqual(actual[0], actual[1])
+        self.assertTrue(actual[0].startswith('/bin/bash; bash '))
+        self.assertTrue(actual[0].endswith('worker.sh; exit'))
+        self.assertEqual(len(self.pw.files_to_remove), 7)
+
+        for command in actual:
+            self.assertEqual(self.pw._run_local_job(command)[3], 0)
+        self.assertEqual(open(join(working_dir, 'out.txt')).read(),
+                         '0\n1\n2\n3\n4\n')
+        self.assertEqual(sorted(listdir(join(working_dir, 'TESTclaims'))),
+                         ['0', '1', '2', '3', '4'])
+        rmtree(working_dir)
+
 
 class BufferedWriterTests(TestCase):
 
@@ -33,7 +33,12 @@ from qiime.parse import (group_by_field, group_by_fields,
                          parse_taxa_summary_table, parse_prefs_file, parse_mapping_file_to_dict,
                          mapping_file_to_dict, MinimalQualParser, parse_denoiser_mapping,
                          parse_otu_map, parse_sample_id_map, parse_taxonomy_to_otu_metadata,
-                         is_casava_v180_or_later, MinimalSamParser)
+                         is_casava_v180_or_later, MinimalSamParser,
+                         parse_binary_distmat, is_binary_distmat,
+                         parse_binary_distance_rows,
+                         parse_distmat_to_skbio)
+from qiime.format import (write_binary_distance_matrix,
+                          write_binary_distance_rows)
 
 
 class TopLevelTests(TestCase):
@@ -317,6 +322,71 @@ c\t1\t3.5\t0
         self.assertEqual(obs[0], exp[0])
         assert_almost_equal(obs[1], exp[1])
 
+    def test_parse_distmat_binary(self):
+        """parse_distmat should read binary distmats from open files"""
+        fd, dm_fp = mkstemp(prefix='ParseTests_', suffix='.txt')
+        close(fd)
+        self.files_to_remove.append(dm_fp)
+        dm = array([[0, 1, 2], [1, 0, 3.5], [2, 3.5, 0]])
+        write_binary_distance_matrix(['a', 'b', 'c'], dm, dm_fp)
+
+        obs = parse_distmat(open(dm_fp, 'U'))
+        self.assertEqual(obs[0], ['a', 'b', 'c'])
+        assert_almost_equal(obs[1], dm)
+        self.assertEqual(parse_distmat_to_dict(open(dm_fp, 'U'))['c']['b'],
+                         3.5)
+        obs = parse_distmat_to_skbio(dm_fp)
+        self.assertEqual(obs.ids, ('a', 'b', 'c'))
+        assert_almost_equal(obs.data, dm)
+
+        # binary distmats can't be read from lists of lines
+        self.assertRaises(ValueError, parse_distmat,
+                          open(dm_fp, 'rb').readlines())
+
+    def test_parse_binary_distmat(self):
+        """parse_binary_distmat should memory-map the condensed distmat"""
+        fd, dm_fp = mkstemp(prefix='ParseTests_', suffix='.txt')
+        close(fd)
+        self.files_to_remove.append(dm_fp)
+        dm = array([[0, 1, 2, 4], [1, 0, 3.5, 5], [2, 3.5, 0, 6],
+                    [4, 5, 6, 0]])
+        write_binary_distance_matrix(['a', 'bb', 'c', 'd'], dm, dm_fp)
+        self.assertTrue(is_binary_distmat(dm_fp))
+        ids, condensed = parse_binary_distmat(dm_fp)
+        self.assertEqual(ids, ['a', 'bb', 'c', 'd'])
+        assert_almost_equal(condensed, [1, 2, 4, 3.5, 5, 6])
+
+        write_binary_distance_matrix(['a'], array([[0.0]]), dm_fp)
+        ids, condensed = parse_binary_distmat(dm_fp)
+        self.assertEqual(ids, ['a'])
+        self.assertEqual(len(condensed), 0)
+
+        f = open(dm_fp, 'w')
+        f.write('\ta\tb\na\t0\t1\nb\t1\t0\n')
+        f.close()
+        self.assertFalse(is_binary_distmat(dm_fp))
+        self.assertRaises(ValueError, parse_binary_distmat, dm_fp)
+
+    def test_parse_binary_distance_rows(self):
+        """parse_binary_distance_rows should memory-map the rows"""
+        fd, dm_fp = mkstemp(prefix='ParseTests_', suffix='.txt')
+        close(fd)
+        self.files_to_remove.append(dm_fp)
+        rows = array([[2, 3.5, 0, 6], [0, 1, 2, 4]])
+        write_binary_distance_rows(['c', 'a'], ['a', 'bb', 'c', 'd'], rows,
+                                   dm_fp)
+        self.assertFalse(is_binary_distmat(dm_fp))
+        row_ids, col_ids, obs = parse_binary_distance_rows(dm_fp)
+        self.assertEqual(row_ids, ['c', 'a'])
+        self.assertEqual(col_ids, ['a', 'bb', 'c', 'd'])
+        assert_almost_equal(obs, rows)
+
+        self.assertRaises(ValueError, write_binary_distance_rows, ['a'],
+                          ['a', 'bb', 'c', 'd'], rows, dm_fp)
+
+        write_binary_distance_matrix(['a'], array([[0.0]]), dm_fp)
+        self.assertRaises(ValueError, parse_binary_distance_rows, dm_fp)
+
     def test_parse_distmat_to_dict(self):
         """parse_distmat should return dict of distmat"""
         lines = """\ta\tb\tc
@@ -17,7 +17,7 @@ __version__ = "1.9.0-dev"
 __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
-from os import remove, close
+from os import remove, close, listdir
 from os.path import abspath, join, exists, split
 from shutil import rmtree
 from tempfile import mkstemp, mkdtemp
@@ -27,6 +27,7 @@ from unittest import TestCase, main
 from numpy.testing import assert_almost_equal
 from skbio.sequence import DNA
 from skbio.util import create_dir, remove_files
+from skbio.parse.sequences import parse_fasta
 from bfillings.formatdb import build_blast_db_from_fasta_path
 from bfillings.sortmerna_v2 import build_database_sortmerna
 
@@ -38,7 +39,9 @@ from qiime.pick_otus import (CdHitOtuPicker, OtuPicker,
                              UclustReferenceOtuPicker, expand_failures, UsearchOtuPicker,
                              UsearchReferenceOtuPicker, get_blast_hits, BlastxOtuPicker,
                              Usearch610DeNovoOtuPicker, Usearch61ReferenceOtuPicker,
-                             SumaClustOtuPicker, SortmernaV2OtuPicker, SwarmOtuPicker)
+                             SumaClustOtuPicker, SortmernaV2OtuPicker, SwarmOtuPicker,
+                             dereplicate_fasta, ExactMatchIdMap,
+                             CompactOtuMap)
 
 
 class OtuPickerTests(TestCase):
@@ -77,6 +80,75 @@ class OtuPickerTests(TestCase):
         self.assertEqual(actual, expected)
 
 
+class DereplicateFastaTests(TestCase):
+
+    """Tests of dereplicate_fasta and ExactMatchIdMap"""
+
+    def setUp(self):
+        self.temp_dir = mkdtemp(prefix='DereplicateFastaTests_')
+        self.seqs = [('s1 comment1', 'ACCTTGTTACTTT'),
+                     ('s2 comment2', 'ACCTTGTTACTTTC'),
+                     ('s3 comment3', 'ACCTTGTTACTTTCC'),
+                     ('s4 comment4', 'ACCTTGTTACTTT'),
+                     ('s5 comment5', 'ACCTTGTTACTTTCC'),
+                     ('s6 comment6', 'ACCTTGTTACTTT'),
+                     ('s7 comment7', 'GGCTTGTTACTTT'),
+                     ('s8 comment8', 'TTCTTGTTACTTT'),
+                     ('s9 comment9', 'GGCTTGTTACTTT')]
+        self.seqs_fp = join(self.temp_dir, 'seqs.fasta')
+        with open(self.seqs_fp, 'w') as f:
+            for seq_id, seq in self.seqs:
+                f.write('>%s\n%s\n' % (seq_id, seq))
+        self.unique_seqs_fp = join(self.temp_dir, 'unique_seqs.fasta')
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def test_dereplicate_fasta(self):
+        """dereplicate_fasta matches _prefilter_exact_matches"""
+        exp_seqs, exp_map = OtuPicker({})._prefilter_exact_matches(self.seqs)
+        # small partition sizes force the input to be partitioned
+        for max_partition_size in (1e9, 100, 20):
+            actual = dereplicate_fasta(self.seqs_fp, self.unique_seqs_fp,
+                                       max_partition_size=max_partition_size,
+                                       temp_dir=self.temp_dir)
+            self.assertEqual(sorted(actual.items()), sorted(exp_map.items()))
+            self.assertEqual(list(parse_fasta(open(self.unique_seqs_fp))),
+                             exp_seqs)
+            # partition files are cleaned up
+            self.assertEqual(sorted(listdir(self.temp_dir)),
+                             ['seqs.fasta', 'unique_seqs.fasta'])
+
+    def test_dereplicate_fasta_write_counts(self):
+        """dereplicate_fasta writes counts to fasta labels"""
+        dereplicate_fasta(self.seqs_fp, self.unique_seqs_fp,
+                          write_counts=True, max_partition_size=50,
+                          temp_dir=self.temp_dir)
+        actual = [label for label, seq in
+                  parse_fasta(open(self.unique_seqs_fp))]
+        expected = ['QiimeExactMatch.s1 count=3;',
+                    'QiimeExactMatch.s2 count=1;',
+                    'QiimeExactMatch.s3 count=2;',
+                    'QiimeExactMatch.s7 count=2;',
+                    'QiimeExactMatch.s8 count=1;']
+        self.assertEqual(actual, expected)
+
+    def test_exact_match_id_map(self):
+        """ExactMatchIdMap functions like a dict of lists"""
+        m = ExactMatchIdMap()
+        m['a'] = ['s1', 's2']
+        m['b'] = ['s3']
+        self.assertEqual(m['a'], ['s1', 's2'])
+        self.assertEqual(m.count('a'), 2)
+        self.assertEqual(len(m), 2)
+        self.assertTrue('b' in m)
+        self.assertFalse('c' in m)
+        self.assertEqual(sorted(m), ['a', 'b'])
+        self.assertEqual(sorted(m.items()), [('a', ['s1', 's2']),
+                                             ('b', ['s3'])])
+        self.assertRaises(KeyError, m.__getitem__, 'c')
+
+
 class SortmernaV2OtuPickerTests(TestCase):
     """ Tests for SortMeRNA (closed-reference) OTU picker """
 
@@ -4355,6 +4427,45 @@ class PickOtusStandaloneFunctions(TestCase):
             [self.otu_map1_file, self.otu_map2_file, ['a\t110 221']])
         self.assertEqual(exp123, actual123)
 
+    def test_map_otu_map_files_compact(self):
+        """map_otu_map_files: returns a CompactOtuMap when compact=True
+        """
+        actual = map_otu_map_files(
+            [self.otu_map1_file, self.otu_map2_file], compact=True)
+        self.assertTrue(isinstance(actual, CompactOtuMap))
+        self.assertEqual(actual.to_dict(),
+                         {'110': ['seq1', 'seq2', 'seq5', 'seq6', 'seq7',
+                                  'seq8'],
+                          '221': ['seq3', 'seq4']})
+        self.assertEqual(actual.keys(), ['110', '221'])
+        self.assertEqual(actual['221'], ['seq3', 'seq4'])
+        # seq ids are shared with the first OTU map rather than copied
+        self.assertEqual(len(actual.seq_ids), 8)
+
+    def test_compact_otu_map(self):
+        """CompactOtuMap: parses, expands and looks up OTUs
+        """
+        otu_map1 = CompactOtuMap.from_lines(self.otu_map1_file + ['', '3'])
+        self.assertEqual(len(otu_map1), 4)
+        self.assertEqual(otu_map1.to_dict(),
+                         dict(self.otu_map1.items() + [('3', [])]))
+        self.assertTrue('3' in otu_map1)
+        self.assertFalse('4' in otu_map1)
+        self.assertEqual(otu_map1['3'], [])
+
+        otu_map2 = CompactOtuMap.from_lines(['110\t3\t2', '221\t1\t0'])
+        actual = otu_map2.expand_seq_ids(otu_map1)
+        self.assertEqual(actual.items(),
+                         [('110', ['seq6', 'seq7', 'seq8']),
+                          ('221', ['seq3', 'seq4', 'seq1', 'seq2', 'seq5'])])
+        self.assertEqual(actual.expand_failures(['221\n', '110']),
+                         ['seq3', 'seq4', 'seq1', 'seq2', 'seq5', 'seq6',
+                          'seq7', 'seq8'])
+        self.assertEqual(expand_failures([], actual), [])
+
+        otu_map3 = CompactOtuMap.from_lines(self.otu_map3_file)
+        self.assertRaises(KeyError, otu_map3.expand_seq_ids, otu_map1)
+
 dna_seqs_1 = """>cdhit_test_seqs_0 comment fields, not part of sequence identifiers
 AACCCCCACGGTGGATGCCACACGCCCCATACAAAGGGTAGGATGCTTAAGACACATCGCGTCAGGTTTGTGTCAGGCCT
 > cdhit_test_seqs_1
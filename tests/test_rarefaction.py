@@ -22,7 +22,8 @@ import numpy as np
 from biom import load_table
 from biom.table import Table, TableException
 
-from qiime.rarefaction import RarefactionMaker, get_rare_data
+from qiime.rarefaction import (RarefactionMaker, BatchSubsampler,
+                               get_rare_data)
 from qiime.util import load_qiime_config, write_biom_table
 
 
@@ -130,6 +131,119 @@ class FunctionTests(TestCase):
             self.otu_table.ids()[:2])
         # third sample had 0 seqs, so it's gone
 
+    def test_rarefy_to_collated_alpha(self):
+        """rarefy_to_collated_alpha should write collated alpha files
+
+        """
+        maker = RarefactionMaker(self.otu_table_fp, 1, 11, 10, 2)
+        maker.rarefy_to_collated_alpha(self.rare_dir,
+                                       'observed_otus,chao1_ci')
+
+        self.assertItemsEqual(os.listdir(self.rare_dir),
+                              ['observed_otus.txt', 'chao1_lower_bound.txt',
+                               'chao1_upper_bound.txt'])
+        lines = open(os.path.join(self.rare_dir,
+                                  'observed_otus.txt')).read().splitlines()
+        self.assertEqual(lines[0],
+                         '\tsequences per sample\titeration\tY\tX')
+        self.assertEqual(lines[1:],
+                         ['alpha_rarefaction_1_0.txt\t1\t0\t1\t1',
+                          'alpha_rarefaction_1_1.txt\t1\t1\t1\t1',
+                          'alpha_rarefaction_11_0.txt\t11\t0\tn/a\t4',
+                          'alpha_rarefaction_11_1.txt\t11\t1\tn/a\t4'])
+        # third sample had 0 seqs, so it's gone, and only X has 11 seqs
+
+    def test_rarefy_to_collated_alpha_beta(self):
+        """rarefy_to_collated_alpha should write beta diversity if requested
+
+        """
+        beta_dir = os.path.join(self.rare_dir, 'beta_div')
+        maker = RarefactionMaker(self.otu_table_fp, 3, 3, 1, 1)
+        maker.rarefy_to_collated_alpha(self.rare_dir, ['observed_otus'],
+                                       beta_metrics='bray_curtis,euclidean',
+                                       beta_output_dir=beta_dir)
+
+        self.assertItemsEqual(os.listdir(beta_dir),
+                              ['bray_curtis_rarefaction_3_0.txt',
+                               'euclidean_rarefaction_3_0.txt'])
+        lines = open(os.path.join(
+            beta_dir, 'bray_curtis_rarefaction_3_0.txt')).read().splitlines()
+        self.assertEqual(lines[0], '\tY\tX')
+
+    def test_rarefy_to_collated_alpha_invalid_metric(self):
+        """rarefy_to_collated_alpha should raise an error on unknown metrics
+
+        """
+        maker = RarefactionMaker(self.otu_table_fp, 1, 2, 1, 1)
+        self.assertRaises(ValueError, maker.rarefy_to_collated_alpha,
+                          self.rare_dir, 'observed_otus,not_a_metric')
+
+    def test_batch_subsampler(self):
+        """BatchSubsampler should subsample a single vector of counts"""
+        counts = np.array([5, 0, 3, 10, 1, 7])
+        for replace in (False, True):
+            subsample_f = BatchSubsampler(replace=replace, seed=0)
+            for n in (0, 1, 12, 26):
+                obs = subsample_f(counts, n)
+                self.assertEqual(obs.sum(), n)
+                self.assertEqual(obs[1], 0)
+                if not replace:
+                    self.assertTrue((obs <= counts).all())
+        npt.assert_equal(BatchSubsampler()(counts, 26), counts)
+        self.assertRaises(ValueError, BatchSubsampler(), counts, 27)
+        self.assertEqual(BatchSubsampler(replace=True)(counts, 27).sum(), 27)
+
+    def test_batch_subsampler_reproducible(self):
+        """BatchSubsampler should give the same result with the same seed"""
+        counts = np.arange(100)
+        obs1 = BatchSubsampler(seed=42)(counts, 500)
+        obs2 = BatchSubsampler(seed=42)(counts, 500)
+        npt.assert_equal(obs1, obs2)
+        # repeated calls give new subsamples
+        subsample_f = BatchSubsampler(seed=42)
+        self.assertFalse((subsample_f(counts, 500) ==
+                          subsample_f(counts, 500)).all())
+
+    def test_batch_subsampler_per_sample_seeding(self):
+        """BatchSubsampler results should not depend on later samples"""
+        data = np.arange(300).reshape(100, 3)
+        table = Table(data, map(str, range(100)), ['A', 'B', 'C'])
+        obs1 = BatchSubsampler(seed=42).subsample_table(table.copy(), 1000)
+        table.filter(['A', 'B'])
+        obs2 = BatchSubsampler(seed=42).subsample_table(table, 1000)
+        npt.assert_equal(obs1.data('A'), obs2.data('A'))
+        npt.assert_equal(obs1.data('B'), obs2.data('B'))
+
+    def test_batch_subsampler_distribution(self):
+        """BatchSubsampler should draw OTUs in proportion to their counts"""
+        counts = np.array([5, 0, 3, 10, 1, 7, 40, 2])
+        for replace in (False, True):
+            subsample_f = BatchSubsampler(replace=replace, seed=0)
+            obs = np.array([subsample_f(counts, 20) for i in range(2000)])
+            npt.assert_allclose(obs.mean(axis=0),
+                                20. * counts / counts.sum(), atol=0.1)
+
+    def test_get_rare_data_batch_subsampler(self):
+        """get_rare_data should rarefy all samples with BatchSubsampler"""
+        for replace in (False, True):
+            rare_otu_table = get_rare_data(
+                self.otu_table, 3,
+                subsample_f=BatchSubsampler(replace=replace, seed=0))
+            npt.assert_equal(rare_otu_table.ids(), ['Y', 'X'])
+            npt.assert_equal(rare_otu_table.ids(axis='observation'),
+                             self.otu_table.ids(axis='observation'))
+            npt.assert_equal(rare_otu_table.sum(axis='sample'), [3, 3])
+            if not replace:
+                # Y has exactly 3 sequences, so it is unchanged
+                npt.assert_equal(rare_otu_table.data('Y'), [2, 0, 0, 1])
+                self.assertTrue((rare_otu_table.data('X') <=
+                                 self.otu_table.data('X')).all())
+
+        rare_otu_table = get_rare_data(self.otu_table, 5,
+                                       include_small_samples=True,
+                                       subsample_f=BatchSubsampler(seed=0))
+        npt.assert_equal(rare_otu_table.sum(axis='sample'), [3, 5, 0])
+
     def test_get_empty_rare(self):
         """get_rare_data should be empty when depth > # seqs in any sample"""
         self.assertRaises(TableException, get_rare_data, self.otu_table,
@@ -20,7 +20,9 @@ from skbio.sequence import DNA
 from skbio.alignment import SequenceCollection
 from skbio.parse.sequences import parse_fasta
 
-from qiime.split import split_fasta
+import qiime.split
+from qiime.split import (split_fasta, get_fasta_chunk_offsets,
+                         split_fasta_into_chunks)
 from qiime.util import get_qiime_temp_dir, remove_files
 
 from itertools import product
@@ -243,6 +245,86 @@ class SplitTestsFasta(TestCase):
                 SequenceCollection.from_fasta_records(parse_fasta(infile), DNA),
                 SequenceCollection.from_fasta_records(parse_fasta(actual_seqs), DNA))
 
+    def test_get_fasta_chunk_offsets(self):
+        """get_fasta_chunk_offsets splits at the start of records
+        """
+        fd, fasta_fp = mkstemp(dir=get_qiime_temp_dir(),
+                               prefix='split_fasta_tests',
+                               suffix='.fasta')
+        close(fd)
+        open(fasta_fp, 'w').write('>seq1\nAACCTTAA\n>seq2\nTTAACC\nAATTAA\n'
+                                  '>seq3\nCCTT--AA\n')
+        self.assertEqual(get_fasta_chunk_offsets(fasta_fp, 1), [0, 50])
+        self.assertEqual(get_fasta_chunk_offsets(fasta_fp, 2), [0, 35, 50])
+        self.assertEqual(get_fasta_chunk_offsets(fasta_fp, 5),
+                         [0, 15, 35, 50])
+        # no empty chunks
+        self.assertEqual(get_fasta_chunk_offsets(fasta_fp, 100),
+                         [0, 15, 35, 50])
+        self.assertRaises(ValueError, get_fasta_chunk_offsets, fasta_fp, 0)
+
+        open(fasta_fp, 'w').write('')
+        self.assertEqual(get_fasta_chunk_offsets(fasta_fp, 3), [0])
+        remove_files([fasta_fp])
+
+    def test_split_fasta_into_chunks(self):
+        """split_fasta_into_chunks always catches all seqs, in order
+        """
+        in_seqs = SequenceCollection.from_fasta_records(
+            [('seq%s' % k, 'AACCTTAA' * (k % 7 + 1)) for k in range(59)],
+            DNA)
+        fd, fasta_fp = mkstemp(dir=get_qiime_temp_dir(),
+                               prefix='split_fasta_tests',
+                               suffix='.fasta')
+        close(fd)
+        open(fasta_fp, 'w').write(in_seqs.to_fasta())
+        fd, filename_prefix = mkstemp(dir=get_qiime_temp_dir(),
+                                      prefix='split_fasta_tests',
+                                      suffix='')
+        close(fd)
+
+        for i in range(1, 100):
+            actual = split_fasta_into_chunks(fasta_fp, i, filename_prefix)
+
+            actual_seqs = []
+            for fp in actual:
+                actual_seqs += list(open(fp))
+            remove_files(actual)
+
+            self.assertTrue(len(actual) <= i)
+            self.assertEqual(
+                actual,
+                ['%s.%d.fasta' % (filename_prefix, j)
+                 for j in range(len(actual))])
+            self.assertEqual(list(parse_fasta(actual_seqs)),
+                             list(parse_fasta(in_seqs.to_fasta().split('\n'))))
+        remove_files([fasta_fp, filename_prefix])
+
+    def test_split_fasta_into_chunks_truncated(self):
+        """split_fasta_into_chunks raises an error if the file is truncated
+        """
+        fd, fasta_fp = mkstemp(dir=get_qiime_temp_dir(),
+                               prefix='split_fasta_tests',
+                               suffix='.fasta')
+        close(fd)
+        open(fasta_fp, 'w').write('>s1\nAACC\n>s2\nGGTT\n')
+        fd, filename_prefix = mkstemp(dir=get_qiime_temp_dir(),
+                                      prefix='split_fasta_tests',
+                                      suffix='')
+        close(fd)
+
+        # simulate the file being truncated after the offsets were found
+        get_offsets = qiime.split.get_fasta_chunk_offsets
+        qiime.split.get_fasta_chunk_offsets = lambda fp, n: [0, 10, 30]
+        try:
+            self.assertRaises(IOError, split_fasta_into_chunks, fasta_fp, 2,
+                              filename_prefix)
+        finally:
+            qiime.split.get_fasta_chunk_offsets = get_offsets
+            remove_files(['%s.%d.fasta' % (filename_prefix, i)
+                          for i in range(2)] + [fasta_fp, filename_prefix],
+                         error_on_missing=False)
+
 
 if __name__ == "__main__":
     main()
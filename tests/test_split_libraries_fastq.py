@@ -15,10 +15,13 @@ import numpy as np
 from unittest import TestCase, main
 from tempfile import mkdtemp, NamedTemporaryFile
 from shutil import rmtree
+from os import listdir, makedirs
+from os.path import join
 
 from qiime.split_libraries_fastq import (
     process_fastq_single_end_read_file,
     quality_filter_sequence,
+    quality_filter_sequences,
     bad_chars_from_threshold,
     get_illumina_qual_chars,
     quality_filter_sequence,
@@ -26,10 +29,15 @@ from qiime.split_libraries_fastq import (
     check_header_match_pre180,
     check_header_match_180_or_later,
     correct_barcode,
+    BarcodeCorrector,
     process_fastq_single_end_read_file_no_barcode,
+    process_fastq_single_end_read_file_parallel,
+    get_fastq_shard_offsets,
     extract_reads_from_interleaved
 )
 from qiime.golay import decode_golay_12
+from qiime.hamming import decode_hamming_8
+from qiime.barcode import correct_barcode_bitwise
 
 import skbio.parse.sequences
 from skbio.parse.sequences.fastq import ascii_to_phred64, ascii_to_phred33
@@ -143,6 +151,51 @@ class SplitLibrariesFastqTests(TestCase):
         expected = (1, "CCAGTGTATGCA", True, None)
         self.assertEqual(actual, expected)
 
+    def test_barcode_corrector_matches_correct_barcode(self):
+        """BarcodeCorrector gives same results as correct_barcode"""
+        barcode_to_sample_id = {
+            "GGAGACAAGGGA": "s1",
+            "ACACCTGGTGAT": "s2"}
+        barcodes = ["GGAGACAAGGGA", "GGAGACAAGGGT", "ACACCTGGTGAC",
+                    "CCAGTGTATGCA", "CCTGTGTATGCA", "CCAGTGTANGCA",
+                    "GGAGACAAGGGT"]
+        for correction_fn in (None, decode_golay_12):
+            corrector = BarcodeCorrector(barcode_to_sample_id, correction_fn)
+            for barcode in barcodes:
+                self.assertEqual(corrector(barcode),
+                                 correct_barcode(barcode,
+                                                 barcode_to_sample_id,
+                                                 correction_fn))
+        # each distinct barcode (plus the mapping barcodes) is stored once
+        self.assertEqual(len(corrector), 7)
+
+    def test_barcode_corrector_alt_correction_fns(self):
+        """BarcodeCorrector works with hamming and bitwise correction"""
+        barcode_to_sample_id = {"AACCATGC": "s1", "TCGTAGCA": "s2"}
+        corrector = BarcodeCorrector(barcode_to_sample_id, decode_hamming_8)
+        self.assertEqual(corrector("ACCCATGC"),
+                         (0.5, "AACCATGC", True, "s1"))
+        self.assertEqual(corrector("AACCATGC"),
+                         (0, "AACCATGC", False, "s1"))
+
+        barcodes = barcode_to_sample_id.keys()
+        corrector = BarcodeCorrector(
+            barcode_to_sample_id,
+            lambda bc: correct_barcode_bitwise(bc, barcodes))
+        self.assertEqual(corrector("TCGTAGCC"),
+                         (2, "TCGTAGCA", True, "s2"))
+
+    def test_barcode_corrector_max_cache_size(self):
+        """BarcodeCorrector stops caching when full"""
+        barcode_to_sample_id = {"GGAGACAAGGGA": "s1"}
+        corrector = BarcodeCorrector(barcode_to_sample_id, decode_golay_12,
+                                     max_cache_size=2)
+        self.assertEqual(corrector("GGAGACAAGGGT"),
+                         (1, "GGAGACAAGGGA", True, "s1"))
+        self.assertEqual(corrector("CCTGTGTATGCA"),
+                         (1, "CCAGTGTATGCA", True, None))
+        self.assertEqual(len(corrector), 2)
+
     def test_process_fastq_single_end_read_file_invalid_phred_offset(self):
         # passing phred_offset that isn't 33 or 64 raises error
         with self.assertRaises(ValueError):
@@ -194,6 +247,91 @@ class SplitLibrariesFastqTests(TestCase):
         for i in range(len(expected)):
             np.testing.assert_equal(actual[i], expected[i])
 
+    def _write_fastq_pair(self, fastq, barcode_fastq, repeats=1):
+        """write read and barcode fastq files to the temp dir"""
+        read_fp = join(self.temp_dir_path, 'reads.fastq')
+        barcode_fp = join(self.temp_dir_path, 'barcodes.fastq')
+        with open(read_fp, 'w') as f:
+            f.write(''.join([fastq.strip() + '\n'] * repeats))
+        with open(barcode_fp, 'w') as f:
+            f.write(''.join([barcode_fastq.strip() + '\n'] * repeats))
+        return read_fp, barcode_fp
+
+    def test_process_fastq_single_end_read_file_parallel(self):
+        """process_fastq_single_end_read_file_parallel matches serial run
+        """
+        read_fp, barcode_fp = self._write_fastq_pair(fastq1, barcode_fastq1,
+                                                     repeats=7)
+        params = {'store_unassigned': True,
+                  'min_per_read_length_fraction': 0.45,
+                  'start_seq_id': 42,
+                  'barcode_correction_fn': decode_golay_12}
+
+        exp_log_f = FakeFile()
+        exp_hist_f = FakeFile()
+        expected = list(process_fastq_single_end_read_file(
+            open(read_fp, 'U'), open(barcode_fp, 'U'), self.barcode_map1,
+            log_f=exp_log_f, histogram_f=exp_hist_f, **params))
+
+        for jobs_to_start in (1, 3):
+            log_f = FakeFile()
+            hist_f = FakeFile()
+            actual = list(process_fastq_single_end_read_file_parallel(
+                read_fp, barcode_fp, self.barcode_map1,
+                jobs_to_start=jobs_to_start, log_f=log_f, histogram_f=hist_f,
+                temp_dir=self.temp_dir_path, **params))
+            self.assertEqual(len(actual), len(expected))
+            for i in range(len(expected)):
+                np.testing.assert_equal(actual[i], expected[i])
+            self.assertEqual(log_f.s, exp_log_f.s)
+            self.assertEqual(hist_f.s, exp_hist_f.s)
+
+    def test_process_fastq_single_end_read_file_parallel_stopped(self):
+        """process_fastq_single_end_read_file_parallel removes all shards
+        """
+        read_fp, barcode_fp = self._write_fastq_pair(fastq1, barcode_fastq1,
+                                                     repeats=7)
+        shard_dir = join(self.temp_dir_path, 'shards')
+        makedirs(shard_dir)
+        seqs = process_fastq_single_end_read_file_parallel(
+            read_fp, barcode_fp, self.barcode_map1, jobs_to_start=3,
+            store_unassigned=True, min_per_read_length_fraction=0.45,
+            temp_dir=shard_dir)
+        seqs.next()
+        self.assertTrue(len(listdir(shard_dir)) > 0)
+        # the consumer stops before reading all of the shards
+        seqs.close()
+        self.assertEqual(listdir(shard_dir), [])
+
+    def test_get_fastq_shard_offsets(self):
+        """get_fastq_shard_offsets splits files on record boundaries
+        """
+        read_fp, barcode_fp = self._write_fastq_pair(fastq1, barcode_fastq1,
+                                                     repeats=3)
+        num_records = fastq1.strip().count('\n') // 4 + 1
+        shards = get_fastq_shard_offsets(read_fp, barcode_fp, 4,
+                                         buffer_size=100)
+        self.assertEqual(len(shards), 4)
+        self.assertEqual(shards[0][:2], (0, 0))
+        self.assertEqual(shards[-1][2], None)
+        self.assertEqual(sum([s[2] for s in shards[:-1]]) <
+                         3 * num_records, True)
+
+        read_f = open(read_fp, 'U')
+        barcode_f = open(barcode_fp, 'U')
+        for read_offset, barcode_offset, _ in shards:
+            read_f.seek(read_offset)
+            barcode_f.seek(barcode_offset)
+            read_header = read_f.readline()
+            barcode_header = barcode_f.readline()
+            self.assertTrue(read_header.startswith('@'))
+            self.assertTrue(check_header_match_pre180(read_header,
+                                                      barcode_header))
+
+        # a single shard covers the whole file
+        self.assertEqual(get_fastq_shard_offsets(read_fp, barcode_fp, 1),
+                         [(0, 0, None)])
+
     def test_process_fastq_single_end_read_file_no_barcode(self):
         """process_fastq_single_end_read_file functions as expected for non-barcoded lane
         """
@@ -991,6 +1129,53 @@ class SplitLibrariesFastqTests(TestCase):
              "GCACTCACCGCCCGTCAC",
              ascii_to_phred64("bbbbbbbbbbbbbbbbbb")))
 
+    def test_quality_filter_sequences(self):
+        """quality_filter_sequences matches quality_filter_sequence
+        """
+        np.random.seed(0)
+        headers = []
+        sequences = []
+        qualities = []
+        for i in range(200):
+            length = np.random.randint(0, 40)
+            headers.append("990:2:4:11271:%d#%d/1" % (i, i % 3))
+            sequences.append(''.join(np.random.choice(list('ACGTN'),
+                                                      length,
+                                                      p=[.24, .24, .24, .24,
+                                                         .04])))
+            qualities.append(np.random.randint(0, 8, length))
+
+        for max_bad_run_length in (0, 1, 3, 50):
+            for phred_quality_threshold in (None, 2, 5):
+                for seq_max_N in (0, 1):
+                    for filter_digit in (True, False):
+                        params = (max_bad_run_length,
+                                  phred_quality_threshold, 15, seq_max_N,
+                                  filter_digit)
+                        results, lengths = quality_filter_sequences(
+                            headers, sequences, qualities, *params)
+                        for i in range(len(sequences)):
+                            if len(sequences[i]) == 0:
+                                # quality_filter_sequence doesn't handle
+                                # empty reads
+                                continue
+                            exp_result, exp_seq, _ = \
+                                quality_filter_sequence(headers[i],
+                                                        sequences[i],
+                                                        qualities[i],
+                                                        *params)
+                            self.assertEqual(results[i], exp_result)
+                            if exp_result != 3:
+                                self.assertEqual(lengths[i], len(exp_seq))
+
+    def test_quality_filter_sequences_empty(self):
+        """quality_filter_sequences handles an empty block
+        """
+        results, lengths = quality_filter_sequences([], [], [], 3, 2, 0.75,
+                                                    0, False)
+        np.testing.assert_equal(results, [])
+        np.testing.assert_equal(lengths, [])
+
     def test_quality_filter_sequence_fail_w_N(self):
         """quality_filter_sequence handles N as expected
         """
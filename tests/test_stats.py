@@ -21,6 +21,7 @@ from StringIO import StringIO
 from unittest import TestCase, main
 from warnings import filterwarnings
 from itertools import izip
+from fractions import Fraction
 from types import StringType, ListType, FloatType, TupleType
 
 
@@ -28,18 +29,21 @@ from skbio.util import remove_files
 from numpy.testing import assert_almost_equal, assert_allclose
 from numpy import (array, asarray, roll, median, nan, arange, matrix,
                    concatenate, nan, ndarray, number, ones,
-                   reshape, testing, tril, var, log, fill_diagonal)
-from numpy.random import permutation, shuffle, seed
+                   reshape, testing, tril, var, log, fill_diagonal, isnan)
+from numpy.random import permutation, shuffle, seed, rand
 from biom import Table, load_table
 
 from qiime.stats import (all_pairs_t_test, _perform_pairwise_tests,
                          CorrelationStats,
                          DistanceMatrixStats, MantelCorrelogram,
-                         PartialMantel, quantile, _quantile,
+                         PartialMantel, MantelPermutations,
+                         permutation_p_value, mantel_pearson,
+                         quantile, _quantile,
                          paired_difference_analyses,
                          G_2_by_2, g_fit, t_paired, t_one_sample,
                          t_two_sample, mc_t_two_sample,
-                         _permute_observations,
+                         mc_t_two_sample_rows,
+                         _permute_observations, _permutation_indices,
                          correlation_t, ZeroExpectedError, fisher,
                          safe_sum_p_log_p, permute_2d,
                          pearson, spearman, ANOVA_one_way, mw_t,
@@ -55,7 +59,8 @@ from qiime.stats import (all_pairs_t_test, _perform_pairwise_tests,
                          normprob, tprob, fprob, chi2prob)
 from qiime.parse import parse_mapping_file_to_dict
 
-from skbio.stats.distance import (DissimilarityMatrix, DistanceMatrix)
+from skbio.stats.distance import (DissimilarityMatrix, DistanceMatrix,
+                                  mantel)
 
 from qiime.util import MetadataMap, get_qiime_temp_dir
 
@@ -852,6 +857,134 @@ class MantelCorrelogramTests(TestHelper):
         self.assertEqual(obs_ax.get_ylabel(), "Mantel correlation statistic")
 
 
+class MantelPermutationsTests(TestHelper):
+
+    """Tests for the MantelPermutations class and the functions using it."""
+
+    def setUp(self):
+        """Set up distance matrices for use in tests."""
+        super(MantelPermutationsTests, self).setUp()
+        data = self.overview_dm.data
+        self.other_dm = DistanceMatrix(data ** 2 + (data > 0.7) * 0.1,
+                                       self.overview_dm.ids)
+        self.small_data = array([[0, 1, 4], [1, 0, 3], [4, 3, 0]])
+
+    def test_call(self):
+        """Correlations match those of the explicitly permuted matrix."""
+        x = self.overview_dm.data
+        ys = [self.other_dm.condensed_form(), self.overview_dm.condensed_form()]
+        seed(0)
+        stats, perm_stats = MantelPermutations(ys)(x, 10)
+        self.assertEqual(perm_stats.shape, (10, 2))
+        assert_almost_equal(stats, [pearson(ys[0], ys[1]), 1.0])
+
+        seed(0)
+        for perm_stat in perm_stats:
+            x_perm = DistanceMatrix(permute_2d(x, permutation(x.shape[0])),
+                                    self.overview_dm.ids).condensed_form()
+            assert_almost_equal(perm_stat,
+                                [pearson(x_perm, ys[0]), pearson(x_perm, ys[1])])
+
+    def test_call_batches(self):
+        """Batch size does not change the permuted correlations."""
+        ys = [self.other_dm.condensed_form()]
+        seed(0)
+        _, exp = MantelPermutations(ys)(self.overview_dm.data, 25)
+        # One permutation at a time, and batches of 3 with a partial batch
+        # at the end.
+        for max_batch_bytes in 1000, 4000:
+            seed(0)
+            _, obs = MantelPermutations(ys, max_batch_bytes=max_batch_bytes)(
+                self.overview_dm.data, 25)
+            self.assertTrue((obs == exp).all())
+
+        _, obs = MantelPermutations(ys)(self.overview_dm.data, 0)
+        self.assertEqual(obs.shape, (0, 1))
+
+    def test_call_no_variation(self):
+        """Correlations with a constant distance matrix are nan."""
+        stats, perm_stats = MantelPermutations([[1, 1, 1]])(self.small_data,
+                                                             5)
+        self.assertTrue(isnan(stats).all())
+        self.assertTrue(isnan(perm_stats).all())
+
+    def test_invalid_input(self):
+        """Mismatched or malformed distance matrices raise an error."""
+        self.assertRaises(ValueError, MantelPermutations, [[1, 2, 3, 4]])
+        self.assertRaises(ValueError, MantelPermutations, [[1, 2, 3], [1, 2]])
+        permutations = MantelPermutations([[1, 2, 3]])
+        self.assertRaises(ValueError, permutations, self.overview_dm.data)
+
+    def test_permutation_p_value(self):
+        """p-values count the permuted stats at least as extreme."""
+        perm_stats = array([-0.5, -0.2, 0.1, 0.3, 0.6])
+        self.assertEqual(permutation_p_value(0.3, perm_stats, 'greater'),
+                         3 / 6)
+        self.assertEqual(permutation_p_value(0.3, perm_stats, 'less'), 5 / 6)
+        self.assertEqual(permutation_p_value(-0.3, perm_stats), 4 / 6)
+        self.assertTrue(isnan(permutation_p_value(nan, perm_stats)))
+        self.assertTrue(isnan(permutation_p_value(0.3, array([]))))
+        self.assertRaises(ValueError, permutation_p_value, 0.3, perm_stats,
+                          'foo')
+
+    def test_mantel_test(self):
+        """mantel_pearson gives the same results as skbio's mantel."""
+        for alternative in 'two-sided', 'greater', 'less':
+            seed(0)
+            exp = mantel(self.overview_dm, self.other_dm, permutations=99,
+                         alternative=alternative)
+            seed(0)
+            obs = mantel_pearson(self.overview_dm, self.other_dm, 99,
+                                 alternative)
+            assert_almost_equal(obs, exp)
+
+        # y is reordered to match x.
+        ids = self.overview_dm.ids[::-1]
+        seed(0)
+        obs = mantel_pearson(self.overview_dm, self.other_dm.filter(ids), 99)
+        seed(0)
+        exp = mantel_pearson(self.overview_dm, self.other_dm, 99)
+        assert_almost_equal(obs, exp)
+
+        stat, p_value, n = mantel_pearson(self.overview_dm, self.other_dm, 0)
+        self.assertTrue(isnan(p_value))
+        self.assertEqual(n, 9)
+
+    def test_mantel_test_small_matrices(self):
+        """mantel_pearson gives exactly skbio's p-values on small matrices.
+
+        Small matrices are often permuted back to the observed distances, and
+        those permutations must tie exactly with the observed statistic.
+        """
+        for i in range(60):
+            seed(i)
+            n = 3 + i % 4
+            ids = ['s%d' % j for j in range(n)]
+            data = rand(2, n, n)
+            if i % 2:
+                data = data.round(1)
+            data = data + data.transpose(0, 2, 1)
+            for d in data:
+                fill_diagonal(d, 0)
+            x, y = DistanceMatrix(data[0], ids), DistanceMatrix(data[1], ids)
+            for alternative in 'two-sided', 'greater', 'less':
+                seed(i)
+                exp = mantel(x, y, permutations=99, alternative=alternative)
+                seed(i)
+                obs = mantel_pearson(x, y, 99, alternative)
+                self.assertEqual(obs[1:], exp[1:])
+                assert_almost_equal(obs[0], exp[0])
+
+    def test_mantel_test_invalid_input(self):
+        """mantel_pearson raises an error on incompatible input."""
+        dm = DistanceMatrix(self.small_data, ['s1', 's2', 's3'])
+        self.assertRaises(ValueError, mantel_pearson, self.overview_dm, dm)
+        self.assertRaises(ValueError, mantel_pearson, dm, dm, -1)
+        self.assertRaises(ValueError, mantel_pearson, dm, dm, 99, 'foo')
+        dm = DistanceMatrix([[0, 1], [1, 0]], ['s1', 's2'])
+        self.assertRaises(ValueError, mantel_pearson, dm, dm)
+
+
 class PartialMantelTests(TestHelper):
 
     """Tests for the PartialMantel class."""
@@ -1576,6 +1709,122 @@ class StatTests(TestsHelper):
         self.assertRaises(ValueError, mc_t_two_sample, [1], [4.])
         self.assertRaises(ValueError, mc_t_two_sample, [1, 2], [])
 
+    def test_mc_t_two_sample_rows(self):
+        """Test each row without ties gets the results of mc_t_two_sample."""
+        x = array([[72, 71, 91, 72, 73, 72, 75],
+                   [1, 1, 2, 0, 0, 0, 3],
+                   [1, 1, 1, 1, 1, 1, 1],
+                   [88, 75, 77, 76, 74, 67, 72]])
+        y = array([[88, 75, 77, 76, 74, 67, 72],
+                   [0, 0, 0, 5, 0, 1, 0],
+                   [1, 1, 1, 1, 1, 1, 1],
+                   [72, 71, 91, 72, 73, 72, 75]])
+        for tails in 'two-sided', 'low', 'high':
+            for exp_diff in 0, 1:
+                seed(0)
+                obs = mc_t_two_sample_rows(x, y, tails=tails,
+                                           permutations=99, exp_diff=exp_diff,
+                                           max_batch_bytes=1000)
+                for i in range(len(x)):
+                    seed(0)
+                    exp = mc_t_two_sample(x[i], y[i], tails=tails,
+                                          permutations=99, exp_diff=exp_diff)
+                    assert_allclose([o[i] for o in obs],
+                                    [exp[0], exp[1], exp[3]])
+
+    def test_mc_t_two_sample_rows_ties(self):
+        """Test permutations giving the observed groups count as ties."""
+        # Only the permutations that put 3.02 (the smallest value) back in a
+        # group on its own give a t statistic as low as the observed one.
+        x = array([[3.02]])
+        y = array([[4.02, 3.88, 3.34, 3.87, 3.18]])
+        seed(0)
+        exp = ((_permutation_indices(6, 999)[:, 0] == 0).sum() + 1) / 1000
+        seed(0)
+        obs = mc_t_two_sample_rows(x, y, tails='low', permutations=999)
+        assert_allclose(obs[2], [exp])
+
+        seed(0)
+        exp = ((_permutation_indices(6, 999)[:, 5] == 0).sum() + 1) / 1000
+        seed(0)
+        obs = mc_t_two_sample_rows(y, x, tails='low', permutations=999)
+        assert_allclose(obs[2], [exp])
+
+    def test_mc_t_two_sample_rows_integer_ties(self):
+        """Test tied t statistics on integer counts are all counted.
+
+        Permutations which swap equal counts between the groups give the
+        observed t statistic exactly, and the p-values count every
+        permutation whose t statistic is at least as extreme in exact
+        arithmetic (mc_t_two_sample misses some of them to rounding error).
+        """
+        def signed_t_sq(x, y):
+            # Increases with the t statistic.
+            mean_x = Fraction(sum(x), len(x))
+            mean_y = Fraction(sum(y), len(y))
+            sum_sq_dev = (sum((v - mean_x) ** 2 for v in x) +
+                          sum((v - mean_y) ** 2 for v in y))
+            diff = mean_x - mean_y
+            return diff * abs(diff) / (sum_sq_dev / (len(x) + len(y) - 2) *
+                                       (Fraction(1, len(x)) +
+                                        Fraction(1, len(y))))
+
+        x = array([[0, 0, 0, 1, 3], [2, 0, 1, 1, 4], [5, 1, 0, 2, 2]])
+        y = array([[0, 0, 0, 4], [1, 1, 0, 3], [0, 1, 2, 0]])
+        for tails in 'two-sided', 'low', 'high':
+            seed(0)
+            obs = mc_t_two_sample_rows(x, y, tails=tails, permutations=199)
+            seed(0)
+            perm_indices = _permutation_indices(9, 199)
+            for i in range(len(x)):
+                vals = sorted(list(x[i]) + list(y[i]))
+                obs_t = signed_t_sq(x[i], y[i])
+                perm_ts = [signed_t_sq([vals[j] for j in inds[:5]],
+                                       [vals[j] for j in inds[5:]])
+                           for inds in perm_indices]
+                if tails == 'two-sided':
+                    count = sum(abs(t) >= abs(obs_t) for t in perm_ts)
+                elif tails == 'low':
+                    count = sum(t <= obs_t for t in perm_ts)
+                else:
+                    count = sum(t >= obs_t for t in perm_ts)
+                self.assertEqual(obs[2][i], (count + 1) / 200)
+
+        # The first row is the one with the most ties.
+        seed(0)
+        self.assertEqual(mc_t_two_sample_rows(x[:1], y[:1],
+                                              permutations=199)[2], [1.])
+
+    def test_mc_t_two_sample_rows_single_obs(self):
+        """Test rows with a single observation in one of the groups."""
+        x = array([[3], [4]])
+        y = array([[4, 3, 5, 3, 2], [1, 2, 3, 4, 5]])
+        for a, b in (x, y), (y, x):
+            seed(0)
+            obs = mc_t_two_sample_rows(a, b, exp_diff=0.5)
+            for i in range(len(x)):
+                seed(0)
+                exp = mc_t_two_sample(a[i], b[i], exp_diff=0.5)
+                assert_allclose([o[i] for o in obs], [exp[0], exp[1], exp[3]])
+
+    def test_mc_t_two_sample_rows_no_perms(self):
+        """Test gives nan nonparametric p-values if no perms are given."""
+        obs = mc_t_two_sample_rows([[7.2, 7.1, 9.1]], [[8.8, 7.5, 7.7]],
+                                   permutations=0)
+        exp = mc_t_two_sample([7.2, 7.1, 9.1], [8.8, 7.5, 7.7],
+                              permutations=0)
+        assert_allclose([o[0] for o in obs], [exp[0], exp[1], nan])
+
+    def test_mc_t_two_sample_rows_invalid_input(self):
+        """Test fails on various invalid input."""
+        self.assertRaises(ValueError, mc_t_two_sample_rows, [[1]], [[4.]])
+        self.assertRaises(ValueError, mc_t_two_sample_rows, [[1, 2]],
+                          [[]])
+        self.assertRaises(ValueError, mc_t_two_sample_rows, [[1, 2]],
+                          [[1, 2]], permutations=-1)
+        self.assertRaises(ValueError, mc_t_two_sample_rows, [[1, 2]],
+                          [[1, 2]], tails='foo')
+
     def test_permute_observations(self):
         """Test works correctly on small input dataset."""
         I = [10, 20., 1]
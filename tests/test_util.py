@@ -2,8 +2,10 @@
 from __future__ import division
 # unit tests for util.py
 
-from os import chdir, getcwd, mkdir, rmdir, remove, close
+from os import chdir, getcwd, mkdir, rmdir, remove, close, environ, pathsep
 from os.path import split, abspath, dirname, exists, isdir, join
+from subprocess import Popen, PIPE
+from sys import executable
 from glob import glob
 from random import seed
 from shutil import rmtree
@@ -2324,6 +2326,66 @@ class RExecutorTests(TestCase):
         self.assertTrue(len(results) > 0)
 
 
+startup_probe = """
+import sys
+from time import time
+from StringIO import StringIO
+from runpy import run_path
+start = time()
+sys.stdout = StringIO()
+sys.argv = %r
+try:
+    %s
+except SystemExit:
+    pass
+sys.__stdout__.write('%%f\\n%%s\\n' %% (time() - start,
+                                       ' '.join(sys.modules)))
+"""
+
+
+class StartupTimeTests(TestCase):
+
+    """Guard against slow dependencies being imported at startup."""
+
+    # packages that should only be imported by the functions that use them
+    lazy_dependencies = ['skbio', 'bfillings.blast', 'qiime_default_reference']
+
+    def _startup(self, statement, argv=None):
+        """Return (seconds, imported module names) for statement in a fresh
+        interpreter"""
+        env = environ.copy()
+        env['PYTHONPATH'] = pathsep.join(
+            [get_qiime_project_dir(), env.get('PYTHONPATH', '')])
+        code = startup_probe % (argv or [''], statement)
+        proc = Popen([executable, '-c', code], stdout=PIPE, env=env)
+        stdout, _ = proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+        seconds, modules = stdout.splitlines()[-2:]
+        return float(seconds), set(modules.split())
+
+    def test_library_imports(self):
+        """importing core QIIME modules does not import lazy dependencies"""
+        for module in ['qiime.util', 'qiime.parse', 'qiime.format',
+                       'qiime.filter', 'qiime.sort']:
+            _, modules = self._startup('import %s' % module)
+            for dependency in self.lazy_dependencies:
+                self.assertFalse(dependency in modules,
+                                 "%s imports %s" % (module, dependency))
+
+    def test_script_startup(self):
+        """light scripts start faster than importing scikit-bio alone"""
+        skbio_seconds, _ = self._startup('import skbio')
+        for script in ['filter_fasta.py', 'count_seqs.py',
+                       'print_qiime_config.py']:
+            fp = join(get_qiime_scripts_dir(), script)
+            seconds, modules = self._startup(
+                'run_path(%r, run_name="__main__")' % fp, [fp, '-h'])
+            self.assertFalse('skbio' in modules,
+                             "%s imports skbio at startup" % script)
+            self.assertTrue(seconds < skbio_seconds,
+                            "%s took %1.2fs to start" % (script, seconds))
+
+
 # Long strings of test data go here
 fasta_lines = """>seq1
 ACCAGCGGAGAC
@@ -11,19 +11,32 @@ __maintainer__ = "Greg Caporaso"
 __email__ = "gregcaporaso@gmail.com"
 
 from shutil import rmtree
+from functools import partial
+from optparse import Values
 from glob import glob
+from time import time
 from os.path import exists, join, getsize
 from tempfile import mkdtemp
 
 from unittest import TestCase, main
 from skbio.util import remove_files
+import qiime.workflow.util
 from qiime.util import load_qiime_config, get_qiime_temp_dir
 from qiime.parse import parse_qiime_parameters
 from qiime.test import (initiate_timeout,
                         disable_timeout,
                         get_test_data_fps)
 from qiime.workflow.util import (call_commands_serially,
+                                 call_commands_concurrently,
+                                 get_command_handler,
+                                 print_commands,
+                                 get_command_dependencies,
+                                 get_in_process_script_fp,
+                                 qiime_script_call,
                                  no_status_updates,
+                                 WorkflowLogger,
+                                 WorkflowStepCache,
+                                 WorkflowCheckpoints,
                                  WorkflowError)
 from qiime.workflow.downstream import run_beta_diversity_through_plots
 
@@ -77,5 +90,283 @@ class WorkflowTests(TestCase):
         log_fp = glob(join(self.test_out, 'log*.txt'))[0]
         self.assertTrue(getsize(log_fp) > 0)
 
+    def test_get_command_dependencies(self):
+        """get_command_dependencies orders commands by their inputs/outputs
+        """
+        commands = [[('a', 'a', ['in.txt'], ['a.txt'])],
+                    [('b', 'b', ['in.txt'], ['b/'])],
+                    [('c', 'c', ['a.txt', 'b/x.txt'], ['c.txt']),
+                     ('d', 'd', [], [])],
+                    [('rm', 'rm in.txt', [], ['in.txt'])],
+                    [('e', 'e')],
+                    [('f', 'f', [], ['f.txt'])]]
+        flat_commands, dependencies = get_command_dependencies(commands)
+        self.assertEqual([e[0] for e in flat_commands],
+                         ['a', 'b', 'c', 'd', 'rm', 'e', 'f'])
+        self.assertEqual(dependencies,
+                         [set(), set(), set([0, 1]), set([2]), set([0, 1]),
+                          set([0, 1, 2, 3, 4]), set([5])])
+
+    def test_call_commands_concurrently(self):
+        """call_commands_concurrently runs independent commands at once
+        """
+        log_fp = join(self.test_out, 'log.txt')
+        out_fp = join(self.test_out, 'out.txt')
+        commands = [[('Sleep 1', 'sleep 1; echo 1 >> %s' % out_fp,
+                      [], ['1.txt'])],
+                    [('Sleep 2', 'sleep 1; echo 2 >> %s' % out_fp,
+                      [], ['2.txt'])],
+                    [('Combine', 'echo 3 >> %s' % out_fp,
+                      ['1.txt', '2.txt'], [])]]
+        start = time()
+        call_commands_concurrently(commands, no_status_updates,
+                                   WorkflowLogger(log_fp),
+                                   max_concurrent_jobs=2)
+        self.assertTrue(time() - start < 1.9)
+        self.assertEqual(sorted(open(out_fp).read().split()),
+                         ['1', '2', '3'])
+        self.assertEqual(open(out_fp).read().split()[-1], '3')
+        log = open(log_fp).read()
+        self.assertTrue('# Combine command \necho 3' in log)
+        self.assertTrue('Logging stopped' in log)
+
+        # failures are raised as WorkflowErrors, and later commands aren't run
+        commands = [[('Fail', 'sleep 0.2; false', [], ['1.txt'])],
+                    [('Succeed', 'echo 4 >> %s' % out_fp, [], ['2.txt'])],
+                    [('Skipped', 'echo 5 >> %s' % out_fp, ['1.txt'], [])]]
+        self.assertRaises(WorkflowError, call_commands_concurrently,
+                          commands, no_status_updates,
+                          WorkflowLogger(log_fp), max_concurrent_jobs=2)
+        self.assertEqual(open(out_fp).read().split()[-1], '4')
+        self.assertTrue('ERROR RAISED DURING STEP: Fail' in
+                        open(log_fp).read())
+
+        # commands which can't be started are also raised as WorkflowErrors
+        commands = [[('Bad', 'echo a\0b', [], [])]]
+        self.assertRaises(WorkflowError, call_commands_concurrently,
+                          commands, no_status_updates,
+                          WorkflowLogger(log_fp), max_concurrent_jobs=2)
+        self.assertTrue('Command could not be run: TypeError' in
+                        open(log_fp).read())
+
+    def test_workflow_step_cache(self):
+        """WorkflowStepCache restores outputs of commands with the same inputs
+        """
+        cache_dir = join(self.test_out, 'cache')
+        in_fp = join(self.test_out, 'in.txt')
+        open(in_fp, 'w').write('abc\n')
+        runs_fp = join(self.test_out, 'runs.txt')
+
+        def get_command(out_fp):
+            return ('Copy', 'cp %s %s; echo run >> %s' %
+                    (in_fp, out_fp, runs_fp), [in_fp], [out_fp])
+
+        step_cache = WorkflowStepCache(cache_dir)
+        out1_fp = join(self.test_out, 'out1.txt')
+        out2_fp = join(self.test_out, 'out2.txt')
+        # the output filepaths aren't part of the key
+        key = step_cache.get_key(get_command(out1_fp))
+        self.assertEqual(key, step_cache.get_key(get_command(out2_fp)))
+        self.assertEqual(step_cache.get_key(('Copy', 'echo')), None)
+
+        for out_fp in [out1_fp, out2_fp]:
+            call_commands_serially([[get_command(out_fp)]],
+                                   no_status_updates,
+                                   WorkflowLogger(),
+                                   step_cache=step_cache)
+            self.assertEqual(open(out_fp).read(), 'abc\n')
+        # the second command was restored from the cache
+        self.assertEqual(open(runs_fp).read(), 'run\n')
+
+        # changing the input changes the key
+        open(in_fp, 'w').write('abcd\n')
+        self.assertNotEqual(step_cache.get_key(get_command(out1_fp)), key)
+        call_commands_concurrently([[get_command(out2_fp)]],
+                                   no_status_updates,
+                                   WorkflowLogger(),
+                                   step_cache=step_cache)
+        self.assertEqual(open(out2_fp).read(), 'abcd\n')
+        self.assertEqual(open(runs_fp).read(), 'run\nrun\n')
+
+        # force runs the commands again
+        step_cache = WorkflowStepCache(cache_dir, force=True)
+        call_commands_serially([[get_command(out2_fp)]],
+                               no_status_updates,
+                               WorkflowLogger(),
+                               step_cache=step_cache)
+        self.assertEqual(open(runs_fp).read(), 'run\nrun\nrun\n')
+
+        # the least recently used entries are evicted
+        self.assertEqual(len(glob(join(cache_dir, '*'))), 2)
+        step_cache = WorkflowStepCache(cache_dir, max_size=5)
+        step_cache.store(step_cache.get_key(get_command(out2_fp)),
+                         get_command(out2_fp))
+        self.assertEqual(glob(join(cache_dir, '*')),
+                         [join(cache_dir,
+                               step_cache.get_key(get_command(out2_fp)))])
+
+    def test_workflow_checkpoints(self):
+        """WorkflowCheckpoints skips validated steps when resuming a run
+        """
+        manifest_fp = join(self.test_out, 'checkpoints.txt')
+        in_fp = join(self.test_out, 'in.txt')
+        open(in_fp, 'w').write('abc\n')
+        runs_fp = join(self.test_out, 'runs.txt')
+        a_fp = join(self.test_out, 'a.txt')
+        b_fp = join(self.test_out, 'b.txt')
+        commands = [[('A', 'cp %s %s; echo A >> %s' % (in_fp, a_fp, runs_fp),
+                      [in_fp], [a_fp]),
+                     ('B', 'cat %s %s > %s; echo B >> %s' %
+                      (a_fp, a_fp, b_fp, runs_fp), [a_fp], [b_fp])]]
+
+        def run(resume):
+            checkpoints = WorkflowCheckpoints(manifest_fp, resume=resume)
+            call_commands_serially(commands,
+                                   no_status_updates,
+                                   WorkflowLogger(),
+                                   step_cache=checkpoints)
+            return checkpoints
+
+        # the first run fails at step B, which can be resumed
+        commands[0][1] = ('B', 'cat %s %s/x > %s' % (a_fp, a_fp, b_fp),
+                          [a_fp], [b_fp])
+        self.assertRaises(WorkflowError, run, True)
+        self.assertEqual(open(runs_fp).read(), 'A\n')
+        commands[0][1] = ('B', 'cat %s %s > %s; echo B >> %s' %
+                          (a_fp, a_fp, b_fp, runs_fp), [a_fp], [b_fp])
+        run(True)
+        self.assertEqual(open(runs_fp).read(), 'A\nB\n')
+        self.assertEqual(open(b_fp).read(), 'abc\nabc\n')
+        run(True)
+        self.assertEqual(open(runs_fp).read(), 'A\nB\n')
+
+        # outputs are validated: changing one reruns its step, and changing
+        # an input reruns the steps that read it
+        open(b_fp, 'w').write('abc\n')
+        run(True)
+        self.assertEqual(open(runs_fp).read(), 'A\nB\nB\n')
+        self.assertEqual(open(b_fp).read(), 'abc\nabc\n')
+        open(in_fp, 'w').write('x\n')
+        run(True)
+        self.assertEqual(open(runs_fp).read(), 'A\nB\nB\nA\nB\n')
+
+        # without resume, all steps are run, and a new manifest is started
+        run(False)
+        self.assertEqual(open(runs_fp).read(), 'A\nB\nB\nA\nB\nA\nB\n')
+        self.assertEqual(len(open(manifest_fp).readlines()), 5)
+
+        # steps which aren't run as commands, and removed inputs
+        step = ('Move', 'mv %s %s' % (b_fp, in_fp), [b_fp], [in_fp])
+        checkpoints = WorkflowCheckpoints(manifest_fp)
+        self.assertFalse(checkpoints.is_complete(step))
+        checkpoints.mark_complete(step)
+        self.assertTrue(checkpoints.is_complete(step))
+        remove_files([b_fp])
+        self.assertTrue(WorkflowCheckpoints(manifest_fp).is_complete(step))
+        self.assertFalse(WorkflowCheckpoints(manifest_fp,
+                                             resume=False).is_complete(step))
+        self.assertEqual(checkpoints.get_key(('Copy', 'echo')), None)
+
+    def test_get_command_handler(self):
+        """get_command_handler applies the workflow options
+        """
+        opts = Values({'concurrent_jobs': 1, 'in_process': False,
+                       'step_cache_dir': None, 'step_cache_max_size': 10.0,
+                       'rerun_cached_steps': False})
+        self.assertEqual(get_command_handler(opts), call_commands_serially)
+
+        opts.concurrent_jobs = 3
+        opts.in_process = True
+        opts.step_cache_dir = join(self.test_out, 'cache')
+        opts.rerun_cached_steps = True
+        command_handler = get_command_handler(opts)
+        self.assertTrue(isinstance(command_handler, partial))
+        keywords = {}
+        while isinstance(command_handler, partial):
+            keywords.update(command_handler.keywords)
+            command_handler = command_handler.func
+        self.assertEqual(command_handler, call_commands_concurrently)
+        self.assertEqual(keywords['max_concurrent_jobs'], 3)
+        self.assertTrue(keywords['in_process'])
+        self.assertTrue(keywords['step_cache']._force)
+        self.assertEqual(keywords['step_cache']._max_size, 10 * 1024 ** 3)
+
+        # only printing ignores the other options
+        self.assertEqual(get_command_handler(opts, print_only=True),
+                         print_commands)
+
+    def test_get_in_process_script_fp(self):
+        """get_in_process_script_fp only accepts QIIME script commands
+        """
+        self.assertTrue(get_in_process_script_fp(
+            'single_rarefaction.py -i a.biom -o b.biom -d 10').endswith(
+            '/single_rarefaction.py'))
+        self.assertEqual(get_in_process_script_fp(
+            'single_rarefaction.py -i a.biom -d 10 > log.txt'), None)
+        self.assertEqual(get_in_process_script_fp('mv a.txt b.txt'), None)
+        self.assertEqual(get_in_process_script_fp('not_a_script.py'), None)
+        self.assertEqual(get_in_process_script_fp(''), None)
+
+    def test_qiime_script_call(self):
+        """qiime_script_call runs QIIME scripts like qiime_system_call
+        """
+        out_fp = join(self.test_out, 'even.biom')
+        command = 'single_rarefaction.py -i %s -o %s -d 10' % \
+            (self.test_data['biom'][0], out_fp)
+        self.assertEqual(qiime_script_call(command), ('', '', 0))
+        self.assertTrue(exists(out_fp))
+
+        stdout, stderr, return_value = qiime_script_call(
+            'single_rarefaction.py -i %s' % self.test_data['biom'][0])
+        self.assertEqual(return_value, 2)
+        self.assertTrue('--output_path' in stderr)
+
+        # commands which aren't QIIME scripts are run by the shell
+        self.assertEqual(qiime_script_call('echo hello | cat'),
+                         ('hello\n', '', 0))
+
+    def test_qiime_script_call_sys_exit(self):
+        """qiime_script_call closes files and runs exit functions on exit
+        """
+        script_fp = join(self.test_out, 'write_and_exit.py')
+        open(script_fp, 'w').write(
+            "import atexit\n"
+            "import sys\n"
+            "out = open(sys.argv[1], 'w')\n"
+            "out.write('hello\\n')\n"
+            "atexit.register(lambda: open(sys.argv[2], 'w').write('bye'))\n"
+            "sys.exit(0)\n")
+        out_fp = join(self.test_out, 'out.txt')
+        exit_fp = join(self.test_out, 'exit.txt')
+
+        get_qiime_scripts_dir = qiime.workflow.util.get_qiime_scripts_dir
+        qiime.workflow.util.get_qiime_scripts_dir = lambda: self.test_out
+        try:
+            self.assertEqual(qiime_script_call('write_and_exit.py %s %s' %
+                                               (out_fp, exit_fp)),
+                             ('', '', 0))
+        finally:
+            qiime.workflow.util.get_qiime_scripts_dir = get_qiime_scripts_dir
+        self.assertEqual(open(out_fp).read(), 'hello\n')
+        self.assertEqual(open(exit_fp).read(), 'bye')
+
+    def test_call_commands_concurrently_in_process(self):
+        """QIIME scripts can be run in process by several threads at once
+        """
+        log_fp = join(self.test_out, 'log.txt')
+        out_fps = [join(self.test_out, 'even%d.biom' % i) for i in range(6)]
+        commands = [[('Rarefy %d' % i,
+                      'single_rarefaction.py -i %s -o %s -d 10' %
+                      (self.test_data['biom'][0], out_fp),
+                      [self.test_data['biom'][0]], [out_fp])]
+                    for i, out_fp in enumerate(out_fps)]
+        call_commands_concurrently(commands, no_status_updates,
+                                   WorkflowLogger(log_fp),
+                                   max_concurrent_jobs=3, in_process=True)
+        for out_fp in out_fps:
+            self.assertTrue(exists(out_fp))
+        self.assertTrue('Logging stopped' in open(log_fp).read())
+
+
 if __name__ == "__main__":
     main()